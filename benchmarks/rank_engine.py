@@ -0,0 +1,53 @@
+"""
+排行榜计算耗时: rank.calc_ranks 的 numpy 与 heapq 实现, 以及 RankStore 的查询和单个用户更新, 只使用内存中的行
+用法: python benchmarks/rank_engine.py [用户数]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from yinpa import models as m  # noqa: E402
+from yinpa import rank  # noqa: E402
+
+
+def make_rows(count: int):
+    random.seed(0)
+    generators = {
+        "sex": lambda: random.choice((0, 1, 1, 2)), "length": lambda: round(random.uniform(-30, 30), 2),
+        "persistance": lambda: round(random.uniform(100, 600), 2), "chest_size": lambda: round(random.uniform(0, 30), 2),
+        "injected_count": lambda: random.randint(0, 1000), "shoot_count": lambda: random.randint(0, 1000),
+    }
+    columns = rank.get_rank_columns()
+    return [tuple(i if c == "id" else generators.get(c, lambda: round(random.uniform(0, 1e5), 4))() for c in columns)
+            for i in range(count)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = make_rows(count)
+    target = m.UserInfo.get_init(0, "benchmark")
+    if rank.calc_ranks(rows, target, use_numpy=True) != rank.calc_ranks(rows, target, use_numpy=False):
+        raise AssertionError("numpy and heapq results differ")
+    for name, use_numpy in (("heapq", False), ("numpy", True)):
+        best = min(timeit.repeat(lambda: rank.calc_ranks(rows, target, use_numpy=use_numpy), number=1, repeat=5))
+        print(f"{name:<8}{count} users, {len(rank.RANK_BOARDS)} boards: {best * 1e3:.1f} ms")
+
+    store = rank.RankStore()
+    store.rebuild(lambda columns: rows)
+    if store.calc_ranks(target) != rank.calc_ranks(rows, target):
+        raise AssertionError("RankStore and calc_ranks results differ")
+    best = min(timeit.repeat(lambda: store.calc_ranks(target), number=100, repeat=5)) / 100
+    print(f"{'store':<8}{count} users, {len(rank.RANK_BOARDS)} boards: {best * 1e3:.3f} ms")
+
+    columns = rank.get_rank_columns()[1:]
+    updates = [dict(zip(columns, row[1:])) for row in make_rows(1000)]
+    best = min(timeit.repeat(lambda: [store.update(random.randrange(count), i) for i in updates],
+                             number=1, repeat=5)) / len(updates)
+    print(f"{'update':<8}one user, {len(rank.RANK_BOARDS)} boards: {best * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
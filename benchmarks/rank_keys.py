@@ -0,0 +1,59 @@
+"""
+排行榜取值耗时: 原 yinpa_main.get_rank_data 的 heapq 排序和逐个比较的名次计算 (get_target_rank), 只使用内存中的用户。
+与 rank 模块的对比见 rank_engine.py
+用法: python benchmarks/rank_keys.py [用户数]
+"""
+import heapq
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from yinpa import models as m  # noqa: E402
+
+RANK_KEYS = ["length", "persistance", "prostitution", "chest_size", "injected_vol", "injected_count", "shoot_count",
+             "shoot_vol", "active_time", "passive_time"]
+
+
+def get_target_rank(lst, target, key, reverse=False):
+    count = 0
+    for i in lst:
+        if (key(i) > key(target)) if not reverse else (key(i) < key(target)):
+            count += 1
+    return count + 1
+
+
+def make_users(count: int):
+    random.seed(0)
+    base = m.UserInfo.get_init(0, "benchmark")
+    users = []
+    for i in range(count):
+        users.append(base.copy(update={
+            "id": i, "length": random.uniform(-30, 30), "persistance": random.uniform(100, 600),
+            "chest_size": random.uniform(0, 30), "injected_vol": random.uniform(0, 1e5),
+            "injected_count": random.randint(0, 1000), "shoot_count": random.randint(0, 1000),
+            "shoot_vol": random.uniform(0, 1e5), "active_time": random.uniform(0, 1e5),
+            "passive_time": random.uniform(0, 1e5), "prostitution": random.uniform(0, 1e6)}))
+    return users
+
+
+def rank_all(users, target, count_limit=40):
+    for name in RANK_KEYS:
+        def key(u):
+            return getattr(u, name)
+        heapq.nlargest(count_limit, users, key=key)
+        heapq.nsmallest(count_limit, users, key=key)
+        get_target_rank(users, target, key)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    users = make_users(count)
+    best = min(timeit.repeat(lambda: rank_all(users, users[0]), number=1, repeat=5))
+    print(f"{count} users, {len(RANK_KEYS)} keys: {best * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+排行榜绘制耗时: 当前线程依次绘制与 render_pool.RankRenderPool 多进程绘制对比 (不使用表格缓存)
+需要在 msyh.ttc 所在目录运行。只有一个 CPU 时进程池没有收益
+用法: python benchmarks/rank_render.py [进程数] [每张表的人数]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import ImageChops  # noqa: E402
+
+from yinpa import image_generate, rank  # noqa: E402
+from yinpa import models as m  # noqa: E402
+from yinpa.database import YinpaDB  # noqa: E402
+from yinpa.render_pool import RankRenderPool  # noqa: E402
+
+
+def make_rank_data(count_limit: int):
+    random.seed(0)
+    base = m.UserInfo.get_init(0, "benchmark")
+    users = []
+    for i in range(count_limit * 5):
+        users.append(base.copy(update={
+            "id": i, "name": f"user{i}", "length": random.uniform(-30, 30), "persistance": random.uniform(100, 600),
+            "chest_size": random.uniform(0, 30), "injected_vol": random.uniform(0, 1e5),
+            "injected_count": random.randint(0, 1000), "shoot_count": random.randint(0, 1000),
+            "shoot_vol": random.uniform(0, 1e5), "active_time": random.uniform(0, 1e5),
+            "passive_time": random.uniform(0, 1e5), "prostitution": random.uniform(0, 1e6)}))
+    columns = rank.get_rank_columns()
+    rows = [[YinpaDB._user_column_value(u, c) for c in columns] for u in users]
+    target = users[0]
+    return [dict(head_part=[users[u] for u in i.head_ids], key=i.board.get_display(), total_count=i.total_count,
+                 end_part=None if i.end_ids is None else [users[u] for u in i.end_ids], title=i.board.title,
+                 item_name=i.board.item_name, target_userinfo=target, target_user_rank=i.target_rank, table_w=400)
+            for i in rank.calc_ranks(rows, target, count_limit)]
+
+
+def best_of(func, repeat=3):
+    ret = None
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = func()
+        best = min(best, time.perf_counter() - start)
+    return best, ret
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    count_limit = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    rank_data = make_rank_data(count_limit)
+    pool = RankRenderPool(processes)
+    # 导入 yinpa 时已经启动了数据库写线程, 这里的 fork 只用于测量, 渲染进程不会用到这些线程持有的锁
+    pool.start()
+
+    serial, expected = best_of(lambda: image_generate.generate_rank_tables(rank_data))
+    pooled, result = best_of(lambda: image_generate.generate_rank_tables(rank_data, draw_tiles=pool.draw_tiles))
+    pool.shutdown()
+    for a, b in zip(expected, result):
+        if ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is not None:
+            raise AssertionError("pooled rank table differs from serial result")
+    print(f"{len(rank_data)} tables, {count_limit} users each: serial {serial * 1e3:.1f} ms, "
+          f"{processes} processes {pooled * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+用户信息读取耗时和内存占用: UserInfo(**row) (pydantic 校验) 与 UserInfo.from_db_row (直接构建) 对比
+用法: python benchmarks/user_load.py [次数]
+"""
+import gc
+import os
+import sqlite3
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from yinpa import models as m  # noqa: E402
+from yinpa.database import USER_COLUMNS, YinpaDB  # noqa: E402
+
+
+def make_rows():
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    YinpaDB._create_tables(conn)
+
+    user = m.UserInfo.get_init(1, "benchmark")
+    user.items = {m.ItemTypes.HP_RECOVERY: 3, m.ItemTypes.SENSADD: 1}
+    user.own_dress = [m.DressTypes.get_dress_from_id(0)]
+    user.worn_dress = list(user.own_dress)
+    conn.execute(f"INSERT INTO users ({', '.join(USER_COLUMNS)}) VALUES ({', '.join('?' for _ in USER_COLUMNS)})",
+                 [YinpaDB._user_column_value(user, i) for i in USER_COLUMNS])
+    conn.execute("INSERT INTO body_info (id, race) VALUES (?, ?)", [user.id, user.body_info.race.value.race_id])
+    conn.executemany("INSERT INTO body_parts_info VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     YinpaDB._body_parts_rows(user.id, user.body_info.body_parts_info))
+
+    query_user = conn.execute("SELECT * FROM users").fetchone()
+    query_body_info = conn.execute("SELECT * FROM body_info").fetchone()
+    query_body_parts_info = conn.execute("SELECT * FROM body_parts_info").fetchall()
+    return query_user, query_body_info, query_body_parts_info
+
+
+def load_validated(query_user, query_body_info, query_body_parts_info):
+    ret_dict = dict(query_user)
+    ret_dict["body_info"] = dict(query_body_info)
+    ret_dict["body_info"]["body_parts_info"] = {}
+    for i in query_body_parts_info:
+        curr_data = dict(i)
+        ret_dict["body_info"]["body_parts_info"][curr_data["body_id"]] = curr_data
+    ret = m.UserInfo(**ret_dict)
+    ret.clear_dirty()
+    return ret
+
+
+def load_trusted(query_user, query_body_info, query_body_parts_info):
+    ret = m.UserInfo.from_db_row(query_user, m.UserBodyInfo.from_db_rows(query_body_info["race"],
+                                                                         query_body_parts_info))
+    ret.clear_dirty()
+    return ret
+
+
+def measure_memory(func, rows, count=2000):
+    """
+    保留 count 个用户时每个用户占用的内存和 GC 跟踪的对象数
+    """
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    tracemalloc.start()
+    users = [func(*rows) for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    objects = len(gc.get_objects()) - objects_before
+    del users
+    return size / count, objects / count
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rows = make_rows()
+    if load_validated(*rows).dict() != load_trusted(*rows).dict():
+        raise AssertionError("from_db_row result differs from UserInfo(**row)")
+
+    for name, func in (("UserInfo(**row)", load_validated), ("UserInfo.from_db_row", load_trusted)):
+        best = min(timeit.repeat(lambda: func(*rows), number=number, repeat=5))
+        size, objects = measure_memory(func, rows)
+        print(f"{name:<24}{best / number * 1e6:10.1f} us/user{size:10.0f} bytes/user{objects:8.1f} gc objects/user")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import pytest
+
+from yinpa import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "spath", str(tmp_path))
+    ret = database.YinpaDB()
+    yield ret
+    ret.close()
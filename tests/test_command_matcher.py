@@ -0,0 +1,83 @@
+import random
+import re
+
+from yinpa import command_matcher
+from yinpa import models as m
+
+# 昵称中包含动作名、部位名、"的" 以及互为前缀的情况
+USER_NAMES = {1: "chieri", 2: "chi", 3: "尾巴", 4: "摸摸", 5: "小穴的主人", 6: "的", 7: "chieri的", 8: "透 明"}
+
+
+def _alternation(names):
+    # 与字典树一致, 较长的名称优先
+    return "|".join(re.escape(i) for i in sorted(names, key=len, reverse=True))
+
+
+def reference_match(message: str):
+    """
+    按正则表达式匹配指令, 作为 CommandMatcher.match 的参照
+    """
+    actions = dict(m.action_names.items())
+    parts = dict(m.body_parts_names.items())
+    user_ids = {v: k for k, v in USER_NAMES.items()}
+    pattern = (f"^/({_alternation(command_matcher.STRENGTH_WORDS)})?({_alternation(actions)})"
+               f"(?:({_alternation(parts)})|({_alternation(user_ids)})"
+               f"(?:{re.escape(command_matcher.TARGET_PART_SEPARATOR)}({_alternation(parts)}))?)?$")
+    match = re.match(pattern, message.rstrip())
+    if match is None:
+        return None
+    strength_name, action_name, part_name, user_name, user_part_name = match.groups()
+    action = actions[action_name]
+    part_name = part_name or user_part_name
+    return m.YinpaCommand(
+        action=action,
+        body_part=parts[part_name] if part_name else m.BodyParts.get_pars_from_name(action.value.default_part),
+        strength=command_matcher.STRENGTH_WORDS[strength_name] if strength_name else m.StrengthType.NORMAL,
+        target_user_id=user_ids.get(user_name), target_name=user_name)
+
+
+def make_messages(count: int):
+    rnd = random.Random(0)
+    tokens = [[k for k, _ in m.action_names.items()], [k for k, _ in m.body_parts_names.items()],
+              list(USER_NAMES.values()), list(command_matcher.STRENGTH_WORDS),
+              [command_matcher.TARGET_PART_SEPARATOR, " ", "x", "/", "巴"]]
+    ret = []
+    for _ in range(count):
+        message = rnd.choice(["/", "/", "/", "", "!"])
+        for _ in range(rnd.randint(0, 4)):
+            message += rnd.choice(rnd.choice(tokens))
+        ret.append(message)
+    # 随机组合很难凑出完整的指令, 再按指令格式生成一批
+    for _ in range(count):
+        message = "/" + rnd.choice(["", *command_matcher.STRENGTH_WORDS]) + rnd.choice(tokens[0])
+        target = rnd.choice(["", "part", "user", "user_part"])
+        if target == "part":
+            message += rnd.choice(tokens[1])
+        elif target.startswith("user"):
+            message += rnd.choice(tokens[2])
+            if target == "user_part":
+                message += command_matcher.TARGET_PART_SEPARATOR + rnd.choice(tokens[1])
+        ret.append(message + rnd.choice(["", "", " ", "x"]))
+    return ret
+
+
+def test_trie_matches_regex():
+    matcher = command_matcher.CommandMatcher()
+    for user_id, name in USER_NAMES.items():
+        matcher.add_user(user_id, name)
+    matched = 0
+    for message in make_messages(3000):
+        expected = reference_match(message)
+        assert matcher.match(message) == expected, message
+        matched += expected is not None
+    assert matched > 1000
+
+
+def test_renamed_and_removed_users():
+    matcher = command_matcher.CommandMatcher()
+    matcher.add_user(1, "chieri")
+    matcher.add_user(1, "chi")
+    assert matcher.match("/透chieri") is None
+    assert matcher.match("/透chi的尾巴").target_user_id == 1
+    matcher.remove_user(1)
+    assert matcher.match("/透chi") is None
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+
+from yinpa import database
+from yinpa import models as m
+
+
+def test_save_after_delete_leaves_no_rows(db):
+    db.create_user(1, "u1", m.BaseSex.SINGLE, m.RaceTypes.get_race_type_from_name("猫娘"))
+    user = db.get_user_info(1)
+    db.delete_user(1)
+    part = next(iter(user.body_info.body_parts_info))
+    user.body_info.body_parts_info[part].sensitive += 1  # 只修改部位
+    db.update_user_info(user)
+    with db._cursor() as cursor:
+        assert cursor.execute("SELECT COUNT(*) FROM body_parts_info WHERE id=1").fetchone()[0] == 0
+        assert cursor.execute("SELECT COUNT(*) FROM body_info WHERE id=1").fetchone()[0] == 0
+
+
+def test_migrate_baseline_db_dedupes_body_parts(tmp_path, monkeypatch):
+    # 旧版本的数据库: 没有迁移 (user_version 为 0), body_parts_info 没有唯一键, 同一部位可能有多行
+    os.makedirs(tmp_path / "data")
+    conn = sqlite3.connect(tmp_path / "data" / "yinpa_userinfo.db")
+    database.YinpaDB._create_tables(conn)
+    user = m.UserInfo.get_init(1, "u1")
+    conn.execute(f"INSERT INTO users ({', '.join(database.USER_COLUMNS)}) "
+                 f"VALUES ({', '.join('?' for _ in database.USER_COLUMNS)})",
+                 [database.YinpaDB._user_column_value(user, i) for i in database.USER_COLUMNS])
+    conn.execute("INSERT INTO body_info (id, race) VALUES (1, ?)", [user.body_info.race.value.race_id])
+    parts_rows = database.YinpaDB._body_parts_rows(1, user.body_info.body_parts_info)
+    conn.executemany("INSERT INTO body_parts_info VALUES (?, ?, ?, ?, ?, ?, ?)", parts_rows)
+    duplicated = list(parts_rows[0])
+    duplicated[3] = 99  # 后写入的一行为准
+    conn.execute("INSERT INTO body_parts_info VALUES (?, ?, ?, ?, ?, ?, ?)", duplicated)
+    conn.execute("INSERT INTO yinpa_log VALUES (1, 0, 1, 0, 7, 1.0, 0)")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(database, "spath", str(tmp_path))
+    db = database.YinpaDB()
+    try:
+        with db._cursor() as cursor:
+            assert cursor.execute("PRAGMA user_version").fetchone()[0] == 4
+            assert cursor.execute("SELECT COUNT(*) FROM body_parts_info").fetchone()[0] == len(parts_rows)
+            assert cursor.execute("SELECT sensitive FROM body_parts_info WHERE id=1 AND body_id=?",
+                                  [duplicated[1]]).fetchone()[0] == 99
+        part = m.BodyParts.get_parts_from_value(duplicated[1])
+        assert db.get_user_info(1).body_info.body_parts_info[part].sensitive == 99
+        assert db.get_group_members(7) == [1]
+    finally:
+        db.close()
@@ -0,0 +1,36 @@
+import pytest
+from PIL import ImageChops, ImageFont
+
+from yinpa import image_generate
+from yinpa import models as m
+from yinpa.render_cache import RenderCache
+
+
+@pytest.fixture(autouse=True)
+def font(monkeypatch):
+    # 测试环境不一定有 msyh.ttc, 使用 Pillow 自带的字体
+    try:
+        ImageFont.load_default(13)
+    except TypeError:
+        pytest.skip("Pillow 版本过低, 没有可缩放的默认字体")
+    monkeypatch.setattr(image_generate, "get_font", lambda size, path=None: ImageFont.load_default(size))
+
+
+def make_rank_data(name_length: int):
+    users = []
+    for i in range(6):
+        user = m.UserInfo.get_init(i, ("x" * name_length) if i == 3 else f"user{i}")
+        user.persistance = 600 - i
+        users.append(user)
+    return [dict(head_part=users[:4], key=lambda u: u.persistance, total_count=len(users), end_part=users[4:],
+                 title="持久排行", item_name="持久 (s)", target_userinfo=users[target], target_user_rank=target + 1,
+                 table_w=400) for target in range(len(users))]
+
+
+@pytest.mark.parametrize("name_length", [5, 80])
+def test_highlight_overlay_matches_full_redraw(name_length):
+    rank_data = make_rank_data(name_length)
+    expected = image_generate.generate_rank_tables(rank_data)  # 不使用缓存时用 draw_colors 绘制整个表格
+    result = image_generate.generate_rank_tables(rank_data, RenderCache(64 * 1024 * 1024))
+    for a, b in zip(expected, result):
+        assert ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is None
@@ -0,0 +1,31 @@
+import itertools
+
+from yinpa import models as m
+from yinpa import yinpa_error as err
+
+
+def use_items(user: m.UserInfo, item: m.ItemTypes, count: int):
+    # 合并计算之前的方式: 逐个使用
+    for _ in range(count):
+        user.use_item(item, 1)
+
+
+def item_result(func, user: m.UserInfo, item: m.ItemTypes, count: int):
+    user = user.copy(deep=True)
+    try:
+        func(user, item, count)
+    except err.YinpaUserError:
+        return None
+    return user.dict(exclude={"last_update_hp"})
+
+
+def test_use_many_items_matches_single_uses():
+    for sex, length, chest_size, item, count in itertools.product(
+            m.BaseSex, [-13.2345, -5, -0.5, 0, 0.5, 3, 12.0001], [0, 4.5, 7, 30.1234], m.ItemTypes, [1, 2, 3, 7]):
+        user = m.UserInfo.get_init(1, "u1")
+        user.sex = sex
+        user.length = length
+        user.chest_size = chest_size
+        user.hp = 10
+        expected = item_result(use_items, user, item, count)
+        assert item_result(m.UserInfo.use_item, user, item, count) == expected, (sex, length, chest_size, item, count)
@@ -0,0 +1,119 @@
+import random
+
+import pytest
+
+from yinpa import models as m
+from yinpa import rank
+
+GROUP_ID = 7
+
+
+def fill_db(db, count: int):
+    rnd = random.Random(0)
+    columns = rank.get_rank_columns()
+    for user_id in range(1, count + 1):
+        user = m.UserInfo.get_init(user_id, f"u{user_id}")
+        user.sex = rnd.choice(list(m.BaseSex))
+        user.length = rnd.choice([-3, -1, 0, 2, 5])  # 包含各排行分组的边界
+        for i in columns[3:]:
+            setattr(user, i, rnd.choice([0, 1.5, 3, 100]))  # 取值很少, 有大量并列
+        db.update_user_info(user)
+    # 旧版本在 SQL 中累加的数值没有舍入
+    db._write(lambda conn: conn.execute("UPDATE users SET persistance = persistance + 0.000012345, "
+                                        "length = length + 0.000012345 WHERE id % 3 = 0"))
+    db.add_group_members(GROUP_ID, [i for i in range(1, count + 1) if rnd.random() < 0.4])
+
+
+def brute_force_ranks(rows, target_id, count_limit):
+    columns = rank.get_rank_columns()
+    rows = [dict(zip(columns, i)) for i in rows]
+    target = next((i for i in rows if i["id"] == target_id), None)
+    ret = []
+    for board in rank.RANK_BOARDS:
+        group_check = rank.RANK_GROUPS[board.group].check
+        members = [i for i in rows if (group_check is None) or group_check(i["sex"], i["length"])]
+        sign = -1 if board.descending else 1
+        members.sort(key=lambda i: (sign * i[board.column], i["id"]))
+        show_count = int(count_limit / 2) if board.half else count_limit
+        head_ids = [i["id"] for i in members[:show_count]]
+        end_ids = None
+        if board.half:
+            members.sort(key=lambda i: (-sign * i[board.column], i["id"]))
+            end_ids = [i["id"] for i in members[:show_count]][::-1]
+        target_rank = 0
+        if (target is not None) and ((group_check is None) or group_check(target["sex"], target["length"])):
+            target_rank = sum(1 for i in members if sign * i[board.column] < sign * target[board.column]) + 1
+        ret.append(rank.RankResult(board, head_ids, end_ids, len(members), target_rank))
+    return ret
+
+
+def check_engines(rows, targets, count_limit):
+    for target_id in targets:
+        target = m.UserInfo.get_init(target_id, "target") if target_id is not None else None
+        expected = brute_force_ranks(rows, target_id, count_limit)
+        assert rank.calc_ranks(rows, target, count_limit, use_numpy=False) == expected, target_id
+        if rank.np is not None:
+            assert rank.calc_ranks(rows, target, count_limit, use_numpy=True) == expected, target_id
+
+
+@pytest.mark.parametrize("count_limit", [0, 1, 7, 40])
+def test_rank_engines_match_brute_force(db, count_limit):
+    fill_db(db, 120)
+    rows = db.get_user_columns(rank.get_rank_columns())
+    check_engines(rows, [None, *range(1, 121, 7)], count_limit)
+
+
+@pytest.mark.parametrize("count_limit", [0, 1, 7, 40])
+def test_rank_store_follows_writes(db, monkeypatch, count_limit):
+    monkeypatch.setattr(rank._SortedEntries, "_LOAD", 4)  # 小块, 覆盖块的拆分和跨块查询
+    fill_db(db, 120)
+    store = rank.RankStore()
+    store.rebuild(db.get_user_columns)
+    db.add_change_listener(store.on_change)
+
+    def check(targets):
+        rows = db.get_user_columns(rank.get_rank_columns())
+        for target_id in targets:
+            target = db.get_user_info(target_id) if target_id is not None else None
+            assert store.calc_ranks(target, count_limit) == brute_force_ranks(rows, target_id, count_limit), target_id
+
+    targets = [None, *range(1, 121, 7)]
+    check(targets)
+    rnd = random.Random(1)
+    for user_id in rnd.sample(range(1, 121), 40):
+        user = db.get_user_info(user_id)
+        user.length = rnd.choice([-3, 0, 2])
+        user.persistance = rnd.choice([0, 1.5, 3, 100])
+        user.prostitution = rnd.choice([0, 1.5])
+        db.update_user_info(user)
+    for user_id in rnd.sample(range(1, 121), 10):
+        db.delete_user(user_id)
+    user = m.UserInfo.get_init(121, "u121")
+    user.persistance = 3
+    db.update_user_info(user)
+    check([i for i in [*targets, 121] if (i is None) or (db.get_user_info(i) is not None)])
+
+
+@pytest.mark.parametrize("count_limit", [0, 7, 40])
+def test_group_ranks_match_filtered_boards(db, count_limit):
+    fill_db(db, 120)
+    members = set(db.get_group_members(GROUP_ID))
+    group_rows = [i for i in db.get_user_columns(rank.get_rank_columns()) if i[0] in members]
+    for target_id in [None, *sorted(members)]:
+        target = db.get_user_info(target_id) if target_id is not None else None
+        assert rank.calc_group_ranks(db, GROUP_ID, target, count_limit) == \
+            rank.calc_ranks(group_rows, target, count_limit), target_id
+
+
+def test_user_ranks_match_board_ranks(db):
+    fill_db(db, 120)
+    rows = db.get_user_columns(rank.get_rank_columns())
+    members = set(db.get_group_members(GROUP_ID))
+    group_rows = [i for i in rows if i[0] in members]
+    for target_id in range(1, 121):
+        target = db.get_user_info(target_id)
+        assert rank.calc_user_ranks(db, target) == \
+            {i.board.title: i.target_rank for i in rank.calc_ranks(rows, target, 0)}, target_id
+        if target_id in members:
+            assert rank.calc_user_ranks(db, target, GROUP_ID) == \
+                {i.board.title: i.target_rank for i in rank.calc_ranks(group_rows, target, 0)}, target_id
@@ -0,0 +1,49 @@
+from yinpa import database
+from yinpa import models as m
+from yinpa import yinpa_main
+
+
+def test_put_after_commit_is_dropped():
+    cache = database.UserInfoCache(16)
+    stale = m.UserInfo.get_init(1, "u1")
+    version = cache.get_version()  # 未命中, 开始读取数据库
+    cache.apply(1, lambda data: None)  # 读取期间提交了写入, 用户不在缓存中
+    cache.put(stale, version)
+    assert cache.get(1) is None
+
+
+def test_cache_miss_read_interleaved_with_commit(db):
+    db.create_user(1, "u1", m.BaseSex.SINGLE, m.RaceTypes.get_race_type_from_name("猫娘"))
+    writer_copy = db.get_user_info(1)
+    db.cache.clear()
+
+    put = db.cache.put
+    committed = []
+
+    def put_after_commit(data, version=None):
+        # 读取数据库之后、写入缓存之前, 另一个写入提交
+        if (version is not None) and not committed:
+            committed.append(True)
+            writer_copy.persistance = 12345
+            db.update_user_info(writer_copy)
+        put(data, version)
+
+    db.cache.put = put_after_commit
+    assert db.get_user_info(1).persistance != 12345  # 提交前读取的数据
+    assert committed
+    assert db.get_user_info(1).persistance == 12345
+
+
+def test_new_user_cached_with_race_parts(db, monkeypatch):
+    monkeypatch.setattr(yinpa_main, "db", db)
+    yinpa_main.add_user(1, "a", 1, "人类")
+    yinpa_main.add_user(2, "cat", 1, "猫娘")
+    cached = db.get_user_info(2)
+    db.cache.clear()
+    assert cached.body_info.body_parts_info.to_dict() == db.get_user_info(2).body_info.body_parts_info.to_dict()
+
+    db.cache.clear()
+    db.get_user_info(1)
+    yinpa_main.add_user(3, "cat2", 1, "猫娘")  # 只存在于缓存中的新用户
+    yinpa_main.yinpa(1, 3, "摸", "尾巴")
+
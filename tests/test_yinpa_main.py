@@ -0,0 +1,47 @@
+import itertools
+
+import pytest
+
+from yinpa import models as m
+from yinpa import yinpa_error as err
+from yinpa import yinpa_main
+
+
+def make_users():
+    for race, sex, length, length2 in itertools.product(m.RaceTypes, m.BaseSex, [-5, 0, 5], [-5, 0, 5]):
+        user = m.UserInfo.get_init(1, "u1")
+        user.sex = sex
+        user.length = length
+        user.length2 = length2
+        user.body_info.race = race
+        user.body_info.check_body_parts_info()
+        yield user
+
+
+def test_validate_matches_user_checks():
+    users = list(make_users())
+    for action, part in itertools.product(m.DoActionTypes, m.BodyParts):
+        action_name = action.value.names[0]
+        part_name = part.value.names[0]
+        for user in users:
+            # yinpa() 读取用户后原来的检查方式
+            expected = part.value.check_support_action(action) and user.check_have_body_part(part)
+            try:
+                result = yinpa_main.validate_yinpa_request(action_name, part_name, m.StrengthType.NORMAL, user.sex,
+                                                           user.get_length_signs(), user.body_info.race)
+            except err.YinpaUserError:
+                assert not expected, (action, part, user.sex, user.length, user.length2, user.body_info.race)
+            else:
+                assert expected, (action, part, user.sex, user.length, user.length2, user.body_info.race)
+                assert result == (action, part)
+
+
+def test_validate_without_target():
+    for action, part in itertools.product(m.DoActionTypes, m.BodyParts):
+        if part.value.check_support_action(action):
+            yinpa_main.validate_yinpa_request(action.value.names[0], part.value.names[0])
+        else:
+            with pytest.raises(err.YinpaUserError):
+                yinpa_main.validate_yinpa_request(action.value.names[0], part.value.names[0])
+    with pytest.raises(err.YinpaValueError):
+        yinpa_main.validate_yinpa_request("摸", "头", 1)
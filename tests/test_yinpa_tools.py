@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from yinpa import yinpa_tools
+from yinpa.config import YinpaConfig as cfg
+
+
+def loop_calc_sensitive(sensitive):
+    # 改用前缀和之前 sensitive_to_volume 中的循环
+    total_sensitive = int(sensitive)
+    calc_sensitive = 0
+    for_count = 1
+    while True:
+        for_count += 1
+        if for_count <= 2:
+            continue
+        if total_sensitive >= cfg.sensitive_calc_demarcation:
+            total_sensitive -= cfg.sensitive_calc_demarcation
+            calc_sensitive += int(cfg.sensitive_calc_demarcation / for_count)
+        else:
+            calc_sensitive += int(total_sensitive / for_count)
+            break
+    return calc_sensitive
+
+
+def loop_volume(sensitive, use_time):
+    if (sensitive <= 150) or (use_time <= cfg.min_persistance):
+        return 0.0
+    base_value = (loop_calc_sensitive(sensitive) + use_time / 16) / 16
+    return random.randint(int(base_value / 2 * 100), int(base_value * 2.5 * 100)) / 100
+
+
+SENSITIVES = [*range(-50, 2000), 2000.5, 4999.9, 10 ** 5, 10 ** 5 + 1]
+
+
+@pytest.mark.parametrize("demarcation", [200, 1, 3, 7, 2.5])
+def test_calc_sensitive_matches_loop(monkeypatch, demarcation):
+    monkeypatch.setattr(cfg, "sensitive_calc_demarcation", demarcation)
+    for sensitive in SENSITIVES:
+        assert yinpa_tools.sensitive_to_calc_sensitive(sensitive) == loop_calc_sensitive(sensitive), sensitive
+
+
+@pytest.mark.parametrize("demarcation", [200, 7])
+def test_volume_matches_loop(monkeypatch, demarcation):
+    monkeypatch.setattr(cfg, "sensitive_calc_demarcation", demarcation)
+    for use_time in [0, cfg.min_persistance + 1, 300.5]:
+        random.seed(0)
+        expected = [loop_volume(i, use_time) for i in SENSITIVES]
+        random.seed(0)
+        assert [yinpa_tools.sensitive_to_volume(i, use_time) for i in SENSITIVES] == expected
@@ -1,2 +1,3 @@
 from .yinpa_main import *
 from . import image_generate
+from . import aio
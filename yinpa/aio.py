@@ -0,0 +1,200 @@
+"""
+yinpa 的 asyncio 接口。数据库操作和图片生成分别在两个有限大小的线程池中执行，不会阻塞事件循环。
+用法与 yinpa_main 中的同名函数相同，例: await yinpa.aio.yinpa(...)
+"""
+import asyncio
+import functools
+import inspect
+import threading
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+from . import yinpa_main
+from . import image_generate
+from . import models as m
+from .config import YinpaConfig as cfg
+
+_executors_lock = threading.Lock()
+_db_executor: t.Optional[ThreadPoolExecutor] = None
+_render_executor: t.Optional[ThreadPoolExecutor] = None
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    with _executors_lock:
+        if _db_executor is None:
+            _db_executor = ThreadPoolExecutor(max_workers=cfg.aio_db_workers, thread_name_prefix="yinpa-aio-db")
+        return _db_executor
+
+
+def get_render_executor() -> ThreadPoolExecutor:
+    global _render_executor
+    with _executors_lock:
+        if _render_executor is None:
+            _render_executor = ThreadPoolExecutor(max_workers=cfg.aio_render_workers,
+                                                  thread_name_prefix="yinpa-aio-render")
+        return _render_executor
+
+
+def shutdown(wait=True):
+    global _db_executor, _render_executor
+    with _executors_lock:
+        for i in (_db_executor, _render_executor):
+            if i is not None:
+                i.shutdown(wait=wait)
+        _db_executor = None
+        _render_executor = None
+
+
+async def _run_db(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(get_db_executor(),
+                                                            functools.partial(func, *args, **kwargs))
+
+
+async def _run_render(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(get_render_executor(),
+                                                            functools.partial(func, *args, **kwargs))
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+def _to_sync_callback(callback: t.Optional[t.Callable[[int, int], t.Any]]):
+    """
+    将货币消耗回调转为可在线程池中调用的同步函数。回调返回 awaitable 时，交回事件循环执行并等待结果
+    """
+    if callback is None:
+        return None
+    loop = asyncio.get_running_loop()
+
+    def wrapper(userid: int, price: int) -> bool:
+        ret = callback(userid, price)
+        if inspect.isawaitable(ret):
+            ret = asyncio.run_coroutine_threadsafe(_await(ret), loop).result()
+        return ret
+    return wrapper
+
+
+async def get_command_matcher():
+    """
+    第一次调用时需要读取数据库。得到的解析器只使用内存, match() 可直接在事件循环中调用
+    """
+    return await _run_db(yinpa_main.get_command_matcher)
+
+
+async def add_user(user_id: int, user_name: str, sex: int, race: str):
+    return await _run_db(yinpa_main.add_user, user_id, user_name, sex, race)
+
+
+async def delete_user(user_id: int):
+    return await _run_db(yinpa_main.delete_user, user_id)
+
+
+async def get_user_info(user_id: int, raise_notfound_error=True):
+    return await _run_db(yinpa_main.get_user_info, user_id, raise_notfound_error=raise_notfound_error)
+
+
+async def get_user_info_by_name(username: str, raise_notfound_error=True):
+    return await _run_db(yinpa_main.get_user_info_by_name, username, raise_notfound_error=raise_notfound_error)
+
+
+async def update_user_info(data: m.UserInfo):
+    return await _run_db(yinpa_main.update_user_info, data)
+
+
+async def yinpa(self_user_id: int, target_user_id: int, action_name: str, target_part_name: str,
+                strength=m.StrengthType.NORMAL, group_id=-1):
+    return await _run_db(yinpa_main.yinpa, self_user_id, target_user_id, action_name, target_part_name,
+                         strength, group_id)
+
+
+async def dajiao(userid: int, body_part: m.BodyParts):
+    return await _run_db(yinpa_main.dajiao, userid, body_part)
+
+
+async def snatch(self_user_id: int, target_user_id: int, is_newnew=False, is_opai=False):
+    return await _run_db(yinpa_main.snatch, self_user_id, target_user_id, is_newnew=is_newnew, is_opai=is_opai)
+
+
+async def newnew_roll(userid: int, is_omago=False):
+    return await _run_db(yinpa_main.newnew_roll, userid, is_omago=is_omago)
+
+
+async def opai_roll(userid: int):
+    return await _run_db(yinpa_main.opai_roll, userid)
+
+
+async def buy_dress(userid: int, dress_name: str,
+                    coin_use_callback: t.Optional[t.Callable[[int, int], t.Union[bool, t.Awaitable[bool]]]] = None,
+                    coin_name: str = "CS点数"):
+    """
+    coin_use_callback 可以是普通函数或 async 函数
+    """
+    return await _run_db(yinpa_main.buy_dress, userid, dress_name, _to_sync_callback(coin_use_callback), coin_name)
+
+
+async def check_worn_dress(userid: int, dress_name: str):
+    return await _run_db(yinpa_main.check_worn_dress, userid, dress_name)
+
+
+async def wear_dress(userid: int, dress_name: str):
+    return await _run_db(yinpa_main.wear_dress, userid, dress_name)
+
+
+async def take_off_dress(userid: int, dress_name: str):
+    return await _run_db(yinpa_main.take_off_dress, userid, dress_name)
+
+
+async def buy_item(userid: int, item_name: str, count=1,
+                   coin_use_callback: t.Optional[t.Callable[[int, int], t.Union[bool, t.Awaitable[bool]]]] = None,
+                   coin_name: str = "CS点数"):
+    """
+    coin_use_callback 可以是普通函数或 async 函数
+    """
+    return await _run_db(yinpa_main.buy_item, userid, item_name, count, _to_sync_callback(coin_use_callback),
+                         coin_name)
+
+
+async def use_item(self_userid: int, target_userid: t.Optional[int], item_name: str, count=1):
+    return await _run_db(yinpa_main.use_item, self_userid, target_userid, item_name, count)
+
+
+async def get_rank_img(userid: int, count_limit=40, limit_users: t.Optional[t.List[int]] = None,
+                       group_id: t.Optional[int] = None):
+    """
+    数据没有变化时直接返回缓存的图片, 见 yinpa_main.get_rank_img
+    """
+    key = yinpa_main.rank_img_cache_key(userid, count_limit, limit_users, group_id)
+    version = yinpa_main.db.data_version
+    ret = yinpa_main.rank_img_cache.get(key, version)
+    if ret is None:
+        rank_data = await _run_db(yinpa_main.get_rank_data, userid, count_limit, limit_users, group_id)
+        ret = await _run_render(yinpa_main.render_rank_img, rank_data)
+        yinpa_main.rank_img_cache.put(key, ret, version)
+    return ret
+
+
+async def get_user_ranks(userid: int, group_id: t.Optional[int] = None):
+    return await _run_db(yinpa_main.get_user_ranks, userid, group_id)
+
+
+async def rebuild_rank_store():
+    return await _run_db(yinpa_main.rebuild_rank_store)
+
+
+async def add_group_members(group_id: int, user_ids: t.Iterable[int]):
+    return await _run_db(yinpa_main.add_group_members, group_id, list(user_ids))
+
+
+async def remove_group_members(group_id: int, user_ids: t.Optional[t.Iterable[int]] = None):
+    return await _run_db(yinpa_main.remove_group_members, group_id,
+                         None if user_ids is None else list(user_ids))
+
+
+async def generate_userinfo(user_info: m.UserInfo, avatar: t.Optional[bytes] = None):
+    return await _run_render(image_generate.generate_userinfo, user_info, avatar)
+
+
+async def generate_help_img(desc_text: str):
+    return await _run_render(image_generate.generate_help_img, desc_text)
@@ -0,0 +1,157 @@
+import threading
+import typing as t
+
+from . import models as m
+
+_END = ""  # 字典树中的结束标记, 名称均非空, 不会与字符冲突
+
+STRENGTH_WORDS = {"轻轻地": m.StrengthType.SOFT, "狠狠地": m.StrengthType.SEVERELY}
+TARGET_PART_SEPARATOR = "的"
+
+
+def _trie_insert(trie: dict, key: str, value):
+    node = trie
+    for ch in key:
+        node = node.setdefault(ch, {})
+    node[_END] = value
+
+
+def _trie_remove(trie: dict, key: str):
+    node = trie
+    for ch in key:
+        node = node.get(ch)
+        if node is None:
+            return
+    node.pop(_END, None)
+
+
+def _trie_prefixes(trie: dict, text: str, pos: int) -> t.List[t.Tuple[int, t.Any]]:
+    """
+    text[pos:] 的所有前缀中, 在字典树中的 (结束位置, 值), 按长度从长到短排列
+    """
+    ret = []
+    node = trie
+    for i in range(pos, len(text)):
+        node = node.get(text[i])
+        if node is None:
+            break
+        if _END in node:
+            ret.append((i + 1, node[_END]))
+    ret.reverse()
+    return ret
+
+
+def _trie_get(trie: dict, text: str, pos: int):
+    """
+    text[pos:] 整体在字典树中时返回对应的值, 否则返回 None
+    """
+    node = trie
+    for i in range(pos, len(text)):
+        node = node.get(text[i])
+        if node is None:
+            return None
+    return node.get(_END)
+
+
+class CommandMatcher:
+    """
+    解析 yinpa 指令:
+    /[轻轻地|狠狠地](动作)[部位]          例: /透、/摸欧派  (对象由 @ 指定, target_user_id 为 None)
+    /[轻轻地|狠狠地](动作)(对方昵称)[的部位] 例: /透chieri、/狠狠地摸chieri的欧派
+    动作、部位 和 用户昵称 分别存放在字典树中, 从指令开头逐字匹配, 不是指令的消息只检查第一个字符
+    动作和部位的名称来自 models 中的名称索引, 运行时添加的别名会在下次匹配时生效
+    """
+
+    def __init__(self, prefix="/"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._users_trie: dict = {}
+        self._user_names: t.Dict[int, str] = {}
+        self._strength_trie: dict = {}
+        for k, v in STRENGTH_WORDS.items():
+            _trie_insert(self._strength_trie, k, v)
+        self._actions_trie: dict = {}
+        self._parts_trie: dict = {}
+        self._names_version: t.Optional[t.Tuple[int, int]] = None
+        self._build_name_tries()
+
+    def _build_name_tries(self):
+        with self._lock:
+            version = (m.action_names.version, m.body_parts_names.version)
+            if version == self._names_version:
+                return
+            actions_trie = {}
+            for k, v in m.action_names.items():
+                _trie_insert(actions_trie, k, v)
+            parts_trie = {}
+            for k, v in m.body_parts_names.items():
+                _trie_insert(parts_trie, k, v)
+            self._actions_trie = actions_trie
+            self._parts_trie = parts_trie
+            self._names_version = version
+
+    def add_user(self, user_id: int, user_name: str):
+        """
+        添加或更新用户昵称
+        """
+        with self._lock:
+            old_name = self._user_names.get(user_id)
+            if old_name == user_name:
+                return
+            if old_name is not None:
+                _trie_remove(self._users_trie, old_name)
+            self._user_names[user_id] = user_name
+            if user_name:
+                _trie_insert(self._users_trie, user_name, user_id)
+
+    def remove_user(self, user_id: int):
+        with self._lock:
+            old_name = self._user_names.pop(user_id, None)
+            if old_name is not None:
+                _trie_remove(self._users_trie, old_name)
+
+    def match(self, message: str) -> t.Optional[m.YinpaCommand]:
+        """
+        解析消息, 不是 yinpa 指令时返回 None
+        :param message: 原始消息文本 (不含 @)
+        """
+        if not message.startswith(self.prefix):
+            return None
+        if (m.action_names.version, m.body_parts_names.version) != self._names_version:
+            self._build_name_tries()
+
+        message = message.rstrip()
+        pos = len(self.prefix)
+        strength = m.StrengthType.NORMAL
+        strength_match = _trie_prefixes(self._strength_trie, message, pos)
+        if strength_match:
+            pos, strength = strength_match[0]
+
+        # 动作名之间可能互为前缀 (摸 / 摸摸), 从最长的开始尝试
+        for action_end, action in _trie_prefixes(self._actions_trie, message, pos):
+            ret = self._match_target(message, action_end, action, strength)
+            if ret is not None:
+                return ret
+        return None
+
+    def _match_target(self, message: str, pos: int, action: m.DoActionTypes, strength: m.StrengthType):
+        if pos == len(message):
+            return m.YinpaCommand(action=action, body_part=m.BodyParts.get_pars_from_name(action.value.default_part),
+                                  strength=strength)
+
+        body_part = _trie_get(self._parts_trie, message, pos)
+        if body_part is not None:
+            return m.YinpaCommand(action=action, body_part=body_part, strength=strength)
+
+        for name_end, user_id in _trie_prefixes(self._users_trie, message, pos):
+            if name_end == len(message):
+                body_part = m.BodyParts.get_pars_from_name(action.value.default_part)
+            elif message.startswith(TARGET_PART_SEPARATOR, name_end):
+                body_part = _trie_get(self._parts_trie, message, name_end + len(TARGET_PART_SEPARATOR))
+                if body_part is None:
+                    continue
+            else:
+                continue
+            return m.YinpaCommand(action=action, body_part=body_part, strength=strength, target_user_id=user_id,
+                                  target_name=message[pos:name_end])
+        return None
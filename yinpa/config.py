@@ -26,3 +26,18 @@ class YinpaConfig:
     roll_newnew_base = 2.0  # 随机基本长度
     roll_opai_base = 1.5  # 随机基本长度
     roll_magnification = 3  # 随机倍率范围
+
+    db_busy_timeout = 30.0  # 数据库繁忙时的等待秒数
+    db_write_batch_size = 64  # 写线程单次提交最多合并的写任务数
+    db_session_lock_stripes = 64  # 会话用户锁的分段数
+
+    aio_db_workers = 4  # 异步接口: 数据库操作线程数
+    aio_render_workers = 2  # 异步接口: 图片生成线程数
+
+    user_cache_size = 1024  # 用户信息缓存数量, 为 0 时不缓存
+    rank_store = True  # 全体排行数据常驻内存并随写入更新, 为 False 时每次从数据库计算
+    rank_img_cache_bytes = 64 * 1024 * 1024  # 排行榜图片缓存的最大字节数 (按像素数据计算), 为 0 时不缓存
+    rank_img_cache_ttl = 0  # 排行榜图片缓存的过期秒数, 为 0 时只在数据变化时失效
+    rank_tile_cache_bytes = 64 * 1024 * 1024  # 排行表 (单张表格) 缓存的最大字节数, 为 0 时不缓存。一张排行榜约 20 MB
+    rank_render_processes = 0  # 绘制排行表的进程数, 为 0 时在当前线程中依次绘制。导入 yinpa 时用 fork 创建, 见 render_pool
+    font_path = "msyh.ttc"  # 生成图片使用的字体文件, 相对路径从工作目录查找
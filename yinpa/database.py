@@ -2,24 +2,246 @@ import random
 import sqlite3
 import os
 import time
+import threading
+import typing as t
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from . import models
 from . import yinpa_error as err
 from .config import YinpaConfig as cfg
 from . import yinpa_tools
+from . import db_connection
 
 spath = os.path.split(__file__)[0]
 
+USER_COLUMNS = ("id", "name", "sex", "hp", "chest_size", "length", "length2", "depth", "prostitution", "persistance",
+                "injected_vol", "injected_count", "shoot_vol", "shoot_count", "active_time", "passive_time",
+                "last_update_hp", "items", "temp_sensitive", "temp_use_time", "worn_dress", "own_dress")
+
+
+INJECT_COLUMNS = ("shoot_vol", "shoot_count", "injected_vol", "injected_count", "active_time", "passive_time")
+
+
+def _inject_values_from_row(row: t.Mapping[str, t.Any]) -> t.Dict[str, t.Any]:
+    """
+    与 UserInfo.from_db_row 相同的转换
+    """
+    return {k: int(row[k]) if k.endswith("_count") else models.round_number(float(row[k])) for k in INJECT_COLUMNS}
+
+
+def _apply_inject_change(values: t.Dict[str, t.Any], change: t.Dict[str, float]) -> t.Dict[str, t.Any]:
+    """
+    inject_others 的数值变化, 数据库和缓存使用同一计算
+    :param values: INJECT_COLUMNS 的当前值
+    :param change: 各字段的增量
+    :return: 变化后的 INJECT_COLUMNS 和 prostitution
+    """
+    ret = {k: models.round_number(v + change[k]) if k in change else v for k, v in values.items()}
+    ret["prostitution"] = models.round_number(models.UserInfo.calc_prostitution(**ret))
+    return ret
+
+
+class UserInfoCache:
+    """
+    UserInfo 的 LRU 缓存, 保存与数据库已提交数据一致的对象。存入和取出时均复制, 调用方可以随意修改取得的对象
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[int, models.UserInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0  # 每次写入提交 (apply) 或失效时增加, 用于丢弃在此之前从数据库读取的数据
+
+    def get_version(self):
+        return self._version
+
+    def get(self, user_id: int) -> t.Optional[models.UserInfo]:
+        with self._lock:
+            data = self._data.get(user_id)
+            if data is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+        return data.copy(deep=True)
+
+    def put(self, data: models.UserInfo, version: t.Optional[int] = None):
+        """
+        :param version: 从数据库读取前 get_version() 的值。读取期间发生过失效时不写入缓存; 为 None 时总是写入
+        """
+        if self.max_size <= 0:
+            return
+        data = data.copy(deep=True)
+        self._coerce_int_fields(data)
+        data.body_info.body_parts_info.truncate_values()
+        with self._lock:
+            if (version is not None) and (version != self._version):
+                return
+            self._data[data.id] = data
+            self._data.move_to_end(data.id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    @staticmethod
+    def _coerce_int_fields(data: models.UserInfo):
+        """
+        int 字段可能在内存中被赋值为 float, 从数据库读取时会被截断为 int。缓存中保存截断后的值, 与重新读取的结果一致
+        """
+        for k, field in data.__fields__.items():
+            value = data.__dict__.get(k)
+            if (field.type_ is int) and isinstance(value, float):
+                data.__dict__[k] = int(value)
+
+    def apply(self, user_id: int, func: t.Callable[[models.UserInfo], t.Any]):
+        """
+        对缓存中的用户执行 func, 使其与数据库中的修改保持一致。在写入提交后调用, 用户不在缓存中时也会增加版本,
+        使提交前开始读取数据库的 put 不会写入旧数据
+        """
+        with self._lock:
+            self._version += 1
+            data = self._data.get(user_id)
+            if data is not None:
+                func(data)
+                data.clear_dirty()
+                self._coerce_int_fields(data)
+                data.body_info.body_parts_info.truncate_values()
+
+    def invalidate(self, *user_ids: int):
+        with self._lock:
+            self._version += 1
+            for i in user_ids:
+                self._data.pop(i, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "max_size": self.max_size}
+
 
 class YinpaDB:
     def __init__(self):
         if not os.path.isdir(f"{spath}/data"):
             os.makedirs(f"{spath}/data")
-        self.conn = sqlite3.connect(f"{spath}/data/yinpa_userinfo.db", check_same_thread=False)
+        self.pool = db_connection.DBConnectionManager(f"{spath}/data/yinpa_userinfo.db")
+        self._local = threading.local()
+        self._session_locks = [threading.Lock() for _ in range(cfg.db_session_lock_stripes)]
+        self.cache = UserInfoCache(cfg.user_cache_size)
+        self._change_listeners: t.List[t.Callable[[int, t.Optional[t.Dict[str, t.Any]]], t.Any]] = []
+        self._data_version = 0
+        self._data_version_lock = threading.Lock()
         self.init_db()
 
+    @property
+    def data_version(self) -> int:
+        """
+        数据版本, 每次写入提交后加一。在读取数据前记录, 用于判断由数据生成的结果 (例如排行榜图片) 是否过期。
+        在提交后的缓存同步和 add_change_listener 的回调都执行完之后才增加, 读到新版本时这些数据 (例如 RankStore) 已经更新;
+        此前读取的仍是旧版本, 生成的结果最多被多缓存为旧版本的一项
+        """
+        return self._data_version
+
+    def _bump_data_version(self):
+        with self._data_version_lock:
+            self._data_version += 1
+
+    def add_change_listener(self, func: t.Callable[[int, t.Optional[t.Dict[str, t.Any]]], t.Any]):
+        """
+        注册用户数据变化的回调, 在写入提交后于写入的线程中调用: func(user_id, values)。
+        values 为本次写入的 users 表的列值 (与数据库中相同, 新用户为全部列), 删除用户时为 None
+        """
+        self._change_listeners.append(func)
+
+    def remove_change_listener(self, func: t.Callable[[int, t.Optional[t.Dict[str, t.Any]]], t.Any]):
+        self._change_listeners.remove(func)
+
+    def _notify_change(self, user_id: int, values: t.Optional[t.Dict[str, t.Any]]):
+        for i in self._change_listeners:
+            i(user_id, values)
+
+    @contextmanager
+    def session(self, *user_ids: int):
+        """
+        事务会话。会话内的写操作先暂存，退出时作为一个写任务在同一个事务中提交；发生异常时全部丢弃。
+        会话内的读操作读取已提交的数据，看不到本会话暂存的写入: 需要读取刚保存的用户时应继续使用保存时的对象，
+        不要重新 get_user_info。
+        :param user_ids: 会话涉及的用户。涉及相同用户的会话依次执行，其余会话可以并发，并可能被合并到同一次提交中。
+                         不指定时与所有会话互斥。嵌套的会话沿用最外层会话
+        """
+        if getattr(self._local, "session", None) is not None:
+            yield self
+            return
+
+        if user_ids:
+            lock_indexes = sorted({hash(i) % len(self._session_locks) for i in user_ids})
+        else:
+            lock_indexes = range(len(self._session_locks))
+        locks = [self._session_locks[i] for i in lock_indexes]  # 按固定顺序加锁, 避免死锁
+        for lock in locks:
+            lock.acquire()
+        try:
+            session_ops = self._local.session = []
+            try:
+                yield self
+            finally:
+                self._local.session = None
+            if session_ops:
+                self.pool.write(lambda conn: [op(conn) for op, _ in session_ops])
+                try:
+                    for _, after_commit in session_ops:
+                        if after_commit is not None:
+                            after_commit()
+                finally:
+                    self._bump_data_version()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _write(self, op: t.Callable[[sqlite3.Connection], t.Any],
+               after_commit: t.Optional[t.Callable[[], t.Any]] = None):
+        """
+        执行写操作。会话内暂存到会话提交时执行，返回 None；会话外立即提交并返回 op 的返回值
+        :param after_commit: 提交成功后在当前线程执行, 用于同步缓存
+        """
+        session_ops = getattr(self._local, "session", None)
+        if session_ops is not None:
+            session_ops.append((op, after_commit))
+            return None
+        ret = self.pool.write(op)
+        try:
+            if after_commit is not None:
+                after_commit()
+        finally:
+            self._bump_data_version()
+        return ret
+
+    @contextmanager
+    def _cursor(self):
+        """
+        当前线程只读连接的游标
+        """
+        cursor = self.pool.reader().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def close(self):
+        self.pool.close()
+
     def init_db(self):
-        cursor = self.conn.cursor()
+        self.pool.write(self._create_tables)
+        self.migrate_db()
+
+    @staticmethod
+    def _create_tables(conn: sqlite3.Connection):
+        cursor = conn.cursor()
         cursor.execute("""CREATE TABLE IF NOT EXISTS "users" (
   "id" INTEGER NOT NULL,
   "name" TEXT NOT NULL,
@@ -68,37 +290,111 @@ class YinpaDB:
     inject_volume    REAL,
     timestamp        integer
 )""")
-        self.conn.commit()
         cursor.close()
 
+    def migrate_db(self):
+        """
+        数据库结构迁移。当前版本记录在 PRAGMA user_version 中，按顺序执行尚未应用的迁移，每个迁移单独一个事务。
+        """
+        migrations = [
+            self._migrate_body_parts_unique_key,
+            self._migrate_lookup_indexes,
+            self._migrate_group_members,
+            self._migrate_rank_indexes,
+        ]
+        with self._cursor() as cursor:
+            db_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for version, migration in enumerate(migrations, start=1):
+            if db_version >= version:
+                continue
+
+            def migrate(conn: sqlite3.Connection, migration=migration, version=version):
+                cursor = conn.cursor()
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+            self.pool.write(migrate)
+
+    @staticmethod
+    def _migrate_body_parts_unique_key(cursor: sqlite3.Cursor):
+        """
+        v1: body_parts_info 去重 (保留每个 (id, body_id) 最后写入的一行)，并添加唯一键
+        """
+        cursor.execute("DELETE FROM body_parts_info WHERE rowid NOT IN "
+                       "(SELECT MAX(rowid) FROM body_parts_info GROUP BY id, body_id)")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS body_parts_info_id_body_id "
+                       "ON body_parts_info (id, body_id)")
+
+    @staticmethod
+    def _migrate_lookup_indexes(cursor: sqlite3.Cursor):
+        """
+        v2: 常用查询的索引。body_parts_info 按 id 查询使用 v1 的 (id, body_id) 唯一索引
+        """
+        cursor.execute("CREATE INDEX IF NOT EXISTS users_name ON users (name)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS yinpa_log_group_id_timestamp ON yinpa_log (group_id, timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS yinpa_log_user_id_timestamp ON yinpa_log (user_id, timestamp)")
+        cursor.execute("ANALYZE")
+
+    @staticmethod
+    def _migrate_group_members(cursor: sqlite3.Cursor):
+        """
+        v3: 群成员表, 用于按群计算排行。由 yinpa_log 中记录的群号补全
+        """
+        cursor.execute("""CREATE TABLE IF NOT EXISTS "group_members" (
+    group_id INTEGER NOT NULL,
+    user_id  INTEGER NOT NULL,
+    PRIMARY KEY (group_id, user_id)
+) WITHOUT ROWID""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS group_members_user_id ON group_members (user_id)")
+        cursor.execute("INSERT OR IGNORE INTO group_members (group_id, user_id) "
+                       "SELECT group_id, user_id FROM yinpa_log WHERE group_id != -1 "
+                       "UNION SELECT group_id, target_id FROM yinpa_log WHERE group_id != -1")
+        cursor.execute("DELETE FROM group_members WHERE user_id NOT IN (SELECT id FROM users)")
+
+    @staticmethod
+    def _migrate_rank_indexes(cursor: sqlite3.Cursor):
+        """
+        v4: 排行数值列的索引, 用于 get_user_ranks 的 COUNT 查询。length 和 chest_size 的索引包含排行分组需要的列
+        """
+        cursor.execute("CREATE INDEX IF NOT EXISTS users_length ON users (length, sex)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS users_chest_size ON users (chest_size, sex, length)")
+        for i in ("persistance", "prostitution", "injected_vol", "injected_count", "shoot_vol", "shoot_count",
+                  "active_time", "passive_time"):
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS users_{i} ON users ({i})")
+        cursor.execute("ANALYZE")
+
     def update_hp(self, userid):
-        cursor = self.conn.cursor()
-        query = cursor.execute("SELECT hp, last_update_hp FROM users WHERE id=?", [userid]).fetchone()
-        if not query:
-            cursor.close()
-            raise err.UserNotFoundError(userid)
-        db_hp, last_update_hp = query
-        time_now = int(time.time())
-        now_hp = db_hp + int((time_now - last_update_hp) / cfg.unit_hp_recovery_seconds)
-        if now_hp > cfg.max_hp:
-            now_hp = cfg.max_hp
-        cursor.execute("UPDATE users SET hp=?, last_update_hp=? WHERE id=?", [now_hp, time_now, userid])
-        self.conn.commit()
-        cursor.close()
-        return now_hp
+        """
+        立即将体力恢复写入数据库。get_user_info 已在读取时计算体力恢复，一般不需要调用
+        """
+        def op(conn: sqlite3.Connection):
+            query = conn.execute("SELECT hp, last_update_hp FROM users WHERE id=?", [userid]).fetchone()
+            if not query:
+                raise err.UserNotFoundError(userid)
+            db_hp, last_update_hp = query
+            time_now = int(time.time())
+            now_hp = db_hp + int((time_now - last_update_hp) / cfg.unit_hp_recovery_seconds)
+            if now_hp > cfg.max_hp:
+                now_hp = cfg.max_hp
+            conn.execute("UPDATE users SET hp=?, last_update_hp=? WHERE id=?", [now_hp, time_now, userid])
+            return now_hp
+        return self._write(op, lambda: self.cache.invalidate(userid))
 
     def get_user_info(self, userid, raise_notfound_error=True):
-        try:
-            self.update_hp(userid)
-        except err.UserNotFoundError:
-            pass
-        cursor = self.conn.cursor()
-        cursor.row_factory = sqlite3.Row
-
-        query_user = cursor.execute("SELECT * FROM users WHERE id=?", [userid]).fetchone()
-        query_body_info = cursor.execute("SELECT * FROM body_info WHERE id=?", [userid]).fetchone()
-        query_body_parts_info = cursor.execute("SELECT * FROM body_parts_info WHERE id=?", [userid]).fetchall()
-        cursor.close()
+        """
+        获取用户信息。体力恢复只在内存中计算，保存用户时才会写入数据库。
+        会话内读取的是已提交的数据, 不包含本会话暂存的写入 (见 session)
+        """
+        ret = self.cache.get(userid)
+        if ret is not None:
+            ret.recover_hp()
+            return ret
+
+        cache_version = self.cache.get_version()
+        with self._cursor() as cursor:
+            cursor.row_factory = sqlite3.Row
+            query_user = cursor.execute("SELECT * FROM users WHERE id=?", [userid]).fetchone()
+            query_body_info = cursor.execute("SELECT * FROM body_info WHERE id=?", [userid]).fetchone()
+            query_body_parts_info = cursor.execute("SELECT * FROM body_parts_info WHERE id=?", [userid]).fetchall()
 
         if not all([query_user, query_body_info, query_body_parts_info]):
             if raise_notfound_error:
@@ -106,20 +402,16 @@ class YinpaDB:
             else:
                 return None
 
-        ret_dict = dict(query_user)
-        ret_dict["body_info"] = dict(query_body_info)
-        if "body_parts_info" not in ret_dict["body_info"]:
-            ret_dict["body_info"]["body_parts_info"] = {}
-        for i in query_body_parts_info:
-            curr_data = dict(i)
-            ret_dict["body_info"]["body_parts_info"][curr_data["body_id"]] = curr_data
-
-        return models.UserInfo(**ret_dict)
+        ret = models.UserInfo.from_db_row(
+            query_user, models.UserBodyInfo.from_db_rows(query_body_info["race"], query_body_parts_info))
+        ret.clear_dirty()
+        self.cache.put(ret, cache_version)
+        ret.recover_hp()
+        return ret
 
     def get_user_info_from_name(self, username, raise_notfound_error=True):
-        cursor = self.conn.cursor()
-        query = cursor.execute("SELECT id FROM users WHERE name=?", [username]).fetchone()
-        cursor.close()
+        with self._cursor() as cursor:
+            query = cursor.execute("SELECT id FROM users WHERE name=?", [username]).fetchone()
         if not query:
             if raise_notfound_error:
                 raise err.UserNotFoundError(username)
@@ -128,9 +420,8 @@ class YinpaDB:
         return self.get_user_info(query[0], raise_notfound_error=raise_notfound_error)
 
     def get_random_user(self):
-        cursor = self.conn.cursor()
-        query = cursor.execute("SELECT id FROM users ORDER BY RANDOM() LIMIT 1").fetchone()
-        cursor.close()
+        with self._cursor() as cursor:
+            query = cursor.execute("SELECT id FROM users ORDER BY RANDOM() LIMIT 1").fetchone()
         if not query:
             raise err.UserNotFoundError("获取随机对象失败")
         return self.get_user_info(query[0])
@@ -140,78 +431,305 @@ class YinpaDB:
         获取所有用户信息
         :param with_body_parts_info: 获取 body_parts_info。设置为 False 可以极大提高获取速度, 但是没有 body_info.body_parts_info
         """
-        cursor = self.conn.cursor()
-        cursor.row_factory = sqlite3.Row
+        return list(self.iter_all_users(with_body_parts_info=with_body_parts_info))
 
-        query_users = cursor.execute("SELECT * FROM users").fetchall()
-        query_body_info = [dict(i) for i in cursor.execute("SELECT * FROM body_info",).fetchall()]
-        query_body_parts_info = [dict(i) for i in cursor.execute("SELECT * FROM body_parts_info").fetchall()] \
-            if with_body_parts_info else []
-        cursor.close()
+    def iter_all_users(self, with_body_parts_info=True) -> t.Iterator[models.UserInfo]:
+        """
+        逐个生成所有用户信息，不构建完整列表。users 和 body_parts_info 均按 id 有序读取，合并时只需各扫描一遍
+        :param with_body_parts_info: 同 get_all_users
+        """
+        return self._iter_users("", [], with_body_parts_info)
 
+    def get_users(self, user_ids: t.Iterable[int], with_body_parts_info=True) -> t.List[models.UserInfo]:
+        """
+        获取多个用户信息, 按 id 排序, 不存在的用户忽略
+        :param with_body_parts_info: 同 get_all_users
+        """
+        user_ids = sorted(set(user_ids))
         ret = []
-        for query_user in query_users:
-            user_info_dict = dict(query_user)
-            user_id = user_info_dict["id"]
-
-            del_index = -1
-            for n, body_info in enumerate(query_body_info):
-                if body_info["id"] == user_id:
-                    user_info_dict["body_info"] = body_info
-                    del_index = n
-                    break
-            if del_index >= 0:
-                del query_body_info[del_index]
+        for i in range(0, len(user_ids), 500):  # 每次查询的参数数量有上限
+            chunk = user_ids[i:i + 500]
+            ret.extend(self._iter_users(f"WHERE {{table}}.id IN ({', '.join('?' for _ in chunk)})", chunk,
+                                        with_body_parts_info))
+        return ret
 
-            if "body_parts_info" not in user_info_dict["body_info"]:
-                user_info_dict["body_info"]["body_parts_info"] = {}
+    def _iter_users(self, where: str, params: t.List[t.Any], with_body_parts_info: bool) -> t.Iterator[models.UserInfo]:
+        """
+        :param where: WHERE 子句, 其中的 {table} 替换为 users 或 body_parts_info
+        """
+        with self._cursor() as cursor, self._cursor() as parts_cursor:
+            cursor.row_factory = sqlite3.Row
+            parts_cursor.row_factory = sqlite3.Row
+            cursor.execute("SELECT users.*, body_info.race FROM users JOIN body_info ON body_info.id = users.id "
+                           f"{where.format(table='users')} ORDER BY users.id", params)
+            if with_body_parts_info:
+                query_body_parts_info = parts_cursor.execute(
+                    f"SELECT * FROM body_parts_info {where.format(table='body_parts_info')} ORDER BY id", params)
+            else:
+                query_body_parts_info = iter(())
+            curr_part = next(query_body_parts_info, None)
 
-            for n, i in enumerate(query_body_parts_info):
-                if i["id"] == user_id:
-                    user_info_dict["body_info"]["body_parts_info"][i["body_id"]] = i
-            ret.append(models.UserInfo(**user_info_dict))
-        return ret
+            for query_user in cursor:
+                user_id = query_user["id"]
+                body_parts_rows = []
+                while (curr_part is not None) and (curr_part["id"] < user_id):  # 没有对应用户的部位
+                    curr_part = next(query_body_parts_info, None)
+                while (curr_part is not None) and (curr_part["id"] == user_id):
+                    body_parts_rows.append(curr_part)
+                    curr_part = next(query_body_parts_info, None)
+                user_info = models.UserInfo.from_db_row(
+                    query_user, models.UserBodyInfo.from_db_rows(query_user["race"], body_parts_rows))
+                user_info.clear_dirty()
+                yield user_info
+
+    def get_user_columns(self, columns: t.Sequence[str]) -> t.List[t.Tuple[t.Any, ...]]:
+        """
+        只读取所有用户的指定列, 按 id 排序。用户范围与 get_all_users 相同
+        :param columns: users 表的列名
+        """
+        for i in columns:
+            if i not in USER_COLUMNS:
+                raise err.YinpaValueError(f"Invalid user column: {i}")
+        with self._cursor() as cursor:
+            return cursor.execute(f"SELECT {', '.join(f'users.{i}' for i in columns)} FROM users "
+                                  "JOIN body_info ON body_info.id = users.id ORDER BY users.id").fetchall()
+
+    def get_user_row(self, user_id: int, columns: t.Sequence[str]) -> t.Optional[t.Tuple[t.Any, ...]]:
+        """
+        只读取一个用户的指定列, 值与 get_user_columns 相同 (数据库中的原始值)。用户不存在时返回 None
+        """
+        for i in columns:
+            if i not in USER_COLUMNS:
+                raise err.YinpaValueError(f"Invalid user column: {i}")
+        with self._cursor() as cursor:
+            return cursor.execute(f"SELECT {', '.join(f'users.{i}' for i in columns)} FROM users "
+                                  "JOIN body_info ON body_info.id = users.id WHERE users.id = ?", [user_id]).fetchone()
+
+    @staticmethod
+    def _user_column_value(data: models.UserInfo, column: str):
+        if column == "sex":
+            return data.sex.value
+        if column == "items":
+            return data.items_to_json_str()
+        if column == "worn_dress":
+            return data.worn_dress_item_to_json_str()
+        if column == "own_dress":
+            return data.own_dress_item_to_json_str()
+        return getattr(data, column)
 
     def update_user_info(self, data: models.UserInfo):
+        """
+        保存用户信息。从数据库读取的用户只写入发生变化的字段和部位，新用户写入全部数据。
+        写入的数据在调用时确定，会话内之后对 data 的修改需要再次调用。
+        会话外调用时在该用户的会话中写入, 不会插入到涉及该用户的会话的读取和提交之间。
+        在会话外读取、修改再保存仍可能覆盖期间其它写入对相同字段的修改, 需要时应把读取和保存放在 session(user_id) 中
+        """
+        if getattr(self._local, "session", None) is None:
+            with self.session(data.id):
+                return self.update_user_info(data)
+
         data.update_prostitution()
-        cursor = self.conn.cursor()
-
-        cursor.execute("INSERT OR REPLACE INTO users (id, name, sex, hp, chest_size, length, length2, depth, "
-                       "prostitution, persistance, injected_vol, injected_count, shoot_vol, shoot_count, active_time, "
-                       "passive_time, last_update_hp, items, temp_sensitive, temp_use_time, worn_dress, own_dress) "
-                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                       [data.id, data.name, data.sex.value, data.hp,
-                        data.chest_size, data.length, data.length2, data.depth,
-                        data.prostitution, data.persistance, data.injected_vol,
-                        data.injected_count, data.shoot_vol, data.shoot_count,
-                        data.active_time, data.passive_time, data.last_update_hp,
-                        data.items_to_json_str(), data.temp_sensitive, data.temp_use_time,
-                        data.worn_dress_item_to_json_str(), data.own_dress_item_to_json_str()])
-        cursor.execute("INSERT OR REPLACE INTO body_info (id, race) VALUES (?, ?)",
-                       [data.id, data.body_info.race.value.race_id])
-
-        for k in data.body_info.body_parts_info:
-            v = data.body_info.body_parts_info[k]
-            query_parts = cursor.execute("SELECT * FROM body_parts_info WHERE id=? AND body_id=?",
-                                         [data.id, k.value.body_id]).fetchone()
-            if query_parts:
-                cursor.execute("UPDATE body_parts_info SET base_sensitive = ?, sensitive = ?, "
-                               "stroke_soft_sensitive = ?, stroke_normal_sensitive = ?, stroke_severely_sensitive = ?"
-                               " WHERE id = ? AND body_id = ?", [v.base_sensitive, v.sensitive, v.stroke_soft_sensitive,
-                                                                 v.stroke_normal_sensitive, v.stroke_severely_sensitive,
-                                                                 data.id, k.value.body_id])
+        # data 的修改标记在提交后才清除, 写入失败或会话回滚时下次保存仍会写入这些修改
+        data._save_seq += 1
+        save_seq = data._save_seq
+        saved = data.copy(deep=True)
+        saved.clear_dirty()
+
+        def mark_synced():
+            if data._save_seq == save_seq:  # 同一会话中多次保存时, 后一次写入的字段包含前一次的
+                data.mark_synced(saved)
+
+        if data.is_new():
+            op = self._insert_user_info_op(data)
+            changed_values = {i: self._user_column_value(data, i) for i in USER_COLUMNS} \
+                if self._change_listeners else None
+
+            def after_commit():
+                mark_synced()
+                self.cache.invalidate(saved.id)
+                self.cache.put(saved)
+                if changed_values is not None:
+                    self._notify_change(saved.id, changed_values)
+        else:
+            op = self._update_dirty_user_info_op(data)
+            # 缓存与数据库一样只更新变化的字段, 避免用旧对象覆盖其它写入 (例如 inject_others) 的结果
+            dirty_fields_all = data.get_dirty_fields()
+            dirty_fields = [i for i in dirty_fields_all if i in data.__fields__]
+            dirty_parts = list(data.body_info.get_dirty_parts())
+            changed_values = {i: self._user_column_value(data, i) for i in USER_COLUMNS if i in dirty_fields_all} \
+                if self._change_listeners else None
+
+            def apply_dirty(cached: models.UserInfo):
+                for k in dirty_fields:
+                    setattr(cached, k, getattr(saved, k))
+                if "race" in dirty_fields_all:
+                    cached.body_info.race = saved.body_info.race
+                for k in dirty_parts:
+                    cached.body_info.body_parts_info[k] = saved.body_info.body_parts_info[k]
+
+            def after_commit():
+                mark_synced()
+                self.cache.apply(saved.id, apply_dirty)
+                if changed_values:
+                    self._notify_change(saved.id, changed_values)
+        self._write(op, after_commit)
+
+    def _update_dirty_user_info_op(self, data: models.UserInfo):
+        dirty_fields = data.get_dirty_fields()
+        update_columns = [i for i in USER_COLUMNS if i in dirty_fields]
+        update_values = [self._user_column_value(data, i) for i in update_columns] + [data.id]
+        race_id = data.body_info.race.value.race_id \
+            if ("race" in dirty_fields) or ("body_info" in dirty_fields) else None
+        parts_rows = self._body_parts_rows(data.id, data.body_info.get_dirty_parts())
+
+        def op(conn: sqlite3.Connection):
+            # 用户已被删除时不写入, 避免留下没有对应用户的 body_info 和 body_parts_info
+            if update_columns:
+                cursor = conn.execute(f"UPDATE users SET {', '.join(f'{i} = ?' for i in update_columns)} "
+                                      f"WHERE id = ?", update_values)
+                if cursor.rowcount == 0:
+                    return
+            elif ((race_id is not None) or parts_rows) and \
+                    (conn.execute("SELECT 1 FROM users WHERE id=?", [data.id]).fetchone() is None):
+                return
+            if race_id is not None:
+                conn.execute("INSERT OR REPLACE INTO body_info (id, race) VALUES (?, ?)", [data.id, race_id])
+            self._upsert_body_parts(conn, parts_rows)
+        return op
+
+    def _insert_user_info_op(self, data: models.UserInfo):
+        user_values = [self._user_column_value(data, i) for i in USER_COLUMNS]
+        race_id = data.body_info.race.value.race_id
+        parts_rows = self._body_parts_rows(data.id, data.body_info.body_parts_info)
+
+        def op(conn: sqlite3.Connection):
+            conn.execute(f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                         f"VALUES ({', '.join('?' for _ in USER_COLUMNS)})", user_values)
+            conn.execute("INSERT OR REPLACE INTO body_info (id, race) VALUES (?, ?)", [data.id, race_id])
+            self._upsert_body_parts(conn, parts_rows)
+        return op
+
+    @staticmethod
+    def _body_parts_rows(user_id: int, body_parts_info: t.Mapping[models.BodyParts, models.BodyPartView]):
+        return [[user_id, k.value.body_id, v.base_sensitive, v.sensitive, v.stroke_soft_sensitive,
+                 v.stroke_normal_sensitive, v.stroke_severely_sensitive] for k, v in body_parts_info.items()]
+
+    @staticmethod
+    def _upsert_body_parts(conn: sqlite3.Connection, parts_rows: t.List[t.List]):
+        if not parts_rows:
+            return
+        conn.executemany("INSERT INTO body_parts_info (id, body_id, base_sensitive, sensitive, "
+                         "stroke_soft_sensitive, stroke_normal_sensitive, stroke_severely_sensitive) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id, body_id) DO UPDATE SET "
+                         "base_sensitive = excluded.base_sensitive, sensitive = excluded.sensitive, "
+                         "stroke_soft_sensitive = excluded.stroke_soft_sensitive, "
+                         "stroke_normal_sensitive = excluded.stroke_normal_sensitive, "
+                         "stroke_severely_sensitive = excluded.stroke_severely_sensitive", parts_rows)
+
+    def add_group_members(self, group_id: int, user_ids: t.Iterable[int]):
+        """
+        记录群成员。在群内 yinpa 时会自动记录双方
+        """
+        rows = [[group_id, i] for i in user_ids]
+
+        def op(conn: sqlite3.Connection):
+            conn.executemany("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)", rows)
+        return self._write(op)
+
+    def remove_group_members(self, group_id: int, user_ids: t.Optional[t.Iterable[int]] = None):
+        """
+        :param user_ids: 为 None 时移除整个群
+        """
+        def op(conn: sqlite3.Connection):
+            if user_ids is None:
+                conn.execute("DELETE FROM group_members WHERE group_id=?", [group_id])
             else:
-                cursor.execute("INSERT INTO body_parts_info (id, body_id, base_sensitive, sensitive, "
-                               "stroke_soft_sensitive, stroke_normal_sensitive, stroke_severely_sensitive) "
-                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                               [data.id, k.value.body_id, v.base_sensitive, v.sensitive, v.stroke_soft_sensitive,
-                                v.stroke_normal_sensitive, v.stroke_severely_sensitive])
-        self.conn.commit()
-        cursor.close()
+                conn.executemany("DELETE FROM group_members WHERE group_id=? AND user_id=?",
+                                 [[group_id, i] for i in user_ids])
+        return self._write(op)
+
+    def get_group_members(self, group_id: int) -> t.List[int]:
+        with self._cursor() as cursor:
+            return [i[0] for i in cursor.execute("SELECT user_id FROM group_members WHERE group_id=?", [group_id])]
+
+    @staticmethod
+    def _group_users_sql(select: str, where: t.Optional[str]):
+        """
+        群内用户的查询, 只扫描 group_members 中该群的行, 再按主键连接 users。用户范围与 get_all_users 相同
+        :param where: 附加条件, 可使用 users 表的列
+        """
+        return (f"SELECT {select} FROM group_members JOIN users ON users.id = group_members.user_id "
+                f"JOIN body_info ON body_info.id = users.id WHERE group_members.group_id = ?"
+                f"{f' AND ({where})' if where else ''}")
+
+    def get_group_top_users(self, group_id: int, column: str, limit: int, descending=True,
+                            where: t.Optional[str] = None) -> t.List[int]:
+        """
+        群内按 column 排序的前 limit 个用户 id。数值相同时 id 小的在前
+        """
+        if column not in USER_COLUMNS:
+            raise err.YinpaValueError(f"Invalid user column: {column}")
+        with self._cursor() as cursor:
+            return [i[0] for i in cursor.execute(
+                self._group_users_sql("users.id", where) +
+                f" ORDER BY users.{column} {'DESC' if descending else 'ASC'}, users.id LIMIT ?", [group_id, limit])]
+
+    def count_group_users(self, group_id: int, where: t.Optional[str] = None, column: t.Optional[str] = None,
+                          value=None, descending=True) -> int:
+        """
+        群内用户数量
+        :param column: 不为 None 时只统计 column 大于 value 的用户 (descending 为 False 时为小于)
+        """
+        params = [group_id]
+        if column is not None:
+            if column not in USER_COLUMNS:
+                raise err.YinpaValueError(f"Invalid user column: {column}")
+            compare = f"users.{column} {'>' if descending else '<'} ?"
+            where = f"({where}) AND {compare}" if where else compare
+            params.append(value)
+        with self._cursor() as cursor:
+            return cursor.execute(self._group_users_sql("COUNT(*)", where), params).fetchone()[0]
+
+    def get_user_ranks(self, user_id: int, metrics: t.Sequence[str], group_id: t.Optional[int] = None,
+                       descending=True, where: t.Optional[str] = None) -> t.Dict[str, int]:
+        """
+        用户在各项数值中的名次 (数值比该用户大的用户数 + 1, 与排行榜相同), 不需要读取所有用户。
+        每项一条 COUNT(*) 查询: 全体排行使用数值列的索引 (v4), 按群排行只扫描该群的成员
+        :param metrics: users 表的列名, prostitution 等
+        :param group_id: 只统计此群的成员
+        :param descending: 为 False 时统计数值比该用户小的用户数
+        :param where: 参与排行的用户的附加条件, 可使用 users 表的列
+        :return: {列名: 名次}
+        """
+        for i in metrics:
+            if i not in USER_COLUMNS:
+                raise err.YinpaValueError(f"Invalid user column: {i}")
+        ret = {}
+        with self._cursor() as cursor:
+            query = cursor.execute(f"SELECT {', '.join(f'users.{i}' for i in metrics) or 'id'} FROM users WHERE id=?",
+                                   [user_id]).fetchone()
+            if query is None:
+                raise err.UserNotFoundError(user_id)
+            for column, value in zip(metrics, query):
+                compare = f"users.{column} {'>' if descending else '<'} ?"
+                if where:
+                    compare = f"({where}) AND {compare}"
+                if group_id is None:
+                    count = cursor.execute(f"SELECT COUNT(*) FROM users WHERE {compare}", [value]).fetchone()[0]
+                else:
+                    count = cursor.execute(self._group_users_sql("COUNT(*)", compare), [group_id, value]).fetchone()[0]
+                ret[column] = count + 1
+        return ret
+
+    def get_all_user_names(self) -> t.List[t.Tuple[int, str]]:
+        """
+        获取所有用户的 (id, 昵称)
+        """
+        with self._cursor() as cursor:
+            return cursor.execute("SELECT id, name FROM users").fetchall()
 
     def check_username_exists(self, user_name: str, user_id=None):
-        cursor = self.conn.cursor()
-        try:
+        with self._cursor() as cursor:
             if user_id is None:
                 if cursor.execute("SELECT * FROM users WHERE name=?", [user_name]).fetchone():
                     return True
@@ -219,8 +737,6 @@ class YinpaDB:
                 if cursor.execute("SELECT * FROM users WHERE id!=? AND name=?", [user_id, user_name]).fetchone():
                     return True
             return False
-        finally:
-            cursor.close()
 
     def create_user(self, user_id: int, user_name: str, sex: models.BaseSex, race: models.RaceTypes):
         if self.check_username_exists(user_name, user_id):
@@ -241,48 +757,75 @@ class YinpaDB:
                 if n == change_index:
                     data.body_info.body_parts_info[k].sensitive += change_value
                     break
+        # get_init 只有人类的部位, 与重新读取时 (from_db_rows) 一样补全种族特有的部位, 缓存中的用户才与数据库一致
+        data.body_info.check_body_parts_info()
 
         self.update_user_info(data)
         return data
 
     def delete_user(self, user_id: int):
-        cursor = self.conn.cursor()
-        cursor.execute("DELETE FROM body_parts_info WHERE id=?", [user_id])
-        cursor.execute("DELETE FROM body_info WHERE id=?", [user_id])
-        cursor.execute("DELETE FROM users WHERE id=?", [user_id])
-        rowcount = cursor.rowcount
-        self.conn.commit()
-        cursor.close()
-        return rowcount > 0
+        def op(conn: sqlite3.Connection):
+            conn.execute("DELETE FROM body_parts_info WHERE id=?", [user_id])
+            conn.execute("DELETE FROM body_info WHERE id=?", [user_id])
+            conn.execute("DELETE FROM group_members WHERE user_id=?", [user_id])
+            return conn.execute("DELETE FROM users WHERE id=?", [user_id]).rowcount > 0
+
+        def after_commit():
+            self.cache.invalidate(user_id)
+            self._notify_change(user_id, None)
+        return self._write(op, after_commit)
 
     def inject_others(self, self_user_id: int, action_type: int, target_user_id: int, target_part: int,
                       volume: float, spend_time: float, group_id=-1, is_serve=False):
         """
         is_serve 为 True 时，仅记录目标用户射出；为 False 时，记录自身射出和目标注入
         """
-        cursor = self.conn.cursor()
-        try:
-            query = cursor.execute("SELECT id FROM users WHERE id=? OR id=?", [self_user_id, target_user_id]).fetchall()
-            query = [i[0] for i in query]
+        timestamp = int(time.time())
+
+        self_change = {"active_time": spend_time}
+        target_change = {"passive_time": spend_time}
+        if is_serve:
+            target_change.update(shoot_vol=volume, shoot_count=1)
+        else:
+            self_change.update(shoot_vol=volume, shoot_count=1)
+            target_change.update(injected_vol=volume, injected_count=1)
+        written_values: t.Dict[int, t.Dict[str, t.Any]] = {}
+
+        def op(conn: sqlite3.Connection):
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            query = cursor.execute(f"SELECT id, {', '.join(INJECT_COLUMNS)} FROM users WHERE id=? OR id=?",
+                                   [self_user_id, target_user_id]).fetchall()
+            query = {i["id"]: i for i in query}
             if self_user_id not in query:
                 raise err.UserNotFoundError("您还未加入yinpa")
             if target_user_id not in query:
                 raise err.UserNotFoundError("对方还未加入yinpa")
 
-            if is_serve:
-                cursor.execute("UPDATE users SET shoot_vol = shoot_vol + ?, shoot_count = shoot_count + 1 WHERE id=?",
-                               [volume, target_user_id])
-            else:
-                cursor.execute("UPDATE users SET injected_vol = injected_vol + ?, injected_count = injected_count + 1 "
-                               "WHERE id=?", [volume, target_user_id])
-                cursor.execute("UPDATE users SET shoot_vol = shoot_vol + ?, shoot_count = shoot_count + 1 WHERE id=?",
-                               [volume, self_user_id])
-
-            cursor.execute("UPDATE users SET active_time = active_time + ? WHERE id=?", [spend_time, self_user_id])
-            cursor.execute("UPDATE users SET passive_time = passive_time + ? WHERE id=?", [spend_time, target_user_id])
+            # 在 Python 中计算, 与 UserInfo 的数值处理 (保留 4 位小数) 和缓存中的结果完全一致
+            for user_id, change in ((self_user_id, self_change), (target_user_id, target_change)):
+                values = written_values[user_id] = _apply_inject_change(_inject_values_from_row(query[user_id]),
+                                                                        change)
+                cursor.execute(f"UPDATE users SET {', '.join(f'{i} = ?' for i in values)} WHERE id=?",
+                               [*values.values(), user_id])
             cursor.execute("INSERT INTO yinpa_log (user_id, action_type, target_id, target_body_part, group_id, inject_volume, timestamp) "
                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                           [self_user_id, action_type, target_user_id, target_part, group_id, volume, int(time.time())])
-            self.conn.commit()
-        finally:
-            cursor.close()
+                           [self_user_id, action_type, target_user_id, target_part, group_id, volume, timestamp])
+            if group_id != -1:
+                cursor.executemany("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)",
+                                   [[group_id, self_user_id], [group_id, target_user_id]])
+
+        def apply_change(change: t.Dict[str, float]):
+            def func(data: models.UserInfo):
+                for k, v in _apply_inject_change({i: getattr(data, i) for i in INJECT_COLUMNS}, change).items():
+                    setattr(data, k, v)
+            return func
+        apply_self = apply_change(self_change)
+        apply_target = apply_change(target_change)
+
+        def after_commit():
+            self.cache.apply(self_user_id, apply_self)
+            self.cache.apply(target_user_id, apply_target)
+            for k, v in written_values.items():
+                self._notify_change(k, v)
+        self._write(op, after_commit)
@@ -0,0 +1,119 @@
+import queue
+import sqlite3
+import threading
+import typing as t
+from concurrent.futures import Future
+
+from .config import YinpaConfig as cfg
+
+
+class DBConnectionManager:
+    """
+    SQLite 连接管理
+    - 数据库使用 WAL 模式, synchronous=NORMAL
+    - 每个线程使用自己的只读连接, 读操作可以并发
+    - 所有写操作提交到唯一的写线程执行。写线程每次取出队列中所有等待的写任务, 在同一个事务中执行并只提交一次 (组提交),
+      每个写任务使用单独的 SAVEPOINT, 出错时只回滚该任务
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._readers: t.List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._write_queue: "queue.Queue[t.Optional[t.Tuple[t.Callable[[sqlite3.Connection], t.Any], Future]]]" = \
+            queue.Queue()
+        self._writer_ready = threading.Event()
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="yinpa-db-writer", daemon=True)
+        self._writer_thread.start()
+        self._writer_ready.wait()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=cfg.db_busy_timeout, check_same_thread=False)
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        """
+        获取当前线程的只读连接
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only = ON")
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def write(self, func: t.Callable[[sqlite3.Connection], t.Any]):
+        """
+        在写线程的事务中执行 func(conn), 等待提交完成后返回 func 的返回值。func 抛出的异常会在调用方重新抛出
+        """
+        if threading.current_thread() is self._writer_thread:
+            raise RuntimeError("write() can not be called from the writer thread")
+        future = Future()
+        self._write_queue.put((func, future))
+        return future.result()
+
+    def close(self):
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        with self._readers_lock:
+            for i in self._readers:
+                i.close()
+            self._readers.clear()
+        self._local = threading.local()
+
+    def _writer_loop(self):
+        conn = self._connect()
+        conn.isolation_level = None  # 事务由写线程自行管理
+        conn.execute("PRAGMA journal_mode = WAL")
+        self._writer_ready.set()
+        running = True
+        while running:
+            job = self._write_queue.get()
+            if job is None:
+                break
+            jobs = [job]
+            while len(jobs) < cfg.db_write_batch_size:
+                try:
+                    job = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                jobs.append(job)
+            self._run_jobs(conn, jobs)
+        conn.close()
+
+    @staticmethod
+    def _run_jobs(conn: sqlite3.Connection, jobs):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for func, future in jobs:
+                conn.execute("SAVEPOINT yinpa_job")
+                try:
+                    result = func(conn)
+                except BaseException as e:
+                    conn.execute("ROLLBACK TO yinpa_job")
+                    conn.execute("RELEASE yinpa_job")
+                    results.append((future, False, e))
+                else:
+                    conn.execute("RELEASE yinpa_job")
+                    results.append((future, True, result))
+            conn.execute("COMMIT")
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future in jobs:
+                future.set_exception(e)
+            return
+
+        for future, success, value in results:
+            if success:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
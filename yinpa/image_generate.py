@@ -1,14 +1,46 @@
 from . import models as m
 from PIL import Image, ImageOps, ImageFont, ImageDraw
 from io import BytesIO
+import hashlib
+import math
 import os
+import threading
 from typing import List, Any, Union, Tuple, Optional, Callable, Dict
 from .config import YinpaConfig as cfg
 from . import yinpa_tools
+from .render_cache import RenderCache
 
 
 spath = os.path.split(__file__)[0]
 
+FONT_SIZES = (12, 13, 14, 23, 25, 26, 27)  # 各图片使用的字号, preload_fonts 默认加载这些字号
+_fonts: Dict[Tuple[str, int], ImageFont.FreeTypeFont] = {}
+_fonts_lock = threading.Lock()
+
+
+def get_font(size: int, path: Optional[str] = None) -> ImageFont.FreeTypeFont:
+    """
+    按 (字体路径, 字号) 缓存的字体, 第一次使用时加载, 各线程共用
+    :param path: 字体文件路径, 为 None 时使用 cfg.font_path
+    """
+    key = (cfg.font_path if path is None else path, size)
+    font = _fonts.get(key)
+    if font is None:
+        with _fonts_lock:
+            font = _fonts.get(key)
+            if font is None:
+                font = ImageFont.truetype(key[0], size=size)
+                _fonts[key] = font
+    return font
+
+
+def preload_fonts(sizes=FONT_SIZES, path: Optional[str] = None):
+    """
+    预先加载字体, 启动时调用以免第一次生成图片时读取字体文件。字体文件不存在时抛出 OSError
+    """
+    for i in sizes:
+        get_font(i, path)
+
 
 def mask_img(img: Image.Image, mask_path: str, size=None) -> Image.Image:
     imsize = img.size if size is None else size
@@ -30,13 +62,13 @@ def draw_table(data: List[List[Any]], table_width=600, table_height=300, bg_colo
     # 创建图像对象
     image = Image.new('RGBA', (table_width, table_height), color=bg_color)
     draw = ImageDraw.Draw(image)
-    font = ImageFont.truetype('msyh.ttc', size=font_stze)
+    font = get_font(font_stze)
 
     # 绘制表格线和文本
     for i, row in enumerate(data):
         if (i == 0) and table_title:
             draw.rectangle((0, 0, table_width - 1, cell_height), outline='black')
-            title_font = ImageFont.truetype('msyh.ttc', size=font_stze + 1)
+            title_font = get_font(font_stze + 1)
             draw.text((table_width / 2, cell_height / 2), str(table_title), fill='black', font=title_font, anchor='mm')
             continue
 
@@ -48,6 +80,35 @@ def draw_table(data: List[List[Any]], table_width=600, table_height=300, bg_colo
             draw.text((x + cell_width / 2, y + cell_height / 2), str(cell), fill=fill, font=font, anchor='mm')
     return image
 
+def redraw_table_row(image: Image.Image, data: List[List[Any]], row: int, table_width=600, table_height=300,
+                     fill: Any = "black", font_stze=12, table_title: str = None, bg_color: Union[str, Tuple] = "white"):
+    """
+    用另一种颜色重新绘制 draw_table 生成的表格中的一行 (直接修改 image), 参数与 draw_table 相同。
+    只清空单元格内部后重绘文字, 结果与 draw_table 的 draw_colors 相同。
+    文字超出单元格内部时 (例如很长的昵称) 原来的文字无法清除干净, 此时不修改 image 并返回 False, 需要重新绘制整个表格
+    :param row: 行在 data 中的下标
+    :return: 是否已经重新绘制
+    """
+    cell_width = table_width / len(data[0])
+    cell_height = table_height / (len(data) + (1 if table_title else 0))
+    draw = ImageDraw.Draw(image)
+    font = get_font(font_stze)
+    y = (row + (1 if table_title else 0)) * cell_height
+    cells = []
+    for j, cell in enumerate(data[row]):
+        x = j * cell_width
+        box = (x + 1, y + 1, x + cell_width - 2, y + cell_height - 2)
+        center = (x + cell_width / 2, y + cell_height / 2)
+        left, top, right, bottom = draw.textbbox(center, str(cell), font=font, anchor='mm')
+        if (left < math.ceil(box[0])) or (top < math.ceil(box[1])) or \
+                (right > math.floor(box[2])) or (bottom > math.floor(box[3])):
+            return False
+        cells.append((box, center, str(cell)))
+    for box, center, text in cells:
+        draw.rectangle(box, fill=bg_color)
+        draw.text(center, text, fill=fill, font=font, anchor='mm')
+    return True
+
 def paste_image(pt, im, x, y, w=-1, h=-1, with_mask=True):
     w = im.width if w == -1 else w
     h = im.height if h == -1 else h
@@ -116,7 +177,7 @@ def generate_body_info_table(user_info: m.UserInfo, width=490, line_h=25):
 
 
 def text_to_img(text: str, text_size=23, margin=15, bg_color: Union[str, Tuple] = "white", line_spacing=1.2):
-    font = ImageFont.truetype('msyh.ttc', size=text_size)
+    font = get_font(text_size)
     text_w, text_h = calc_text_size(text, font, line_spacing)
     pt = Image.new("RGB", (text_w + margin * 2, text_h + margin * 2), bg_color)
     draw = ImageDraw.Draw(pt)
@@ -127,7 +188,7 @@ def text_to_img(text: str, text_size=23, margin=15, bg_color: Union[str, Tuple]
 def generate_userinfo(user_info: m.UserInfo, avatar: bytes = None):
     info_str = user_info_to_str(user_info)
     info_str = f"{info_str}\n\n敏感度信息"
-    font = ImageFont.truetype('msyh.ttc', size=23)
+    font = get_font(23)
     text_w, text_h = calc_text_size(info_str, font, 1.2)
 
     items = [["物品名", "数量"]]
@@ -155,7 +216,7 @@ def generate_userinfo(user_info: m.UserInfo, avatar: bytes = None):
 
     draw = ImageDraw.Draw(pt)
     draw.text((310, 40), info_str, fill="black", font=font)
-    font = ImageFont.truetype('msyh.ttc', size=27)
+    font = get_font(27)
     draw.text((137, 237), "背包物品", fill="black", font=font, anchor='mm')
     paste_image(pt, item_img, 7, 267)
     paste_image(pt, body_info_img, 293, body_info_img_y)
@@ -190,13 +251,17 @@ def generate_help_img(desc_text: str):
     return pt
 
 
-def generate_rank_table(head_part: List[m.UserInfo], key: Callable[[m.UserInfo], Any], total_count: int,
-                        end_part: Optional[List[m.UserInfo]] = None, title: Optional[str] = None, item_name="数值",
-                        target_userinfo: Optional[m.UserInfo] = None, target_user_rank=-1, table_w=350):
+def rank_table_data(head_part: List[m.UserInfo], key: Callable[[m.UserInfo], Any], total_count: int,
+                    end_part: Optional[List[m.UserInfo]] = None, item_name="数值",
+                    target_userinfo: Optional[m.UserInfo] = None, target_user_rank=-1):
+    """
+    排行表的内容
+    :return: (表格数据, 需要标红的行在表格数据中的下标, 没有时为 None)
+    """
     table_data = [["排名", "昵称", item_name]]
     for n, i in enumerate(head_part):
         table_data.append([n + 1, i.name, key(i)])
-    target_data_index = -1
+    target_row = None
 
     if end_part:
         table_data.append(["...", "...", "..."])
@@ -204,27 +269,122 @@ def generate_rank_table(head_part: List[m.UserInfo], key: Callable[[m.UserInfo],
             if target_userinfo not in head_part:
                 if target_userinfo not in end_part:
                     if target_user_rank > 0:
-                        target_data_index = len(table_data) + 2
+                        target_row = len(table_data)
                         table_data.append([target_user_rank, target_userinfo.name, key(target_userinfo)])
                         table_data.append(["...", "...", "..."])
             else:
-                target_data_index = head_part.index(target_userinfo) + 3
+                target_row = head_part.index(target_userinfo) + 1
         end_len = len(end_part)
         for n, i in enumerate(end_part):
-            if i.id == target_userinfo.id:
-                target_data_index = len(table_data) + 2
+            if (target_userinfo is not None) and (i.id == target_userinfo.id):
+                target_row = len(table_data)
             table_data.append([total_count - end_len + n + 1, i.name, key(i)])
     else:
         if target_userinfo:
             if target_userinfo not in head_part:
                 table_data.append(["...", "...", "..."])
                 if target_user_rank > 0:
-                    target_data_index = len(table_data) + 2
+                    target_row = len(table_data)
                     table_data.append([target_user_rank, target_userinfo.name, key(target_userinfo)])
             else:
-                target_data_index = head_part.index(target_userinfo) + 3
-    return draw_table(table_data, table_w, 30 * len(table_data), (255, 255, 255, 255), font_stze=13, table_title=title,
-                      draw_colors={target_data_index: "red"})
+                target_row = head_part.index(target_userinfo) + 1
+    return table_data, target_row
+
+
+def _rank_table(head_part: List[m.UserInfo], key: Callable[[m.UserInfo], Any], total_count: int,
+                end_part: Optional[List[m.UserInfo]] = None, title: Optional[str] = None, item_name="数值",
+                target_userinfo: Optional[m.UserInfo] = None, target_user_rank=-1, table_w=350):
+    """
+    参数同 generate_rank_table
+    :return: (表格数据 (均为字符串), 需要标红的行, 宽度, 标题)
+    """
+    table_data, target_row = rank_table_data(head_part, key, total_count, end_part, item_name, target_userinfo,
+                                             target_user_rank)
+    return [[str(j) for j in i] for i in table_data], target_row, table_w, title
+
+
+def draw_rank_tile(table_data: List[List[str]], table_w: int, title: Optional[str],
+                   draw_colors: Optional[Dict[int, Any]] = None):
+    """
+    按 rank_table_data 的表格数据绘制排行表
+    """
+    return draw_table(table_data, table_w, 30 * len(table_data), (255, 255, 255, 255), font_stze=13,
+                      table_title=title, draw_colors=draw_colors)
+
+
+def draw_rank_tile_encoded(table_data: List[List[str]], table_w: int, title: Optional[str]):
+    """
+    在渲染进程中调用的 draw_rank_tile, 不含标红
+    :return: (mode, size, 像素数据), 由 decode_rank_tile 还原
+    """
+    im = draw_rank_tile(table_data, table_w, title)
+    return im.mode, im.size, im.tobytes()
+
+
+def decode_rank_tile(encoded: Tuple[str, Tuple[int, int], bytes]) -> Image.Image:
+    return Image.frombytes(*encoded)
+
+
+def generate_rank_table(head_part: List[m.UserInfo], key: Callable[[m.UserInfo], Any], total_count: int,
+                        end_part: Optional[List[m.UserInfo]] = None, title: Optional[str] = None, item_name="数值",
+                        target_userinfo: Optional[m.UserInfo] = None, target_user_rank=-1, table_w=350,
+                        tile_cache: Optional[RenderCache] = None):
+    """
+    :param tile_cache: 不为 None 时按表格内容缓存不含标红的表格, 内容相同的表格只绘制一次, 标红的行在复制的表格上重新绘制。
+                       结果与不使用缓存时完全相同
+    """
+    return generate_rank_tables([dict(head_part=head_part, key=key, total_count=total_count, end_part=end_part,
+                                      title=title, item_name=item_name, target_userinfo=target_userinfo,
+                                      target_user_rank=target_user_rank, table_w=table_w)], tile_cache)[0]
+
+
+def generate_rank_tables(rank_data: List[Dict[str, Any]], tile_cache: Optional[RenderCache] = None,
+                         draw_tiles: Optional[Callable[[List[Tuple[List[List[str]], int, Optional[str]]]],
+                                                       List[Image.Image]]] = None):
+    """
+    绘制多张排行表, 结果与对每一项调用 generate_rank_table 相同
+    :param rank_data: 每一项为 generate_rank_table 的参数
+    :param tile_cache: 同 generate_rank_table
+    :param draw_tiles: 绘制缓存中没有的表格 (不含标红) 的函数, 参数为 [(表格数据, 宽度, 标题)], 返回对应的图片,
+                       例如 render_pool.RankRenderPool.draw_tiles。为 None 时在当前线程中依次绘制
+    """
+    tables = [_rank_table(**i) for i in rank_data]
+    if (tile_cache is None) and (draw_tiles is None):
+        return [draw_rank_tile(table_data, table_w, title, {} if target_row is None else {target_row + 2: "red"})
+                for table_data, target_row, table_w, title in tables]
+
+    digests = [hashlib.blake2b(repr((table_data, table_w, title)).encode(), digest_size=16).digest()
+               for table_data, _, table_w, title in tables]
+    tiles = {}
+    missing = {}
+    for digest, (table_data, _, table_w, title) in zip(digests, tables):
+        if (digest in tiles) or (digest in missing):
+            continue
+        tile = None if tile_cache is None else tile_cache.get(digest)
+        if tile is None:
+            missing[digest] = (table_data, table_w, title)
+        else:
+            tiles[digest] = tile
+    if missing:
+        if draw_tiles is None:
+            drawn = [draw_rank_tile(*i) for i in missing.values()]
+        else:
+            drawn = draw_tiles(list(missing.values()))
+        for digest, tile in zip(missing, drawn):
+            tiles[digest] = tile
+            if tile_cache is not None:
+                tile_cache.put(digest, tile)
+
+    ret = []
+    for digest, (table_data, target_row, table_w, title) in zip(digests, tables):
+        tile = tiles[digest]
+        if target_row is not None:
+            tile = tile.copy()
+            if not redraw_table_row(tile, table_data, target_row, table_w, 30 * len(table_data), "red",
+                                    font_stze=13, table_title=title):
+                tile = draw_rank_tile(table_data, table_w, title, {target_row + 2: "red"})
+        ret.append(tile)
+    return ret
 
 
 def merge_rank_table_image(ims: List[Image.Image], count_per_line=3, spacing=20):
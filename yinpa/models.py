@@ -1,8 +1,9 @@
 import json
 import random
 import time
+from array import array
 from copy import copy
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 import typing as t
 from enum import Enum
 from . import yinpa_error as err
@@ -64,6 +65,69 @@ class CEnum(Enum):
             ret.value.set_read_only(read_only)
         return ret
 
+class NameIndex:
+    """
+    枚举成员的名称 / id 索引。导入时由成员的名称列表构建, 查找为 O(1); 多个成员使用同一名称时与逐个查找一样取第一个。
+    可在运行时添加别名, 每次修改 version 加一
+    """
+
+    def __init__(self, enum_type: t.Type[Enum], get_keys: t.Callable[[t.Any], t.Iterable[t.Hashable]],
+                 not_found_error: t.Type[err.YinpaError]):
+        self.enum_type = enum_type
+        self.not_found_error = not_found_error
+        self.version = 0
+        self._index: t.Dict[t.Hashable, t.Any] = {}
+        self._aliases: t.Dict[t.Hashable, t.Any] = {}
+        for member in enum_type:
+            for key in get_keys(member):
+                self._index.setdefault(key, member)
+
+    def get(self, key: t.Hashable):
+        ret = self._index.get(key)
+        if ret is None:
+            raise self.not_found_error(key)
+        return ret
+
+    def __contains__(self, key: t.Hashable):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        return self._index.items()
+
+    def add_alias(self, alias: t.Hashable, member):
+        """
+        添加别名。别名已指向其它成员时抛出 YinpaValueError
+        :param alias: 新名称
+        :param member: 别名指向的枚举成员
+        """
+        if not isinstance(member, self.enum_type):
+            raise err.YinpaValueError(f"{member} 不是 {self.enum_type.__name__}")
+        exists = self._index.get(alias)
+        if exists is not None:
+            if exists is member:
+                return
+            raise err.YinpaValueError(f"名称已被使用: {alias}")
+        self._index[alias] = member
+        self._aliases[alias] = member
+        self.version += 1
+
+    def remove_alias(self, alias: t.Hashable):
+        """
+        删除通过 add_alias 添加的别名
+        """
+        if alias not in self._aliases:
+            raise err.YinpaValueError(f"别名不存在: {alias}")
+        del self._aliases[alias]
+        del self._index[alias]
+        self.version += 1
+
+    def get_aliases(self) -> t.Dict[t.Hashable, t.Any]:
+        return dict(self._aliases)
+
+
 class StrengthType(Enum):
     SOFT = 0
     NORMAL = 1
@@ -111,10 +175,11 @@ class DoActionTypes(Enum):
 
     @staticmethod
     def get_action_from_name(name: str):
-        for i in DoActionTypes:
-            if name in i.value.names:
-                return i
-        raise err.ActionNotFoundError(name)
+        return action_names.get(name)
+
+
+action_names = NameIndex(DoActionTypes, lambda i: i.value.names, err.ActionNotFoundError)
+
 
 class ItemTargetTypes(Enum):
     SELF = 0
@@ -234,17 +299,15 @@ class BodyParts(CEnum):
     def get_parts_from_value(value: t.Union[int, None]) -> "BodyParts":
         if value is None:
             raise err.YinpaError("Missing required parameter: body parts")
-        for i in BodyParts:
-            if value == i.value.body_id:
-                return i
-        raise err.BodyNotFoundError(value)
+        return body_parts_ids.get(value)
 
     @staticmethod
     def get_pars_from_name(name: str) -> "BodyParts":
-        for i in BodyParts:
-            if name in i.value.names:
-                return i
-        raise err.BodyNotFoundError(name)
+        return body_parts_names.get(name)
+
+
+body_parts_names = NameIndex(BodyParts, lambda i: i.value.names, err.BodyNotFoundError)
+body_parts_ids = NameIndex(BodyParts, lambda i: [i.value.body_id], err.BodyNotFoundError)
 
 
 class RaceInfo(CanReadOnlyBaseModel):
@@ -332,17 +395,15 @@ class RaceTypes(Enum):
 
     @staticmethod
     def get_race_type_from_id(race_id: t.Optional[t.Union[int, None]]):
-        for i in RaceTypes:
-            if race_id == i.value.race_id:
-                return i
-        raise err.RaceNotFoundError(race_id)
+        return race_ids.get(race_id)
 
     @staticmethod
     def get_race_type_from_name(name: str):
-        for i in RaceTypes:
-            if name == i.value.name:
-                return i
-        raise err.RaceNotFoundError(name)
+        return race_names.get(name)
+
+
+race_names = NameIndex(RaceTypes, lambda i: [i.value.name], err.RaceNotFoundError)
+race_ids = NameIndex(RaceTypes, lambda i: [i.value.race_id], err.RaceNotFoundError)
 
 
 class DressInfo(BaseModel):
@@ -402,17 +463,11 @@ class DressTypes(Enum):
 
     @staticmethod
     def get_dress_from_id(item_id: int):
-        for i in DressTypes:
-            if i.value.item_id == item_id:
-                return i
-        raise err.ItemNotFoundError(item_id)
+        return dress_ids.get(item_id)
 
     @staticmethod
     def get_dress_from_name(item_name: str):
-        for i in DressTypes:
-            if item_name in i.value.item_names:
-                return i
-        raise err.ItemNotFoundError(item_name)
+        return dress_names.get(item_name)
 
     def __eq__(self, other):
         if not isinstance(other, DressTypes):
@@ -423,6 +478,10 @@ class DressTypes(Enum):
         return hash(self.value.item_id)
 
 
+dress_names = NameIndex(DressTypes, lambda i: i.value.item_names, err.ItemNotFoundError)
+dress_ids = NameIndex(DressTypes, lambda i: [i.value.item_id], err.ItemNotFoundError)
+
+
 class UserBodyPartsInfo(BaseModel):
     body_id: int
     base_sensitive: int
@@ -430,10 +489,22 @@ class UserBodyPartsInfo(BaseModel):
     stroke_soft_sensitive: t.Optional[int] = 0  # 轻轻地摸
     stroke_normal_sensitive: t.Optional[int] = 0  # 摸
     stroke_severely_sensitive: t.Optional[int] = 0  # 狠狠地摸
+    _dirty: bool = PrivateAttr(default=True)  # 新建的部位需要写入数据库
 
     def __init__(self, **data):
         super().__init__(**data)
 
+    def __setattr__(self, key, value):
+        if (key in self.__fields__) and (self.__dict__.get(key) != value):
+            self._dirty = True
+        super().__setattr__(key, value)
+
+    def is_dirty(self):
+        return self._dirty
+
+    def clear_dirty(self):
+        self._dirty = False
+
     def get_sensitive(self):
         return self.sensitive + self.base_sensitive
 
@@ -441,10 +512,203 @@ class UserBodyPartsInfo(BaseModel):
     def init_from_body_parts(data: BodyParts):
         return UserBodyPartsInfo(body_id=data.value.body_id, base_sensitive=data.value.base_sensitive)
 
+_BODY_PARTS_ORDER: t.Tuple[BodyParts, ...] = tuple(BodyParts)
+_BODY_PARTS_INDEX: t.Dict[BodyParts, int] = {v: n for n, v in enumerate(_BODY_PARTS_ORDER)}
+BODY_PART_FIELDS = ("base_sensitive", "sensitive", "stroke_soft_sensitive", "stroke_normal_sensitive",
+                    "stroke_severely_sensitive")
+_FIELDS_COUNT = len(BODY_PART_FIELDS)
+
+
+def _stored_value(value: float):
+    return int(value) if value.is_integer() else value
+
+
+def _part_field(column: int):
+    def getter(self: "BodyPartView"):
+        return _stored_value(self._map._values[self._offset + column])
+
+    def setter(self: "BodyPartView", value):
+        body_map = self._map
+        if body_map._values[self._offset + column] != value:
+            body_map._values[self._offset + column] = value
+            body_map._dirty |= 1 << self._index
+    return property(getter, setter)
+
+
+class BodyPartView:
+    """
+    BodyPartsInfoMap 中一个部位的视图, 属性和方法与 UserBodyPartsInfo 相同, 修改会直接写入所属的 BodyPartsInfoMap
+    """
+    __slots__ = ("_map", "_index", "_offset")
+
+    def __init__(self, body_map: "BodyPartsInfoMap", index: int):
+        self._map = body_map
+        self._index = index
+        self._offset = index * _FIELDS_COUNT
+
+    base_sensitive = _part_field(0)
+    sensitive = _part_field(1)
+    stroke_soft_sensitive = _part_field(2)
+    stroke_normal_sensitive = _part_field(3)
+    stroke_severely_sensitive = _part_field(4)
+
+    @property
+    def body_part(self) -> BodyParts:
+        return _BODY_PARTS_ORDER[self._index]
+
+    @property
+    def body_id(self) -> int:
+        return _BODY_PARTS_ORDER[self._index].value.body_id
+
+    def is_dirty(self):
+        return bool(self._map._dirty & (1 << self._index))
+
+    def clear_dirty(self):
+        self._map._dirty &= ~(1 << self._index)
+
+    def get_sensitive(self):
+        return self.sensitive + self.base_sensitive
+
+    def dict(self, **_):
+        ret = {"body_id": self.body_id}
+        for i in BODY_PART_FIELDS:
+            ret[i] = getattr(self, i)
+        return ret
+
+    def copy(self, **_) -> UserBodyPartsInfo:
+        ret = UserBodyPartsInfo.construct(**self.dict())
+        ret._dirty = self.is_dirty()
+        return ret
+
+    def __eq__(self, other):
+        if not isinstance(other, (BodyPartView, UserBodyPartsInfo)):
+            return False
+        return self.dict() == other.dict()
+
+    def __repr__(self):
+        return f"BodyPartView({', '.join(f'{k}={v!r}' for k, v in self.dict().items())})"
+
+
+class BodyPartsInfoMap(t.MutableMapping[BodyParts, BodyPartView]):
+    """
+    用户各部位的敏感度, 与 t.Dict[BodyParts, UserBodyPartsInfo] 用法相同。
+    所有部位的数值按 BodyParts 的顺序保存在一个 array 中, 取值时返回 BodyPartView; 部位是否存在和是否修改用位掩码表示。
+    遍历顺序为 BodyParts 的定义顺序
+    """
+    __slots__ = ("_values", "_present", "_dirty")
+
+    def __init__(self, data: t.Optional[t.Mapping[BodyParts, t.Any]] = None):
+        self._values = array("d", bytes(8 * _FIELDS_COUNT * len(_BODY_PARTS_ORDER)))
+        self._present = 0
+        self._dirty = 0
+        if data:
+            for k, v in data.items():
+                self[k] = v
+
+    def _get_index(self, key: BodyParts) -> int:
+        index = _BODY_PARTS_INDEX.get(key)
+        if (index is None) or (not self._present & (1 << index)):
+            raise KeyError(key)
+        return index
+
+    def __getitem__(self, key: BodyParts) -> BodyPartView:
+        return BodyPartView(self, self._get_index(key))
+
+    def __setitem__(self, key: BodyParts, value: t.Union[UserBodyPartsInfo, BodyPartView, t.Mapping[str, t.Any]]):
+        """
+        :param value: UserBodyPartsInfo 或 BodyPartView 时复制其数值; dict 时按 UserBodyPartsInfo 校验
+        """
+        if isinstance(value, t.Mapping):
+            value = UserBodyPartsInfo(**{"body_id": key.value.body_id, **value})
+        self.set_values(key, *(getattr(value, i) for i in BODY_PART_FIELDS), dirty=value.is_dirty())
+
+    def set_values(self, key: BodyParts, base_sensitive, sensitive=0, stroke_soft_sensitive=0, stroke_normal_sensitive=0,
+                   stroke_severely_sensitive=0, dirty=True):
+        """
+        直接写入一个部位的全部数值
+        """
+        index = _BODY_PARTS_INDEX[key]
+        offset = index * _FIELDS_COUNT
+        self._values[offset:offset + _FIELDS_COUNT] = array("d", (base_sensitive, sensitive, stroke_soft_sensitive,
+                                                                  stroke_normal_sensitive, stroke_severely_sensitive))
+        self._present |= 1 << index
+        if dirty:
+            self._dirty |= 1 << index
+        else:
+            self._dirty &= ~(1 << index)
+
+    def __delitem__(self, key: BodyParts):
+        index = self._get_index(key)
+        self._present &= ~(1 << index)
+        self._dirty &= ~(1 << index)
+
+    def __contains__(self, key):
+        index = _BODY_PARTS_INDEX.get(key)
+        return (index is not None) and bool(self._present & (1 << index))
+
+    def __iter__(self) -> t.Iterator[BodyParts]:
+        present = self._present
+        for n, i in enumerate(_BODY_PARTS_ORDER):
+            if present & (1 << n):
+                yield i
+
+    def __len__(self):
+        return bin(self._present).count("1")
+
+    def clear_dirty(self):
+        self._dirty = 0
+
+    def clear_dirty_synced(self, saved: "BodyPartsInfoMap"):
+        """
+        只清除与 saved 中数值相同的部位的修改标记
+        """
+        for index in range(len(_BODY_PARTS_ORDER)):
+            bit = 1 << index
+            offset = index * _FIELDS_COUNT
+            if (self._dirty & bit) and (saved._present & bit) and \
+                    self._values[offset:offset + _FIELDS_COUNT] == saved._values[offset:offset + _FIELDS_COUNT]:
+                self._dirty &= ~bit
+
+    def truncate_values(self):
+        """
+        将所有数值截断为整数, 与写入数据库后重新读取的结果相同
+        """
+        for n, v in enumerate(self._values):
+            if not v.is_integer():
+                self._values[n] = int(v)
+
+    def to_dict(self) -> t.Dict[BodyParts, t.Dict[str, t.Any]]:
+        return {k: v.dict() for k, v in self.items()}
+
+    def __copy__(self):
+        ret = BodyPartsInfoMap()
+        ret._values = array("d", self._values)
+        ret._present = self._present
+        ret._dirty = self._dirty
+        return ret
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __repr__(self):
+        return f"BodyPartsInfoMap({self.to_dict()!r})"
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if isinstance(value, BodyPartsInfoMap):
+            return value
+        if not isinstance(value, t.Mapping):
+            raise TypeError("body_parts_info must be a mapping")
+        return cls(value)
+
 
 class UserBodyInfo(BaseModel):
     race: RaceTypes
-    body_parts_info: t.Dict[BodyParts, UserBodyPartsInfo]
+    body_parts_info: BodyPartsInfoMap
 
     def __init__(self, **data):
         get_race = data.get("race", None)
@@ -476,10 +740,73 @@ class UserBodyInfo(BaseModel):
                 continue
 
             if not i.value.optional:  # 通用部分
-                self.body_parts_info[i] = UserBodyPartsInfo.init_from_body_parts(i)
+                self.body_parts_info.set_values(i, i.value.base_sensitive)
             else:
                 if i in self.race.value.has_optional_parts:  # 特有部分
-                    self.body_parts_info[i] = UserBodyPartsInfo.init_from_body_parts(i)
+                    self.body_parts_info.set_values(i, i.value.base_sensitive)
+
+    def get_dirty_parts(self) -> t.Dict[BodyParts, BodyPartView]:
+        return {k: v for k, v in self.body_parts_info.items() if v.is_dirty()}
+
+    def dict(self, **kwargs):
+        ret = super().dict(**kwargs)
+        if isinstance(ret.get("body_parts_info"), BodyPartsInfoMap):
+            ret["body_parts_info"] = ret["body_parts_info"].to_dict()
+        return ret
+
+    @classmethod
+    def from_db_rows(cls, race_id: int, parts_rows: t.Iterable[t.Mapping[str, t.Any]]) -> "UserBodyInfo":
+        """
+        由数据库 body_info 的 race 和 body_parts_info 表中的行直接构建, 不经过 pydantic 校验。
+        数值与校验时一样截断为 int, 缺少的部位与 check_body_parts_info 一样补全
+        """
+        race = RaceTypes.get_race_type_from_id(race_id)
+        body_parts_info = BodyPartsInfoMap()
+        for row in parts_rows:
+            body_part = BodyParts.get_parts_from_value(int(row["body_id"]))
+            body_parts_info.set_values(body_part, body_part.value.base_sensitive, _db_int(row["sensitive"]) or 0,
+                                       _db_int(row["stroke_soft_sensitive"]) or 0,
+                                       _db_int(row["stroke_normal_sensitive"]) or 0,
+                                       _db_int(row["stroke_severely_sensitive"]) or 0)
+        for i in _get_race_body_parts(race):
+            if i not in body_parts_info:
+                body_parts_info.set_values(i, i.value.base_sensitive)
+        return cls.construct(race=race, body_parts_info=body_parts_info)
+
+
+_race_body_parts: t.Dict[RaceTypes, t.Tuple[BodyParts, ...]] = {}
+
+
+def _get_race_body_parts(race: RaceTypes) -> t.Tuple[BodyParts, ...]:
+    """
+    种族应有的全部部位 (通用部位 + 特有部位), 第一次使用时计算
+    """
+    ret = _race_body_parts.get(race)
+    if ret is None:
+        ret = tuple(i for i in BodyParts if (not i.value.optional) or (i in race.value.has_optional_parts))
+        _race_body_parts[race] = ret
+    return ret
+
+
+def _db_int(value):
+    return None if value is None else int(value)
+
+
+def _db_float(value):
+    return None if value is None else round_number(float(value))
+
+
+def round_number(value):
+    """
+    UserInfo 中的数值保留 4 位小数
+    """
+    return round(value, 4) if isinstance(value, float) else value
+
+
+def _db_dress_list(value: t.Optional[str]) -> t.List[DressTypes]:
+    if not value:
+        return []
+    return [DressTypes.get_dress_from_id(i) for i in json.loads(value)]
 
 
 class ItemTypes(Enum):
@@ -522,17 +849,15 @@ class ItemTypes(Enum):
 
     @staticmethod
     def get_item_from_id(item_id: int):
-        for i in ItemTypes:
-            if item_id == i.value.id:
-                return i
-        raise err.ItemNotFoundError(item_id)
+        return item_ids.get(item_id)
 
     @staticmethod
     def get_item_from_name(name: str):
-        for i in ItemTypes:
-            if name in i.value.names:
-                return i
-        raise err.ItemNotFoundError(name)
+        return item_names.get(name)
+
+
+item_names = NameIndex(ItemTypes, lambda i: i.value.names, err.ItemNotFoundError)
+item_ids = NameIndex(ItemTypes, lambda i: [i.value.id], err.ItemNotFoundError)
 
 
 class UserInfo(BaseModel):
@@ -563,6 +888,10 @@ class UserInfo(BaseModel):
     temp_sensitive: t.Optional[float] = 0.0
     temp_use_time: t.Optional[float] = 0.0
 
+    _dirty_fields: t.Set[str] = PrivateAttr(default_factory=set)
+    _clean_state: t.Optional[t.Dict[str, t.Any]] = PrivateAttr(default=None)  # 上次与数据库同步时的状态
+    _save_seq: int = PrivateAttr(default=0)  # 保存的次数, 提交后只由最后一次保存清除修改标记
+
     def __init__(self, **data):
         get_sex = data.get("sex", None)
         if not isinstance(get_sex, BaseSex):
@@ -592,10 +921,75 @@ class UserInfo(BaseModel):
         data["own_dress"] = new_own_dress_list
 
         super().__init__(**data)
+        for k in NUMBER_FIELDS:
+            self.__dict__[k] = round_number(self.__dict__.get(k))
         if self.chest_size < 0:
             self.chest_size = 0.0
         self.update_prostitution()
 
+    @classmethod
+    def from_db_row(cls, row: t.Mapping[str, t.Any], body_info: UserBodyInfo) -> "UserInfo":
+        """
+        由数据库 users 表中的行直接构建, 不经过 pydantic 校验。只用于读取本模块写入的数据, 结果与 UserInfo(**row) 相同
+        """
+        items = {ItemTypes.get_item_from_id(int(k)): int(v) for k, v in json.loads(row["items"] or "{}").items()}
+        chest_size = _db_float(row["chest_size"])
+        ret = cls.construct(
+            id=int(row["id"]), name=str(row["name"]), sex=BaseSex.get_sex_from_value(row["sex"]),
+            hp=int(row["hp"]), chest_size=chest_size if chest_size >= 0 else 0.0,
+            length=_db_float(row["length"]), length2=_db_float(row["length2"]), depth=_db_float(row["depth"]),
+            prostitution=_db_float(row["prostitution"]), persistance=_db_float(row["persistance"]),
+            body_info=body_info, worn_dress=_db_dress_list(row["worn_dress"]),
+            own_dress=_db_dress_list(row["own_dress"]),
+            injected_vol=_db_float(row["injected_vol"]), injected_count=_db_int(row["injected_count"]),
+            shoot_vol=_db_float(row["shoot_vol"]), shoot_count=_db_int(row["shoot_count"]),
+            last_update_hp=int(row["last_update_hp"]),
+            active_time=_db_float(row["active_time"]), passive_time=_db_float(row["passive_time"]),
+            items=items, temp_sensitive=_db_float(row["temp_sensitive"]), temp_use_time=_db_float(row["temp_use_time"])
+        )
+        ret.update_prostitution()
+        return ret
+
+    def is_new(self):
+        """
+        是否从未与数据库同步过 (新建用户)
+        """
+        return self._clean_state is None
+
+    def get_dirty_fields(self) -> t.Set[str]:
+        """
+        获取自上次同步后发生变化的字段。items 和 dress 可能被原地修改，因此和同步时的状态做比较。
+        body_info 只检查 race，部位的变化见 UserBodyInfo.get_dirty_parts
+        """
+        ret = set(self._dirty_fields)
+        if self._clean_state is not None:
+            if self.items != self._clean_state["items"]:
+                ret.add("items")
+            if self.worn_dress != self._clean_state["worn_dress"]:
+                ret.add("worn_dress")
+            if self.own_dress != self._clean_state["own_dress"]:
+                ret.add("own_dress")
+            if self.body_info.race != self._clean_state["race"]:
+                ret.add("race")
+        return ret
+
+    def clear_dirty(self):
+        """
+        标记为已与数据库同步
+        """
+        self._dirty_fields.clear()
+        self._clean_state = {"items": dict(self.items), "worn_dress": list(self.worn_dress),
+                             "own_dress": list(self.own_dress), "race": self.body_info.race}
+        self.body_info.body_parts_info.clear_dirty()
+
+    def mark_synced(self, saved: "UserInfo"):
+        """
+        标记为已与数据库同步到 saved 的状态 (保存时复制的对象, 已 clear_dirty)。保存之后又修改过的字段和部位仍然标记为已修改
+        """
+        self._dirty_fields = {k for k in self._dirty_fields if self.__dict__.get(k) != saved.__dict__.get(k)}
+        self._clean_state = dict(saved._clean_state)
+        self.body_info.body_parts_info.clear_dirty_synced(saved.body_info.body_parts_info)
+
     def items_to_dict(self):
         ret = {}
         for k in self.items:
@@ -641,6 +1035,18 @@ class UserInfo(BaseModel):
         else:
             return v1 == v2
 
+    def get_length_signs(self) -> t.FrozenSet[SignTypes]:
+        """
+        长度的符号, 与 check_have_body_part 中 need_length_sign 的判断方式相同。DOUBLE 包含 length 和 length2 的符号
+        """
+        if self.sex == BaseSex.SINGLE:
+            values = [self.length]
+        elif self.sex == BaseSex.DOUBLE:
+            values = [self.length, self.length2]
+        else:
+            return frozenset()
+        return frozenset(i for i in SignTypes for v in values if self.check_value(v, 0, i))
+
     def check_have_body_part(self, part: BodyParts):
         if part not in self.body_info.body_parts_info:
             return False
@@ -666,47 +1072,85 @@ class UserInfo(BaseModel):
                 return False
         return True
 
-    def use_item(self, item_info: ItemTypes):
-        """
-        注意：此方法不会检查物品数量，请在调用此方法前手动检查！
-        """
-        if self.sex not in item_info.value.need_sex:
+    def _check_item_usable(self, item_info: ItemTypes, sex: BaseSex, length: float):
+        if sex not in item_info.value.need_sex:
             raise err.YinpaUserError(f"用户: {self.name} 无法使用此道具。")
-        if self.sex.isSingle():
+        if sex.isSingle():
             if item_info.value.man_only:
-                if self.length <= 0:
+                if length <= 0:
                     raise err.YinpaUserError(f"用户: {self.name} 无法使用此道具。此道具为男性专用。")
             elif item_info.value.woman_only:
-                if self.length >= 0:
+                if length >= 0:
                     raise err.YinpaUserError(f"用户: {self.name} 无法使用此道具。此道具为女性专用。")
-        for i in item_info.value.effects:
+
+    def use_item(self, item_info: ItemTypes, count=1):
+        """
+        注意：此方法不会检查物品数量，请在调用此方法前手动检查！
+        使用多个时效果合并计算: 加减的效果乘以 count, 直接替换的效果只设置一次。
+        可用条件只与 sex 和 length 有关, length 随使用次数线性变化 (或在第一次使用后不再变化),
+        因此只需检查第一次和最后一次使用前的状态。同一属性有多个效果时逐个使用
+        :param count: 使用数量
+        """
+        effects = item_info.value.effects
+        if count == 1 or len({i.key for i in effects}) != len(effects):
+            for _ in range(count):
+                self._check_item_usable(item_info, self.sex, self.length)
+                for i in effects:
+                    if i.is_set:
+                        set_value = i.value
+                    else:
+                        set_value = getattr(self, i.key) + i.value
+                    setattr(self, i.key, set_value)
+            return item_info
+
+        self._check_item_usable(item_info, self.sex, self.length)
+        if count > 1:
+            last_state = {"sex": self.sex, "length": self.length}  # 最后一次使用前的状态
+            for i in effects:
+                if i.key in last_state:
+                    last_state[i.key] = i.value if i.is_set else last_state[i.key] + i.value * (count - 1)
+            self._check_item_usable(item_info, last_state["sex"], last_state["length"])
+        for i in effects:
             if i.is_set:
                 set_value = i.value
             else:
-                set_value = getattr(self, i.key) + i.value
+                set_value = getattr(self, i.key) + i.value * count
             setattr(self, i.key, set_value)
         return item_info
 
+    def recover_hp(self):
+        """
+        根据 hp 和 last_update_hp 计算自然恢复后的体力。只修改内存中的数据，保存用户时一并写入
+        """
+        now_hp = self.hp + int((int(time.time()) - self.last_update_hp) / cfg.unit_hp_recovery_seconds)
+        if now_hp > cfg.max_hp:
+            now_hp = cfg.max_hp
+        if now_hp != self.hp:
+            self.hp = now_hp
+        return now_hp
+
     def update_prostitution(self):
-        value = (self.shoot_vol + self.injected_vol) / 1000 * (self.injected_count + self.shoot_count) + \
-                (self.active_time + self.passive_time) / 60
+        value = self.calc_prostitution(self.shoot_vol, self.injected_vol, self.injected_count, self.shoot_count,
+                                       self.active_time, self.passive_time)
         self.prostitution = value
         return value
 
+    @staticmethod
+    def calc_prostitution(shoot_vol, injected_vol, injected_count, shoot_count, active_time, passive_time):
+        return (shoot_vol + injected_vol) / 1000 * (injected_count + shoot_count) + (active_time + passive_time) / 60
+
     def __setattr__(self, key, value):
         if key == "hp":
             self.last_update_hp = int(time.time())
         elif key == "chest_size":
             if value < 0:
                 value = 0
+        if key in NUMBER_FIELDS:
+            value = round_number(value)
+        if (key in self.__fields__) and (self.__dict__.get(key) != value):
+            self._dirty_fields.add(key)
         super().__setattr__(key, value)
 
-    def __getattribute__(self, item):
-        ret = super().__getattribute__(item)
-        if isinstance(ret, float):
-            return round(ret, 4)
-        return ret
-
     def __eq__(self, other):
         if not isinstance(other, UserInfo):
             return False
@@ -737,6 +1181,18 @@ class UserInfo(BaseModel):
         return UserInfo(**values)
 
 
+# 数值字段, 赋值时保留 4 位小数
+NUMBER_FIELDS = frozenset(k for k, v in UserInfo.__fields__.items() if v.outer_type_ in (int, float))
+
+
+class YinpaCommand(BaseModel):
+    action: DoActionTypes
+    body_part: BodyParts
+    strength: StrengthType
+    target_user_id: t.Optional[int] = None  # 为 None 时对象由 @ 指定
+    target_name: t.Optional[str] = None
+
+
 class ReturnYinpaData(BaseModel):
     self_data: UserInfo
     target_data: UserInfo
@@ -0,0 +1,521 @@
+"""
+排行榜计算。只读取参与排行的列, 所有排行表的前后若干名和指定用户的名次在一次载入的数据上计算。
+安装了 numpy 时使用 argpartition 和向量比较, 否则使用 heapq; 两者结果相同, 与 heapq.nlargest / nsmallest 一样数值相同时 id 小的在前。
+按群排行 (calc_group_ranks) 直接在数据库中查询; 全体排行可以使用随写入更新的 RankStore
+"""
+import heapq
+import itertools
+import math
+import operator
+import threading
+import typing as t
+from array import array
+from bisect import bisect_left, bisect_right
+
+from . import database
+from . import models as m
+from . import yinpa_tools
+
+try:
+    import numpy as np
+except ImportError:  # numpy 为可选依赖
+    np = None
+
+_SINGLE = m.BaseSex.SINGLE.value
+
+
+
+class RankGroup(t.NamedTuple):
+    check: t.Optional[t.Callable[[t.Any, t.Any], t.Any]]  # 参数为性别值和长度, 同时支持单个数值和 numpy 数组
+    sql: t.Optional[str]  # 相同的条件, 用于按群排行的查询
+
+# 参与各排行的用户, 条件为 None 时为所有用户
+RANK_GROUPS: t.Dict[str, RankGroup] = {
+    "all": RankGroup(None, None),
+    "length": RankGroup(lambda sex, length: (sex == _SINGLE) & (length >= 0),  # 单 - 男
+                        f"users.sex = {_SINGLE} AND users.length >= 0"),
+    "depth": RankGroup(lambda sex, length: (sex == _SINGLE) & (length < 0),  # 单 - 女
+                       f"users.sex = {_SINGLE} AND users.length < 0"),
+    "chest": RankGroup(lambda sex, length: (sex != _SINGLE) | (length < 0),  # 除 单 - 男 以外
+                       f"users.sex != {_SINGLE} OR users.length < 0"),
+}
+
+
+class RankBoard(t.NamedTuple):
+    title: str
+    item_name: str
+    column: str  # users 表中参与排行的列
+    group: str = "all"  # RANK_GROUPS 中的键
+    descending: bool = True  # 为 False 时数值小的排在前面
+    half: bool = False  # 为 True 时前后各显示 count_limit / 2 名, 否则只显示前 count_limit 名
+    display: t.Optional[t.Callable[[m.UserInfo], t.Any]] = None  # 表中显示的值, 为 None 时显示 column 的值
+
+    def get_display(self) -> t.Callable[[m.UserInfo], t.Any]:
+        return self.display if self.display is not None else operator.attrgetter(self.column)
+
+
+RANK_BOARDS: t.List[RankBoard] = [
+    RankBoard("长度排行", "长度 (cm)", "length", group="length", half=True),
+    RankBoard("深度排行", "深度 (cm)", "length", group="depth", descending=False, half=True),
+    RankBoard("持久排行", "持久 (s)", "persistance", half=True),
+    RankBoard("欧派排行", "大小", "chest_size", group="chest", half=True,
+              display=lambda u: f"{u.chest_size} ({yinpa_tools.chest_size_to_cup(u.chest_size)})"),
+    RankBoard("被注入量排行", "被注入量 (ml)", "injected_vol"),
+    RankBoard("发射量排行", "发射量 (ml)", "shoot_vol"),
+    RankBoard("被透次数排行", "被透次数", "injected_count"),
+    RankBoard("透人次数排行", "透人次数", "shoot_count"),
+    RankBoard("透人总时长排行", "透人时长 (s)", "active_time"),
+    RankBoard("被透总时长排行", "被透时长 (s)", "passive_time"),
+    RankBoard("引乱排行", "引乱度", "prostitution"),
+]
+
+
+class RankResult(t.NamedTuple):
+    board: RankBoard
+    head_ids: t.List[int]
+    end_ids: t.Optional[t.List[int]]  # 由前到后排列, 只有 board.half 为 True 时有值
+    total_count: int
+    target_rank: int  # 指定用户不存在或不参与此排行时为 0
+
+
+def get_rank_columns(boards: t.Sequence[RankBoard] = None) -> t.Tuple[str, ...]:
+    """
+    排行需要读取的列, 前三列固定为 id, sex, length
+    """
+    ret = {"id": None, "sex": None, "length": None}
+    for i in (RANK_BOARDS if boards is None else boards):
+        ret[i.column] = None
+    return tuple(ret)
+
+
+def calc_ranks(rows: t.Sequence[t.Sequence[t.Any]], target: t.Optional[m.UserInfo], count_limit=40,
+               boards: t.Sequence[RankBoard] = None, use_numpy: t.Optional[bool] = None) -> t.List[RankResult]:
+    """
+    计算所有排行表
+    :param rows: 按 id 排序的行, 列为 get_rank_columns(boards)
+    :param target: 需要计算名次的用户
+    :param boards: 为 None 时使用 RANK_BOARDS
+    :param use_numpy: 为 None 时安装了 numpy 就使用
+    """
+    if boards is None:
+        boards = RANK_BOARDS
+    columns = get_rank_columns(boards)
+    if use_numpy is None:
+        use_numpy = np is not None
+    engine = _NumpyEngine(rows, columns) if use_numpy else _PythonEngine(rows, columns)
+    target_values = _target_values(target, columns, None if target is None else engine.get_row(target.id))
+
+    ret = []
+    for board in boards:
+        members = engine.get_members(board.group)
+        total_count = engine.count(members)
+        show_count = int(count_limit / 2) if board.half else count_limit
+        head_ids = engine.top(members, board.column, show_count, board.descending)
+        end_ids = None
+        if board.half:
+            end_ids = engine.top(members, board.column, show_count, not board.descending)
+            end_ids.reverse()
+
+        target_rank = 0
+        if _in_group(board, target_values):
+            target_rank = engine.count_before(members, board.column, target_values[board.column],
+                                              board.descending) + 1
+        ret.append(RankResult(board, head_ids, end_ids, total_count, target_rank))
+    return ret
+
+
+def calc_group_ranks(db: "database.YinpaDB", group_id: int, target: t.Optional[m.UserInfo], count_limit=40,
+                     boards: t.Sequence[RankBoard] = None) -> t.List[RankResult]:
+    """
+    计算群内的所有排行表。筛选、排序、LIMIT 和名次 (COUNT) 都在 SQL 中完成, 耗时只与群人数有关。结果与 calc_ranks 相同
+    :param group_id: group_members 中的群号
+    """
+    if boards is None:
+        boards = RANK_BOARDS
+    columns = get_rank_columns(boards)
+    target_values = _target_values(target, columns, None if target is None else db.get_user_row(target.id, columns))
+
+    ret = []
+    for board in boards:
+        where = RANK_GROUPS[board.group].sql
+        total_count = db.count_group_users(group_id, where)
+        show_count = int(count_limit / 2) if board.half else count_limit
+        head_ids = db.get_group_top_users(group_id, board.column, show_count, board.descending, where) \
+            if show_count > 0 else []
+        end_ids = None
+        if board.half:
+            end_ids = db.get_group_top_users(group_id, board.column, show_count, not board.descending, where) \
+                if show_count > 0 else []
+            end_ids.reverse()
+
+        target_rank = 0
+        if _in_group(board, target_values):
+            target_rank = db.count_group_users(group_id, where, board.column, target_values[board.column],
+                                               board.descending) + 1
+        ret.append(RankResult(board, head_ids, end_ids, total_count, target_rank))
+    return ret
+
+
+def calc_user_ranks(db: "database.YinpaDB", target: m.UserInfo, group_id: t.Optional[int] = None,
+                    boards: t.Sequence[RankBoard] = None) -> t.Dict[str, int]:
+    """
+    指定用户在各排行中的名次, 使用 YinpaDB.get_user_ranks, 不读取其他用户。名次与 calc_ranks 相同
+    :param group_id: 只统计此群的成员
+    :return: {排行标题: 名次}, 不参与的排行为 0
+    """
+    if boards is None:
+        boards = RANK_BOARDS
+    target_values = _target_values(target, ("sex", "length"), db.get_user_row(target.id, ("sex", "length")))
+    ret = {i.title: 0 for i in boards}
+    queries: t.Dict[t.Tuple[str, bool], t.List[RankBoard]] = {}  # 条件相同的排行一起查询
+    for board in boards:
+        if _in_group(board, target_values):
+            queries.setdefault((board.group, board.descending), []).append(board)
+    for (group, descending), group_boards in queries.items():
+        ranks = db.get_user_ranks(target.id, list(dict.fromkeys(i.column for i in group_boards)), group_id,
+                                  descending, RANK_GROUPS[group].sql)
+        for board in group_boards:
+            ret[board.title] = ranks[board.column]
+    return ret
+
+
+def _target_values(target: t.Optional[m.UserInfo], columns: t.Sequence[str],
+                   row: t.Optional[t.Sequence[t.Any]]) -> t.Optional[t.Dict[str, t.Any]]:
+    """
+    指定用户参与排行的数值。数据库中的数值可能没有舍入 (例如旧版本在 SQL 中累加的结果), 而 UserInfo 中的数值已保留 4 位小数,
+    所以使用与其他用户同一来源的原始数值, 用户不在数据中时才使用 UserInfo 的值
+    :param row: 用户在数据中的行, 列为 columns; 不存在时为 None
+    """
+    if target is None:
+        return None
+    if row is not None:
+        return dict(zip(columns, row))
+    return {i: target.sex.value if i == "sex" else getattr(target, i) for i in columns}
+
+
+def _in_group(board: RankBoard, target_values: t.Optional[t.Mapping[str, t.Any]]):
+    if target_values is None:
+        return False
+    group_check = RANK_GROUPS[board.group].check
+    return (group_check is None) or bool(group_check(target_values["sex"], target_values["length"]))
+
+
+class _NumpyEngine:
+    def __init__(self, rows, columns: t.Sequence[str]):
+        data = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64,
+                           count=len(rows) * len(columns)).reshape(len(rows), len(columns))
+        self.ids = data[:, 0].astype(np.int64)
+        self.columns = {v: data[:, n] for n, v in enumerate(columns)}
+        self._members: t.Dict[str, t.Optional[np.ndarray]] = {}
+
+    def get_members(self, group: str):
+        """
+        :return: 参与排行用户的下标数组, 所有用户时为 None
+        """
+        if group not in self._members:
+            group_check = RANK_GROUPS[group].check
+            self._members[group] = None if group_check is None else \
+                np.flatnonzero(group_check(self.columns["sex"], self.columns["length"]))
+        return self._members[group]
+
+    def count(self, members):
+        return len(self.ids) if members is None else len(members)
+
+    def get_row(self, user_id: int) -> t.Optional[t.List[t.Any]]:
+        """
+        :return: 用户的各列数值, 与 columns 对应; 不存在时为 None
+        """
+        pos = int(np.searchsorted(self.ids, user_id))
+        if (pos == len(self.ids)) or (self.ids[pos] != user_id):
+            return None
+        return [i[pos].item() for i in self.columns.values()]
+
+    def _values(self, members, column: str):
+        values = self.columns[column]
+        return values if members is None else values[members]
+
+    def top(self, members, column: str, k: int, descending: bool) -> t.List[int]:
+        values = self._values(members, column)
+        if k <= 0 or len(values) == 0:
+            return []
+        key = -values if descending else values
+        if k < len(key):
+            # argpartition 不保证并列值的取舍, 比分界值小的全部保留, 等于分界值的按下标取够 k 个
+            threshold = key[np.argpartition(key, k - 1)[k - 1]]
+            less = np.flatnonzero(key < threshold)
+            pos = np.concatenate((less, np.flatnonzero(key == threshold)[:k - len(less)]))
+        else:
+            pos = np.arange(len(key))
+        pos = pos[np.argsort(key[pos], kind="stable")]
+        if members is not None:
+            pos = members[pos]
+        return self.ids[pos].tolist()
+
+    def count_before(self, members, column: str, value, descending: bool) -> int:
+        values = self._values(members, column)
+        return int(np.count_nonzero(values > value if descending else values < value))
+
+
+class _PythonEngine:
+    def __init__(self, rows, columns: t.Sequence[str]):
+        self.ids = [i[0] for i in rows]
+        self.columns = {v: [i[n] for i in rows] for n, v in enumerate(columns)}
+        self._members: t.Dict[str, t.Optional[t.List[int]]] = {}
+
+    def get_members(self, group: str):
+        if group not in self._members:
+            group_check = RANK_GROUPS[group].check
+            self._members[group] = None if group_check is None else \
+                [n for n, (s, l) in enumerate(zip(self.columns["sex"], self.columns["length"])) if group_check(s, l)]
+        return self._members[group]
+
+    def count(self, members):
+        return len(self.ids) if members is None else len(members)
+
+    def get_row(self, user_id: int) -> t.Optional[t.List[t.Any]]:
+        pos = bisect_left(self.ids, user_id)
+        if (pos == len(self.ids)) or (self.ids[pos] != user_id):
+            return None
+        return [i[pos] for i in self.columns.values()]
+
+    def top(self, members, column: str, k: int, descending: bool) -> t.List[int]:
+        values = self.columns[column]
+        func = heapq.nlargest if descending else heapq.nsmallest
+        return [self.ids[i] for i in func(k, range(len(values)) if members is None else members,
+                                          key=values.__getitem__)]
+
+    def count_before(self, members, column: str, value, descending: bool) -> int:
+        values = self.columns[column]
+        if members is not None:
+            values = [values[i] for i in members]
+        return sum(1 for i in values if (i > value if descending else i < value))
+
+
+class _SortedEntries:
+    """
+    按 (排序键, id) 有序的条目, 分块存放在数组中 (与 sortedcontainers.SortedList 相同的做法)。
+    插入删除只移动一个块内的数据, 定位为 O(log n), 按位置取数据需要累加之前各块的长度
+    """
+    _LOAD = 1000  # 块的大小, 超过两倍时拆分
+
+    def __init__(self, entries: t.Sequence[t.Tuple[float, int]] = ()):
+        """
+        :param entries: 已排序的条目
+        """
+        self._keys: t.List[array] = []
+        self._ids: t.List[array] = []
+        self._maxes: t.List[t.Tuple[float, int]] = []  # 每块最后一个条目
+        self._len = len(entries)
+        for i in range(0, len(entries), self._LOAD):
+            chunk = entries[i:i + self._LOAD]
+            self._keys.append(array("d", (k for k, _ in chunk)))
+            self._ids.append(array("q", (u for _, u in chunk)))
+            self._maxes.append(chunk[-1])
+
+    def __len__(self):
+        return self._len
+
+    def _locate(self, key: float, user_id: int) -> t.Tuple[int, int]:
+        chunk = bisect_left(self._maxes, (key, user_id))
+        if chunk == len(self._maxes):
+            chunk -= 1
+        keys = self._keys[chunk]
+        lo = bisect_left(keys, key)
+        hi = bisect_right(keys, key, lo)
+        return chunk, bisect_left(self._ids[chunk], user_id, lo, hi)  # 并列的范围内按 id 有序
+
+    def insert(self, key: float, user_id: int):
+        if not self._keys:
+            self._keys.append(array("d", [key]))
+            self._ids.append(array("q", [user_id]))
+            self._maxes.append((key, user_id))
+            self._len = 1
+            return
+        chunk, pos = self._locate(key, user_id)
+        keys = self._keys[chunk]
+        ids = self._ids[chunk]
+        keys.insert(pos, key)
+        ids.insert(pos, user_id)
+        self._len += 1
+        if len(keys) > self._LOAD * 2:
+            self._keys[chunk:chunk + 1] = [keys[:self._LOAD], keys[self._LOAD:]]
+            self._ids[chunk:chunk + 1] = [ids[:self._LOAD], ids[self._LOAD:]]
+            self._maxes[chunk:chunk + 1] = [(keys[self._LOAD - 1], ids[self._LOAD - 1]), (keys[-1], ids[-1])]
+        else:
+            self._maxes[chunk] = (keys[-1], ids[-1])
+
+    def remove(self, key: float, user_id: int):
+        chunk, pos = self._locate(key, user_id)
+        keys = self._keys[chunk]
+        ids = self._ids[chunk]
+        if pos == len(keys) or keys[pos] != key or ids[pos] != user_id:
+            raise KeyError((key, user_id))
+        del keys[pos]
+        del ids[pos]
+        self._len -= 1
+        if keys:
+            self._maxes[chunk] = (keys[-1], ids[-1])
+        else:
+            del self._keys[chunk], self._ids[chunk], self._maxes[chunk]
+
+    def count_less(self, key: float) -> int:
+        chunk = bisect_left(self._maxes, (key,))
+        ret = sum(len(i) for i in self._keys[:chunk])
+        if chunk < len(self._keys):
+            ret += bisect_left(self._keys[chunk], key)
+        return ret
+
+    def count_less_equal(self, key: float) -> int:
+        chunk = bisect_left(self._maxes, (key, math.inf))
+        ret = sum(len(i) for i in self._keys[:chunk])
+        if chunk < len(self._keys):
+            ret += bisect_right(self._keys[chunk], key)
+        return ret
+
+    def slice(self, start: int, stop: int) -> t.List[t.Tuple[float, int]]:
+        ret = []
+        offset = 0
+        for keys, ids in zip(self._keys, self._ids):
+            if offset >= stop:
+                break
+            if offset + len(keys) > start:
+                lo = max(start - offset, 0)
+                hi = min(stop - offset, len(keys))
+                ret.extend(zip(keys[lo:hi], ids[lo:hi]))
+            offset += len(keys)
+        return ret
+
+
+class RankStore:
+    """
+    常驻内存的全体排行数据, 通过 YinpaDB.add_change_listener 随每次写入更新, 结果与 calc_ranks 相同。
+    每张排行表的条目按 (排序键, id) 分块有序存放, 更新和查询名次为 O(log n), 取前 k 名为 O(k)
+    """
+
+    def __init__(self, boards: t.Sequence[RankBoard] = None):
+        self.boards = list(RANK_BOARDS if boards is None else boards)
+        self.columns = get_rank_columns(self.boards)
+        self._column_indexes = {v: n for n, v in enumerate(self.columns)}
+        self._lock = threading.Lock()
+        self._users: t.Dict[int, array] = {}  # id -> self.columns 的值 (不含 id)
+        self._entries: t.List[_SortedEntries] = [_SortedEntries() for _ in self.boards]
+
+    def _entry(self, board: RankBoard, values: array) -> t.Optional[float]:
+        """
+        :return: 用户在此排行中的排序键, 不参与此排行时为 None
+        """
+        group_check = RANK_GROUPS[board.group].check
+        if (group_check is not None) and not group_check(values[0], values[1]):
+            return None
+        value = values[self._column_indexes[board.column] - 1]
+        return -value if board.descending else value
+
+    def rebuild(self, load_rows: t.Callable[[t.Sequence[str]], t.Iterable[t.Sequence[t.Any]]]):
+        """
+        由数据库重新构建, 用于初始化和恢复。读取期间的更新等待构建完成后再应用
+        :param load_rows: 读取指定列的所有行, 例: db.get_user_columns
+        """
+        with self._lock:
+            users = {}
+            entries = [[] for _ in self.boards]
+            for row in load_rows(self.columns):
+                values = array("d", row[1:])
+                users[int(row[0])] = values
+                for n, board in enumerate(self.boards):
+                    key = self._entry(board, values)
+                    if key is not None:
+                        entries[n].append((key, int(row[0])))
+            for i in entries:
+                i.sort()
+            self._users = users
+            self._entries = [_SortedEntries(i) for i in entries]
+
+    def on_change(self, user_id: int, values: t.Optional[t.Dict[str, t.Any]]):
+        """
+        YinpaDB.add_change_listener 的回调
+        """
+        if values is None:
+            self.remove(user_id)
+        else:
+            self.update(user_id, values)
+
+    def update(self, user_id: int, values: t.Mapping[str, t.Any]):
+        """
+        :param values: 变化的列, 可以只包含部分列; 不在排行中的用户需要包含全部列, 否则忽略 (例如已删除的用户)
+        """
+        with self._lock:
+            old_values = self._users.get(user_id)
+            if old_values is None:
+                if not all(i in values for i in self.columns[1:]):
+                    return
+                new_values = array("d", (values[i] for i in self.columns[1:]))
+            else:
+                new_values = array("d", old_values)
+                for k, v in values.items():
+                    index = self._column_indexes.get(k, 0)
+                    if index > 0:
+                        new_values[index - 1] = v
+                if new_values == old_values:
+                    return
+            for board, entries in zip(self.boards, self._entries):
+                old_key = None if old_values is None else self._entry(board, old_values)
+                new_key = self._entry(board, new_values)
+                if old_key == new_key:
+                    continue
+                if old_key is not None:
+                    entries.remove(old_key, user_id)
+                if new_key is not None:
+                    entries.insert(new_key, user_id)
+            self._users[user_id] = new_values
+
+    def remove(self, user_id: int):
+        with self._lock:
+            old_values = self._users.pop(user_id, None)
+            if old_values is None:
+                return
+            for board, entries in zip(self.boards, self._entries):
+                old_key = self._entry(board, old_values)
+                if old_key is not None:
+                    entries.remove(old_key, user_id)
+
+    def __len__(self):
+        return len(self._users)
+
+    def calc_ranks(self, target: t.Optional[m.UserInfo], count_limit=40) -> t.List[RankResult]:
+        """
+        参数和结果与 calc_ranks 相同
+        """
+        ret = []
+        with self._lock:
+            row = None if target is None else self._users.get(target.id)
+            target_values = _target_values(target, self.columns, None if row is None else [target.id, *row])
+            for board, entries in zip(self.boards, self._entries):
+                show_count = int(count_limit / 2) if board.half else count_limit
+                head_ids = [i[1] for i in entries.slice(0, show_count)] if show_count > 0 else []
+                end_ids = self._bottom_ids(entries, show_count) if board.half else None
+
+                target_rank = 0
+                if _in_group(board, target_values):
+                    value = target_values[board.column]
+                    target_rank = entries.count_less(-value if board.descending else value) + 1
+                ret.append(RankResult(board, head_ids, end_ids, len(entries), target_rank))
+        return ret
+
+    @staticmethod
+    def _bottom_ids(entries: _SortedEntries, k: int) -> t.List[int]:
+        """
+        排序键最大的 k 个 (并列时 id 小的优先), 由前到后排列, 与 calc_ranks 的 end_ids 相同
+        """
+        count = len(entries)
+        if k <= 0:
+            return []
+        if k >= count:
+            picked = entries.slice(0, count)
+        else:
+            threshold = entries.slice(count - k, count - k + 1)[0][0]
+            start = entries.count_less(threshold)
+            end = entries.count_less_equal(threshold)
+            picked = entries.slice(start, start + k - (count - end)) + entries.slice(end, count)  # 并列的部分取 id 小的
+        picked.sort(key=lambda i: (-i[0], i[1]))
+        picked.reverse()
+        return [i[1] for i in picked]
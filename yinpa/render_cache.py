@@ -0,0 +1,77 @@
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+from PIL import Image
+
+
+def image_nbytes(im: Image.Image) -> int:
+    """
+    图片像素数据占用的字节数
+    """
+    return im.width * im.height * len(im.getbands())
+
+
+class RenderCache:
+    """
+    生成的图片的 LRU 缓存。缓存项记录生成前的数据版本 (YinpaDB.data_version), 版本变化后失效, 也可以设置过期时间。
+    按图片占用的字节数限制总大小。取出的是缓存中的对象, 调用方不要修改
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = 0):
+        """
+        :param max_bytes: 缓存的最大字节数, 为 0 时不缓存
+        :param ttl: 过期秒数, 为 0 时只在数据版本变化时失效
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[t.Hashable, t.Tuple[int, float, Image.Image, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: t.Hashable, version=0) -> t.Optional[Image.Image]:
+        """
+        :param version: 当前的数据版本。按内容生成键的缓存不需要版本
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                item_version, created, image, _ = item
+                if (item_version == version) and ((self.ttl <= 0) or (time.monotonic() - created < self.ttl)):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return image
+                self._pop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key: t.Hashable, image: Image.Image, version=0):
+        """
+        :param version: 生成图片前读取的数据版本。生成期间发生写入时, 这一项在下次 get 时失效
+        """
+        size = image_nbytes(image)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (version, time.monotonic(), image, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, key: t.Hashable):
+        self._bytes -= self._data.pop(key)[3]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes}
@@ -0,0 +1,64 @@
+import multiprocessing
+import threading
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from . import image_generate
+
+
+class RankRenderPool:
+    """
+    在进程池中绘制排行表。只向渲染进程发送表格的文字内容, 取回像素数据后在当前进程中合并。
+    没有启动、系统不支持 fork 或渲染进程异常退出后, 在当前线程中依次绘制。
+
+    渲染进程只能用 fork 创建: spawn / forkserver 的子进程要导入 yinpa 才能取得绘制函数, 而导入 yinpa 会打开数据库。
+    fork 只复制调用的线程, 其它线程当时持有的锁 (数据库写线程、aio 线程池、SQLite 连接、日志等) 在子进程中会一直保持锁定,
+    子进程用到时就会死锁, Python 3.12 起也会对多线程进程的 fork 发出警告。所以渲染进程只在 start 时一次全部创建,
+    start 需要在启动任何线程之前调用 (yinpa_main 在创建数据库之前调用); 进程池损坏后不会在多线程的进程中重新创建
+    """
+
+    def __init__(self, processes: int):
+        """
+        :param processes: 渲染进程数, 为 0 时不使用进程池
+        """
+        self.processes = processes
+        self._executor: t.Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        创建全部渲染进程。只能在当前进程还没有其它线程时调用, 见类的说明
+        """
+        with self._lock:
+            if (self._executor is not None) or (self.processes <= 0) or \
+                    ("fork" not in multiprocessing.get_all_start_methods()):
+                return
+            image_generate.preload_fonts((13, 14))  # 子进程直接继承已加载的字体
+            executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("fork"))
+            # 使用 fork 时, 第一次提交任务会在启动管理线程之前创建全部进程
+            executor.submit(int).result()
+            self._executor = executor
+
+    def draw_tiles(self, tables: t.List[t.Tuple[t.List[t.List[str]], int, t.Optional[str]]]) -> t.List[Image.Image]:
+        """
+        绘制不含标红的排行表, 用作 image_generate.generate_rank_tables 的 draw_tiles
+        :param tables: [(表格数据, 宽度, 标题)]
+        """
+        executor = self._executor if len(tables) > 1 else None
+        if executor is not None:
+            try:
+                return [image_generate.decode_rank_tile(i)
+                        for i in executor.map(image_generate.draw_rank_tile_encoded, *zip(*tables))]
+            except (BrokenProcessPool, OSError, RuntimeError):
+                # 进程池不可用 (RuntimeError 为已经关闭), 之后都在当前线程中绘制
+                self.shutdown(wait=False)
+        return [image_generate.draw_rank_tile(*i) for i in tables]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -4,30 +4,104 @@ from . import models as m
 from . import database
 from . import yinpa_error as err
 from . import image_generate
+from . import command_matcher
+from . import rank
+from . import render_cache
+from . import render_pool
 from .config import YinpaConfig as cfg
 import typing as t
-import heapq
+import threading
 
+rank_render_pool = render_pool.RankRenderPool(cfg.rank_render_processes)
+rank_render_pool.start()  # 渲染进程需要在数据库的写线程启动前创建
 db = database.YinpaDB()
+rank_img_cache = render_cache.RenderCache(cfg.rank_img_cache_bytes, cfg.rank_img_cache_ttl)
+rank_tile_cache = render_cache.RenderCache(cfg.rank_tile_cache_bytes)
+_command_matcher: t.Optional[command_matcher.CommandMatcher] = None
+_command_matcher_lock = threading.Lock()
+
+
+def get_command_matcher() -> command_matcher.CommandMatcher:
+    """
+    获取指令解析器, 第一次调用时从数据库读取所有用户昵称。之后通过本模块增删用户时自动更新
+    """
+    global _command_matcher
+    with _command_matcher_lock:
+        if _command_matcher is None:
+            matcher = command_matcher.CommandMatcher()
+            for user_id, user_name in db.get_all_user_names():
+                matcher.add_user(user_id, user_name)
+            _command_matcher = matcher
+        return _command_matcher
+
+
+def match_command(message: str) -> t.Optional[m.YinpaCommand]:
+    """
+    解析 yinpa 指令, 例: /透chieri、/摸chieri的欧派、/狠狠地摸欧派 (对象由 @ 指定)。不是指令时返回 None
+    """
+    return get_command_matcher().match(message)
+
+
+def _update_command_matcher(user_id: int, user_name: t.Optional[str]):
+    with _command_matcher_lock:
+        if _command_matcher is None:
+            return
+        if user_name is None:
+            _command_matcher.remove_user(user_id)
+        else:
+            _command_matcher.add_user(user_id, user_name)
+
+
+_rank_store: t.Optional[rank.RankStore] = None
+_rank_store_lock = threading.Lock()
+
+
+def get_rank_store(rebuild=False) -> rank.RankStore:
+    """
+    获取全体排行数据, 第一次调用时从数据库构建, 之后随数据库写入更新
+    :param rebuild: 已经构建过时重新从数据库构建
+    """
+    global _rank_store
+    with _rank_store_lock:
+        if _rank_store is None:
+            store = rank.RankStore()
+            db.add_change_listener(store.on_change)  # 先注册再读取, 不会漏掉构建期间的写入
+            store.rebuild(db.get_user_columns)
+            _rank_store = store
+        elif rebuild:
+            _rank_store.rebuild(db.get_user_columns)
+        return _rank_store
+
+
+def rebuild_rank_store():
+    """
+    从数据库重新构建全体排行数据, 用于直接修改数据库等情况下的恢复。还没有构建时只构建一次
+    """
+    return get_rank_store(rebuild=True)
 
 
 def add_user(user_id: int, user_name: str, sex: int, race: str):
-    uinfo = db.get_user_info(user_id, raise_notfound_error=False)
-    if uinfo is not None:
-        raise err.YinpaUserExistsError(f"用户 {user_id} 已存在")
+    with db.session(user_id):
+        uinfo = db.get_user_info(user_id, raise_notfound_error=False)
+        if uinfo is not None:
+            raise err.YinpaUserExistsError(f"用户 {user_id} 已存在")
 
-    user_name = user_name.strip()
-    if user_name in ["群主", "管理"]:
-        raise err.YinpaValueError("不允许使用关键字作为用户名")
+        user_name = user_name.strip()
+        if user_name in ["群主", "管理"]:
+            raise err.YinpaValueError("不允许使用关键字作为用户名")
 
-    if len(user_name) > 15:
-        raise err.YinpaUserError(f"名称过长，请保持在 15 字以内")
-    return db.create_user(user_id, user_name, m.BaseSex.get_sex_from_value(sex),
-                          m.RaceTypes.get_race_type_from_name(race))
+        if len(user_name) > 15:
+            raise err.YinpaUserError(f"名称过长，请保持在 15 字以内")
+        ret = db.create_user(user_id, user_name, m.BaseSex.get_sex_from_value(sex),
+                             m.RaceTypes.get_race_type_from_name(race))
+    _update_command_matcher(user_id, ret.name)
+    return ret
 
 
 def delete_user(user_id: int):
-    return db.delete_user(user_id)
+    ret = db.delete_user(user_id)
+    _update_command_matcher(user_id, None)
+    return ret
 
 
 def get_user_info(user_id: int, raise_notfound_error=True):
@@ -39,7 +113,67 @@ def get_user_info_by_name(username: str, raise_notfound_error=True):
 
 
 def update_user_info(data: m.UserInfo):
-    return db.update_user_info(data)
+    """
+    保存用户信息, 与涉及该用户的会话互斥。读取、修改再保存时应放在 db.session(data.id) 中, 避免覆盖期间其它写入的修改
+    """
+    ret = db.update_user_info(data)
+    _update_command_matcher(data.id, data.name)
+    return ret
+
+
+def _part_available(part: m.BodyParts, sex: m.BaseSex, length_signs: t.FrozenSet[m.SignTypes], race: m.RaceTypes):
+    """
+    与 UserInfo.check_have_body_part 相同的判断, 部位是否存在只由种族决定
+    """
+    if part.value.optional and (part not in race.value.has_optional_parts):
+        return False
+    if part.value.need_sex and (sex not in part.value.need_sex):
+        return False
+    if part.value.need_length_sign:
+        if sex == m.BaseSex.NONE:
+            return False
+        return any(i in length_signs for i in part.value.need_length_sign)
+    return True
+
+
+def _build_yinpa_matrix():
+    supported = {(action, part) for action in m.DoActionTypes for part in m.BodyParts
+                 if part.value.check_support_action(action)}
+    all_signs = list(m.SignTypes)
+    signs_sets = [frozenset(j for n, j in enumerate(all_signs) if i & (1 << n)) for i in range(1 << len(all_signs))]
+    available = {(part, sex, signs, race) for part in m.BodyParts for sex in m.BaseSex for signs in signs_sets
+                 for race in m.RaceTypes if _part_available(part, sex, signs, race)}
+    return supported, available
+
+
+# (动作, 部位) 是否可用; (部位, 性别, 长度符号, 种族) 是否存在。导入时计算
+_yinpa_supported, _yinpa_part_available = _build_yinpa_matrix()
+
+
+def validate_yinpa_request(action_name: str, target_part_name: str, strength=m.StrengthType.NORMAL,
+                           target_sex: t.Optional[m.BaseSex] = None,
+                           target_length_signs: t.Optional[t.Iterable[m.SignTypes]] = None,
+                           target_race: t.Optional[m.RaceTypes] = None) -> t.Tuple[m.DoActionTypes, m.BodyParts]:
+    """
+    检查 yinpa 请求, 不读取数据库。不合法时抛出与 yinpa() 相同的异常
+    :param action_name: 动作名称
+    :param target_part_name: 目标部位
+    :param strength: 力度
+    :param target_sex: 目标性别, 与 target_length_signs, target_race 都提供时检查目标是否有该部位
+    :param target_length_signs: 目标长度的符号, 见 UserInfo.get_length_signs
+    :param target_race: 目标种族
+    :return: (动作, 部位)
+    """
+    do_action = m.DoActionTypes.get_action_from_name(action_name)
+    target_part = m.BodyParts.get_pars_from_name(target_part_name)
+    if not isinstance(strength, m.StrengthType):
+        raise err.YinpaValueError(f"Invalid strength value: {strength}")
+    if (do_action, target_part) not in _yinpa_supported:
+        raise err.YinpaUserError(f"这个地方不能 {action_name} 哦\n⁄(⁄⁄•⁄ω⁄•⁄⁄)⁄")
+    if (target_sex is not None) and (target_length_signs is not None) and (target_race is not None):
+        if (target_part, target_sex, frozenset(target_length_signs), target_race) not in _yinpa_part_available:
+            raise err.YinpaUserError(f"对方没有 {target_part_name} 这个部位哦\nヽ(。>д<)ｐ")
+    return do_action, target_part
 
 
 def yinpa(self_user_id: int, target_user_id: int, action_name: str, target_part_name: str,
@@ -56,247 +190,249 @@ def yinpa(self_user_id: int, target_user_id: int, action_name: str, target_part_
     """
     if self_user_id == target_user_id:
         raise err.YinpaUserError("不能对自己做这些事哦，把精力用在群友身上吧~\n(๑•ω•๑)")
-    self_user_info = get_user_info(self_user_id, raise_notfound_error=False)
-    if self_user_info is None:
-        raise err.UserNotFoundError("您还未加入yinpa")
-    target_user_info = get_user_info(target_user_id, raise_notfound_error=False)
-    if target_user_info is None:
-        raise err.UserNotFoundError("对方还未加入yinpa")
-
-    self_hp_left = self_user_info.hp
-    is_overdraft = False
-    reduce_length = 0
-    if self_user_info.hp < cfg.spend_hp_per_yinpa:
-        is_overdraft = True
-        if self_user_info.hp < cfg.min_hp:
-            raise err.YinpaUserError(f"您的体力不足: {self_user_info.hp}\n(；′⌒`)")
-    if is_overdraft:  # 透支身体，扣除持久力
-        self_user_info.persistance -= cfg.red_persistance_overdraft
-        if (self_user_info.length > 0):
-            self_user_info.length -= cfg.red_length_overdraft
-            reduce_length = cfg.red_length_overdraft
-
-    if self_user_info.persistance < cfg.min_persistance:
-        raise err.YinpaUserError(f"你由于过度透支身体, 心有余而力不足, 无法参加。\n"
-                                 f"当前持久: {self_user_info.persistance} s\n"
-                                 f"至少需要: {cfg.min_persistance} s\n┐(‘～`；)┌")
-    self_user_info.hp -= cfg.spend_hp_per_yinpa
-
-    do_action = m.DoActionTypes.get_action_from_name(action_name)
-    target_part = m.BodyParts.get_pars_from_name(target_part_name)
-
-    self_wear = self_user_info.get_worn_dress_by_part(m.BodyParts.get_pars_from_name(do_action.value.self_part))
-    target_wear = target_user_info.get_worn_dress_by_part(target_part)
-
-    if not target_user_info.check_have_body_part(target_part):
-        raise err.YinpaUserError(f"{target_user_info.name} 没有 {target_part_name} 这个部位哦\nヽ(。>д<)ｐ")
-    if not target_part.value.check_support_action(do_action):
-        raise err.YinpaUserError(f"这个地方不能 {action_name} 哦\n⁄(⁄⁄•⁄ω⁄•⁄⁄)⁄")
-
-    user_target_part_info = target_user_info.body_info.body_parts_info[target_part]
-    if strength == m.StrengthType.NORMAL:
-        strength = do_action.value.base_strength_type
-
-    total_sensitive = user_target_part_info.get_sensitive() + \
-                      self_wear.value.add_sensitive + target_wear.value.add_sensitive  # 敏感度计算结果
-    if strength == m.StrengthType.SOFT:
-        total_sensitive += user_target_part_info.stroke_soft_sensitive
-        user_target_part_info.stroke_soft_sensitive += cfg.add_strength_sensitive_every_yinpa
-    elif strength == m.StrengthType.NORMAL:
-        total_sensitive += user_target_part_info.stroke_normal_sensitive
-        user_target_part_info.stroke_normal_sensitive += cfg.add_strength_sensitive_every_yinpa
-    elif strength == m.StrengthType.SEVERELY:
-        total_sensitive += user_target_part_info.stroke_severely_sensitive
-        user_target_part_info.stroke_severely_sensitive += cfg.add_strength_sensitive_every_yinpa
-    else:
-        raise err.YinpaValueError(f"Invalid strength value: {strength}")
+    do_action, target_part = validate_yinpa_request(action_name, target_part_name, strength)
+    with db.session(self_user_id, target_user_id):
+        self_user_info = get_user_info(self_user_id, raise_notfound_error=False)
+        if self_user_info is None:
+            raise err.UserNotFoundError("您还未加入yinpa")
+        target_user_info = get_user_info(target_user_id, raise_notfound_error=False)
+        if target_user_info is None:
+            raise err.UserNotFoundError("对方还未加入yinpa")
+
+        self_hp_left = self_user_info.hp
+        is_overdraft = False
+        reduce_length = 0
+        if self_user_info.hp < cfg.spend_hp_per_yinpa:
+            is_overdraft = True
+            if self_user_info.hp < cfg.min_hp:
+                raise err.YinpaUserError(f"您的体力不足: {self_user_info.hp}\n(；′⌒`)")
+        if is_overdraft:  # 透支身体，扣除持久力
+            self_user_info.persistance -= cfg.red_persistance_overdraft
+            if (self_user_info.length > 0):
+                self_user_info.length -= cfg.red_length_overdraft
+                reduce_length = cfg.red_length_overdraft
+
+        if self_user_info.persistance < cfg.min_persistance:
+            raise err.YinpaUserError(f"你由于过度透支身体, 心有余而力不足, 无法参加。\n"
+                                     f"当前持久: {self_user_info.persistance} s\n"
+                                     f"至少需要: {cfg.min_persistance} s\n┐(‘～`；)┌")
+        self_user_info.hp -= cfg.spend_hp_per_yinpa
+
+        self_wear = self_user_info.get_worn_dress_by_part(m.BodyParts.get_pars_from_name(do_action.value.self_part))
+        target_wear = target_user_info.get_worn_dress_by_part(target_part)
+
+        if not target_user_info.check_have_body_part(target_part):
+            raise err.YinpaUserError(f"{target_user_info.name} 没有 {target_part_name} 这个部位哦\nヽ(。>д<)ｐ")
+
+        user_target_part_info = target_user_info.body_info.body_parts_info[target_part]
+        if strength == m.StrengthType.NORMAL:
+            strength = do_action.value.base_strength_type
+
+        total_sensitive = user_target_part_info.get_sensitive() + \
+                          self_wear.value.add_sensitive + target_wear.value.add_sensitive  # 敏感度计算结果
+        if strength == m.StrengthType.SOFT:
+            total_sensitive += user_target_part_info.stroke_soft_sensitive
+            user_target_part_info.stroke_soft_sensitive += cfg.add_strength_sensitive_every_yinpa
+        elif strength == m.StrengthType.NORMAL:
+            total_sensitive += user_target_part_info.stroke_normal_sensitive
+            user_target_part_info.stroke_normal_sensitive += cfg.add_strength_sensitive_every_yinpa
+        elif strength == m.StrengthType.SEVERELY:
+            total_sensitive += user_target_part_info.stroke_severely_sensitive
+            user_target_part_info.stroke_severely_sensitive += cfg.add_strength_sensitive_every_yinpa
+        else:
+            raise err.YinpaValueError(f"Invalid strength value: {strength}")
 
-    user_target_part_info.sensitive += cfg.add_sensitive_every_yinpa
-    if do_action.value.use_self_persistance:  # 耗时计算
-        base_time = self_user_info.persistance + self_user_info.temp_use_time
-        self_user_info.temp_use_time = 0.0  # 清除临时道具效果
-        left_hp_per = self_hp_left / cfg.max_hp
-    else:
-        base_time = target_user_info.persistance + target_user_info.temp_use_time
-        target_user_info.temp_use_time = 0.0  # 清除临时道具效果
-        left_hp_per = target_user_info.hp / cfg.max_hp
-    base_time += self_wear.value.add_time + target_wear.value.add_time
-    use_time = random.randint(int(base_time * left_hp_per * 100), int(base_time * 150)) / 100  # 最终耗时
-    volume = yinpa_tools.sensitive_to_volume(total_sensitive + target_user_info.temp_sensitive, use_time)  # 量
-    target_user_info.temp_sensitive = 0.0  # 清除临时道具效果
-    reduce_target_hp = min(int(volume if volume <= cfg.max_hp / 2 else cfg.max_hp / 2),
-                           cfg.spend_hp_per_yinpa)  # 目标减少体力
-    target_user_info.hp = int(target_user_info.hp - reduce_target_hp)
-
-    db.update_user_info(self_user_info)
-    db.update_user_info(target_user_info)
-    db.inject_others(self_user_id, do_action.value.id, target_user_id, target_part.value.body_id, volume, use_time,
-                     group_id, not do_action.value.use_self_persistance)
-
-    return m.ReturnYinpaData(self_data=self_user_info, target_data=target_user_info, is_overdraft=is_overdraft,
-                             volume=volume, reduce_target_hp=reduce_target_hp, reduce_length=reduce_length,
-                             is_serve=not do_action.value.use_self_persistance, use_time=use_time, self_wear=self_wear,
-                             target_wear=target_wear)
+        user_target_part_info.sensitive += cfg.add_sensitive_every_yinpa
+        if do_action.value.use_self_persistance:  # 耗时计算
+            base_time = self_user_info.persistance + self_user_info.temp_use_time
+            self_user_info.temp_use_time = 0.0  # 清除临时道具效果
+            left_hp_per = self_hp_left / cfg.max_hp
+        else:
+            base_time = target_user_info.persistance + target_user_info.temp_use_time
+            target_user_info.temp_use_time = 0.0  # 清除临时道具效果
+            left_hp_per = target_user_info.hp / cfg.max_hp
+        base_time += self_wear.value.add_time + target_wear.value.add_time
+        use_time = random.randint(int(base_time * left_hp_per * 100), int(base_time * 150)) / 100  # 最终耗时
+        volume = yinpa_tools.sensitive_to_volume(total_sensitive + target_user_info.temp_sensitive, use_time)  # 量
+        target_user_info.temp_sensitive = 0.0  # 清除临时道具效果
+        reduce_target_hp = min(int(volume if volume <= cfg.max_hp / 2 else cfg.max_hp / 2),
+                               cfg.spend_hp_per_yinpa)  # 目标减少体力
+        target_user_info.hp = int(target_user_info.hp - reduce_target_hp)
+
+        db.update_user_info(self_user_info)
+        db.update_user_info(target_user_info)
+        db.inject_others(self_user_id, do_action.value.id, target_user_id, target_part.value.body_id, volume, use_time,
+                         group_id, not do_action.value.use_self_persistance)
+
+        return m.ReturnYinpaData(self_data=self_user_info, target_data=target_user_info, is_overdraft=is_overdraft,
+                                 volume=volume, reduce_target_hp=reduce_target_hp, reduce_length=reduce_length,
+                                 is_serve=not do_action.value.use_self_persistance, use_time=use_time, self_wear=self_wear,
+                                 target_wear=target_wear)
 
 
 def dajiao(userid: int, body_part: m.BodyParts):
-    user_info = db.get_user_info(userid)
-    if user_info.sex.isNone():  # 无性别不能打
-        raise err.YinpaUserError("目标用户没有此功能\n┐(-｡ｰ;)┌")
-    need_hp = int(cfg.spend_hp_per_yinpa / 3)  # 需要 1/3 体力
-    if user_info.hp < need_hp:
-        raise err.YinpaUserError(f"体力不足: {user_info.hp} / {need_hp}")
-    user_info.hp -= need_hp
-    orig_positive = user_info.length > 0  # 原本是否为正数
-    is_len2 = False
-    is_opai = False
-
-    add_dajiao = random.randint(cfg.dajiao_add_length * 100,
-                                cfg.dajiao_add_length * cfg.dajiao_max_magnification * 100) / 100
-    add_chest = random.randint(cfg.dajiao_add_chest_size * 100,
-                               cfg.dajiao_add_chest_size * cfg.dajiao_max_magnification * 100) / 100
-
-    if body_part in [m.BodyParts.CHEST, m.BodyParts.NIPPLE]:
-        user_info.chest_size += add_chest
-        change_value = add_chest
-        action = m.DoActionTypes.PINCH
-        is_opai = True
-    elif body_part in [m.BodyParts.NEWNEW, m.BodyParts.NEWNEWHEAD]:
-        user_info.length += add_dajiao
-        change_value = add_dajiao
-        action = m.DoActionTypes.RUB
-    elif body_part in [m.BodyParts.OMANGO, m.BodyParts.OMANGOHAPPY]:
-        action = m.DoActionTypes.DIG
-        if user_info.sex.isDouble():
-            user_info.length2 -= add_dajiao
-            change_value = -add_dajiao
-            is_len2 = True
+    with db.session(userid):
+        user_info = db.get_user_info(userid)
+        if user_info.sex.isNone():  # 无性别不能打
+            raise err.YinpaUserError("目标用户没有此功能\n┐(-｡ｰ;)┌")
+        need_hp = int(cfg.spend_hp_per_yinpa / 3)  # 需要 1/3 体力
+        if user_info.hp < need_hp:
+            raise err.YinpaUserError(f"体力不足: {user_info.hp} / {need_hp}")
+        user_info.hp -= need_hp
+        orig_positive = user_info.length > 0  # 原本是否为正数
+        is_len2 = False
+        is_opai = False
+
+        add_dajiao = random.randint(cfg.dajiao_add_length * 100,
+                                    cfg.dajiao_add_length * cfg.dajiao_max_magnification * 100) / 100
+        add_chest = random.randint(cfg.dajiao_add_chest_size * 100,
+                                   cfg.dajiao_add_chest_size * cfg.dajiao_max_magnification * 100) / 100
+
+        if body_part in [m.BodyParts.CHEST, m.BodyParts.NIPPLE]:
+            user_info.chest_size += add_chest
+            change_value = add_chest
+            action = m.DoActionTypes.PINCH
+            is_opai = True
+        elif body_part in [m.BodyParts.NEWNEW, m.BodyParts.NEWNEWHEAD]:
+            user_info.length += add_dajiao
+            change_value = add_dajiao
+            action = m.DoActionTypes.RUB
+        elif body_part in [m.BodyParts.OMANGO, m.BodyParts.OMANGOHAPPY]:
+            action = m.DoActionTypes.DIG
+            if user_info.sex.isDouble():
+                user_info.length2 -= add_dajiao
+                change_value = -add_dajiao
+                is_len2 = True
+            else:
+                user_info.length -= add_dajiao
+                change_value = -add_dajiao
         else:
-            user_info.length -= add_dajiao
-            change_value = -add_dajiao
-    else:
-        raise err.YinpaValueError(f"body_part {body_part} not support in func: dajiao()")
+            raise err.YinpaValueError(f"body_part {body_part} not support in func: dajiao()")
 
-    add_sensitive = random.randint(int(cfg.dajiao_add_sensitive * 100),
-                                   int(cfg.dajiao_add_sensitive * cfg.dajiao_max_magnification * 100)) / 100
-    user_info.body_info.body_parts_info[body_part].sensitive += add_sensitive
-    now_positive = user_info.length > 0  # 现在是否为正数
-    db.update_user_info(user_info)
-    return m.ReturnDajiaoData(user_info=user_info, orig_positive=orig_positive, now_positive=now_positive,
-                              change_value=change_value, action=action, use_hp=need_hp, is_len2=is_len2,
-                              body_part=body_part, is_opai=is_opai, add_sensitive=add_sensitive)
+        add_sensitive = random.randint(int(cfg.dajiao_add_sensitive * 100),
+                                       int(cfg.dajiao_add_sensitive * cfg.dajiao_max_magnification * 100)) / 100
+        user_info.body_info.body_parts_info[body_part].sensitive += add_sensitive
+        now_positive = user_info.length > 0  # 现在是否为正数
+        db.update_user_info(user_info)
+        return m.ReturnDajiaoData(user_info=user_info, orig_positive=orig_positive, now_positive=now_positive,
+                                  change_value=change_value, action=action, use_hp=need_hp, is_len2=is_len2,
+                                  body_part=body_part, is_opai=is_opai, add_sensitive=add_sensitive)
 
 
 def snatch(self_user_id: int, target_user_id: int, is_newnew=False, is_opai=False):  # 抢夺
-    self_user_info = get_user_info(self_user_id)
-    target_user_info = get_user_info(target_user_id)
-    target_change_sex = False
-    self_add = False
-
-    if is_newnew:
-        if (target_user_info.length <= 0) or target_user_info.sex.isNone():
-            raise err.YinpaUserError(f"用户: {target_user_info.name} 没有这个部位。")
-        body_part = m.BodyParts.NEWNEW
-        snatch_len = random.randint(int(cfg.snatch_newnew_length_base * 100),
-                                    int(cfg.snatch_newnew_length_base * cfg.snatch_newnew_max_magnification * 100)) / 100
-        if snatch_len > target_user_info.length:
-            if target_user_info.sex.isSingle():
-                target_change_sex = True
-        target_user_info.length -= snatch_len
-        if self_user_info.sex.isSingle():
-            if self_user_info.length >= 0:
+    with db.session(self_user_id, target_user_id):
+        self_user_info = get_user_info(self_user_id)
+        target_user_info = get_user_info(target_user_id)
+        target_change_sex = False
+        self_add = False
+
+        if is_newnew:
+            if (target_user_info.length <= 0) or target_user_info.sex.isNone():
+                raise err.YinpaUserError(f"用户: {target_user_info.name} 没有这个部位。")
+            body_part = m.BodyParts.NEWNEW
+            snatch_len = random.randint(int(cfg.snatch_newnew_length_base * 100),
+                                        int(cfg.snatch_newnew_length_base * cfg.snatch_newnew_max_magnification * 100)) / 100
+            if snatch_len > target_user_info.length:
+                if target_user_info.sex.isSingle():
+                    target_change_sex = True
+            target_user_info.length -= snatch_len
+            if self_user_info.sex.isSingle():
+                if self_user_info.length >= 0:
+                    self_user_info.length += snatch_len
+                    self_add = True
+            elif self_user_info.sex.isDouble():
                 self_user_info.length += snatch_len
                 self_add = True
-        elif self_user_info.sex.isDouble():
-            self_user_info.length += snatch_len
-            self_add = True
-    elif is_opai:
-        if (target_user_info.length > 0) and (not target_user_info.sex.isNone()):
-            raise err.YinpaUserError(f"用户: {target_user_info.name} 没有这个部位。")
-        if target_user_info.chest_size <= 0:
-            raise err.YinpaUserError(f"用户: {target_user_info.name} 的欧派没有多余的部分可以抢了。")
-        body_part = m.BodyParts.CHEST
-        snatch_len = random.randint(int(cfg.snatch_opai_length_base * 100),
-                                    int(cfg.snatch_opai_length_base * cfg.snatch_opai_max_magnification * 100)) / 100
-        target_user_info.chest_size -= snatch_len
+        elif is_opai:
+            if (target_user_info.length > 0) and (not target_user_info.sex.isNone()):
+                raise err.YinpaUserError(f"用户: {target_user_info.name} 没有这个部位。")
+            if target_user_info.chest_size <= 0:
+                raise err.YinpaUserError(f"用户: {target_user_info.name} 的欧派没有多余的部分可以抢了。")
+            body_part = m.BodyParts.CHEST
+            snatch_len = random.randint(int(cfg.snatch_opai_length_base * 100),
+                                        int(cfg.snatch_opai_length_base * cfg.snatch_opai_max_magnification * 100)) / 100
+            target_user_info.chest_size -= snatch_len
+            if target_user_info.chest_size < 0:
+                target_user_info.chest_size = 0
+            if (self_user_info.length <= 0) or self_user_info.sex.isNone():
+                self_user_info.chest_size += snatch_len
+                self_add = True
+        else:
+            raise err.YinpaValueError("snatch() - Invalid parameter.")
+
+        if self_user_info.chest_size < 0:
+            self_user_info.chest_size = 0
         if target_user_info.chest_size < 0:
             target_user_info.chest_size = 0
-        if (self_user_info.length <= 0) or self_user_info.sex.isNone():
-            self_user_info.chest_size += snatch_len
-            self_add = True
-    else:
-        raise err.YinpaValueError("snatch() - Invalid parameter.")
-
-    if self_user_info.chest_size < 0:
-        self_user_info.chest_size = 0
-    if target_user_info.chest_size < 0:
-        target_user_info.chest_size = 0
 
-    db.update_user_info(self_user_info)
-    db.update_user_info(target_user_info)
+        db.update_user_info(self_user_info)
+        db.update_user_info(target_user_info)
 
-    return m.ReturnSnatchData(self_data=self_user_info, target_data=target_user_info, self_add=self_add,
-                              target_change_sex=target_change_sex, body_part=body_part, snatch_len=snatch_len)
+        return m.ReturnSnatchData(self_data=self_user_info, target_data=target_user_info, self_add=self_add,
+                                  target_change_sex=target_change_sex, body_part=body_part, snatch_len=snatch_len)
 
 
 def newnew_roll(userid: int, is_omago=False):  # 加减大小
-    user_info = get_user_info(userid)
-    if user_info.sex.isNone():
-        raise err.YinpaUserError("目标用户没有这个功能...\n( Ĭ ^ Ĭ )")
-
-    roll_value = random.randint(0, int(cfg.roll_newnew_base * 2 * 100)) / 100 - cfg.roll_newnew_base
-    target_change_sex = False
-    if user_info.sex.isDouble():
-        if is_omago:
-            body_part = m.BodyParts.OMANGO
-            user_info.length2 += roll_value
-            if user_info.length2 > 0:
-                user_info.length2 = -0.01
+    with db.session(userid):
+        user_info = get_user_info(userid)
+        if user_info.sex.isNone():
+            raise err.YinpaUserError("目标用户没有这个功能...\n( Ĭ ^ Ĭ )")
+
+        roll_value = random.randint(0, int(cfg.roll_newnew_base * 2 * 100)) / 100 - cfg.roll_newnew_base
+        target_change_sex = False
+        if user_info.sex.isDouble():
+            if is_omago:
+                body_part = m.BodyParts.OMANGO
+                user_info.length2 += roll_value
+                if user_info.length2 > 0:
+                    user_info.length2 = -0.01
+            else:
+                body_part = m.BodyParts.NEWNEW
+                user_info.length += roll_value
+                if user_info.length < 0:
+                    user_info.length = 0.01
         else:
-            body_part = m.BodyParts.NEWNEW
+            orig_is_man = user_info.length > 0
             user_info.length += roll_value
-            if user_info.length < 0:
-                user_info.length = 0.01
-    else:
-        orig_is_man = user_info.length > 0
-        user_info.length += roll_value
-        current_is_man = user_info.length > 0
-        if orig_is_man != current_is_man:
-            target_change_sex = True
-        body_part = m.BodyParts.NEWNEW if orig_is_man else m.BodyParts.OMANGO
+            current_is_man = user_info.length > 0
+            if orig_is_man != current_is_man:
+                target_change_sex = True
+            body_part = m.BodyParts.NEWNEW if orig_is_man else m.BodyParts.OMANGO
 
-    db.update_user_info(user_info)
-    return m.ReturnRollData(user_info=user_info, change_sex=target_change_sex, body_part=body_part,
-                            roll_value=roll_value)
+        db.update_user_info(user_info)
+        return m.ReturnRollData(user_info=user_info, change_sex=target_change_sex, body_part=body_part,
+                                roll_value=roll_value)
 
 
 def opai_roll(userid: int):  # 加减大小
-    user_info = get_user_info(userid)
-    if user_info.sex.isSingle():
-        if user_info.length > 0:
-            raise err.YinpaUserError("目标用户欧派目前不可用~\n( Ĭ ^ Ĭ )")
-
-    roll_value = random.randint(0, int(cfg.roll_opai_base * 2 * 100)) / 100 - cfg.roll_opai_base
-    user_info.chest_size += roll_value
-    if user_info.chest_size < 0:
-        user_info.chest_size = 0
-    db.update_user_info(user_info)
-    return m.ReturnRollData(user_info=user_info, change_sex=False, body_part=m.BodyParts.CHEST, roll_value=roll_value)
+    with db.session(userid):
+        user_info = get_user_info(userid)
+        if user_info.sex.isSingle():
+            if user_info.length > 0:
+                raise err.YinpaUserError("目标用户欧派目前不可用~\n( Ĭ ^ Ĭ )")
+
+        roll_value = random.randint(0, int(cfg.roll_opai_base * 2 * 100)) / 100 - cfg.roll_opai_base
+        user_info.chest_size += roll_value
+        if user_info.chest_size < 0:
+            user_info.chest_size = 0
+        db.update_user_info(user_info)
+        return m.ReturnRollData(user_info=user_info, change_sex=False, body_part=m.BodyParts.CHEST, roll_value=roll_value)
 
 def buy_dress(userid: int, dress_name: str, coin_use_callback: t.Optional[t.Callable[[int, int], bool]] = None,
              coin_name: str = "CS点数"):
-    user_info = get_user_info(userid)
-    dress_info = m.DressTypes.get_dress_from_name(dress_name)
-    if not dress_info.value.can_buy:
-        raise err.YinpaError(f"该物品不可购买")
-    if dress_info in user_info.own_dress:
-        raise err.YinpaUserError(f"您已拥有 {dress_name}")
-    if callable(coin_use_callback):
-        if not coin_use_callback(userid, dress_info.value.price):
-            raise err.YinpaUserError(f"您的{coin_name}不足, 需要: {dress_info.value.price}")
-    user_info.own_dress.append(dress_info)
-    db.update_user_info(user_info)
-    return user_info, dress_info
+    with db.session(userid):
+        user_info = get_user_info(userid)
+        dress_info = m.DressTypes.get_dress_from_name(dress_name)
+        if not dress_info.value.can_buy:
+            raise err.YinpaError(f"该物品不可购买")
+        if dress_info in user_info.own_dress:
+            raise err.YinpaUserError(f"您已拥有 {dress_name}")
+        if callable(coin_use_callback):
+            if not coin_use_callback(userid, dress_info.value.price):
+                raise err.YinpaUserError(f"您的{coin_name}不足, 需要: {dress_info.value.price}")
+        user_info.own_dress.append(dress_info)
+        db.update_user_info(user_info)
+        return user_info, dress_info
 
 def check_worn_dress(userid: int, dress_name: str):
     user_info = get_user_info(userid)
@@ -304,22 +440,24 @@ def check_worn_dress(userid: int, dress_name: str):
     return dress_info in user_info.worn_dress
 
 def wear_dress(userid: int, dress_name: str):
-    user_info = get_user_info(userid)
-    dress_info = m.DressTypes.get_dress_from_name(dress_name)
-    if dress_info not in user_info.own_dress:
-        raise err.YinpaUserError(f"您的背包内没有 {dress_name}")
-    rm_dress = user_info.add_dress(dress_info)
-    db.update_user_info(user_info)
-    return user_info, dress_info, rm_dress
+    with db.session(userid):
+        user_info = get_user_info(userid)
+        dress_info = m.DressTypes.get_dress_from_name(dress_name)
+        if dress_info not in user_info.own_dress:
+            raise err.YinpaUserError(f"您的背包内没有 {dress_name}")
+        rm_dress = user_info.add_dress(dress_info)
+        db.update_user_info(user_info)
+        return user_info, dress_info, rm_dress
 
 def take_off_dress(userid: int, dress_name: str):
-    user_info = get_user_info(userid)
-    dress_info = m.DressTypes.get_dress_from_name(dress_name)
-    if dress_info not in user_info.worn_dress:
-        raise err.YinpaUserError(f"您没有穿戴 {dress_name}")
-    user_info.worn_dress.remove(dress_info)
-    db.update_user_info(user_info)
-    return user_info, dress_info
+    with db.session(userid):
+        user_info = get_user_info(userid)
+        dress_info = m.DressTypes.get_dress_from_name(dress_name)
+        if dress_info not in user_info.worn_dress:
+            raise err.YinpaUserError(f"您没有穿戴 {dress_name}")
+        user_info.worn_dress.remove(dress_info)
+        db.update_user_info(user_info)
+        return user_info, dress_info
 
 
 def buy_item(userid: int, item_name: str, count=1, coin_use_callback: t.Optional[t.Callable[[int, int], bool]] = None,
@@ -333,181 +471,147 @@ def buy_item(userid: int, item_name: str, count=1, coin_use_callback: t.Optional
     :param coin_name: 货币名称。当抛出错误时，会使用此名称
     :return:
     """
-    user_info = get_user_info(userid)
-    item_info = m.ItemTypes.get_item_from_name(item_name)
-    if callable(coin_use_callback):
-        if not coin_use_callback(userid, item_info.value.price * count):
-            raise err.YinpaUserError(f"您的{coin_name}不足, 需要: {item_info.value.price * count}")
-    if item_info not in user_info.items:
-        user_info.items[item_info] = 0
-    user_info.items[item_info] += count
-    db.update_user_info(user_info)
-    return user_info, item_info
+    with db.session(userid):
+        user_info = get_user_info(userid)
+        item_info = m.ItemTypes.get_item_from_name(item_name)
+        if callable(coin_use_callback):
+            if not coin_use_callback(userid, item_info.value.price * count):
+                raise err.YinpaUserError(f"您的{coin_name}不足, 需要: {item_info.value.price * count}")
+        if item_info not in user_info.items:
+            user_info.items[item_info] = 0
+        user_info.items[item_info] += count
+        db.update_user_info(user_info)
+        return user_info, item_info
 
 
 def use_item(self_userid: int, target_userid: t.Optional[int], item_name: str, count=1):
-    user_info = get_user_info(self_userid)
-    if target_userid is not None:
-        target_userinfo = get_user_info(target_userid)
-    else:
-        target_userinfo = None
-    item_info = m.ItemTypes.get_item_from_name(item_name)
-    left_count = user_info.items.get(item_info, 0)
-    if left_count < count:
-        raise err.YinpaUserError(f"物品数量不足，当前数量: {left_count}")
+    with db.session(*[i for i in (self_userid, target_userid) if i is not None]):
+        user_info = get_user_info(self_userid)
+        if target_userid is not None:
+            target_userinfo = get_user_info(target_userid)
+        else:
+            target_userinfo = None
+        item_info = m.ItemTypes.get_item_from_name(item_name)
+        if count <= 0:
+            raise err.YinpaUserError("使用数量必须大于 0")
+        left_count = user_info.items.get(item_info, 0)
+        if left_count < count:
+            raise err.YinpaUserError(f"物品数量不足，当前数量: {left_count}")
 
-    user_info.items[item_info] -= count
+        user_info.items[item_info] -= count
 
-    for i in range(count):
+        # 效果合并计算, 物品数量与效果在同一事务中写入; 任意一步出错时整个会话回滚
         if item_info.value.target.isSelf():
-            user_info.use_item(item_info)
+            user_info.use_item(item_info, count)
         elif item_info.value.target.isTarget():
             if target_userinfo is None:
                 raise err.YinpaUserError(f"此物品只能给别人用哦~")
-            target_userinfo.use_item(item_info)
+            target_userinfo.use_item(item_info, count)
         elif item_info.value.target.isBoth():
             if target_userinfo is not None:
-                target_userinfo.use_item(item_info)
-            user_info.use_item(item_info)
+                target_userinfo.use_item(item_info, count)
+            user_info.use_item(item_info, count)
         else:
             raise err.YinpaValueError("Invalid item target.")
 
-    db.update_user_info(user_info)
-    if target_userinfo is not None:
-        db.update_user_info(target_userinfo)
-    return user_info, target_userinfo, item_info
+        db.update_user_info(user_info)
+        if target_userinfo is not None:
+            db.update_user_info(target_userinfo)
+        return user_info, target_userinfo, item_info
 
 
-def get_target_rank(lst, target, key: t.Callable, reverse=False):
-    count = 0
-    for i in lst:
-        if (key(i) > key(target)) if not reverse else (key(i) < key(target)):
-            count += 1
-    return count + 1
+def get_rank_data(userid: int, count_limit=40, limit_users: t.Optional[t.List[int]] = None,
+                  group_id: t.Optional[int] = None):
+    """
+    获取排行榜数据 (数据库读取与排序部分)。全体排行使用随写入更新的 RankStore (cfg.rank_store),
+    否则只读取参与排行的列, 由 rank.calc_ranks 计算。最后只读取上榜的用户
+    :param limit_users: 只统计这些用户
+    :param group_id: 只统计此群的成员 (见 add_group_members), 在数据库中完成筛选和排序。不为 None 时忽略 limit_users
+    :return: 每张排行表的 image_generate.generate_rank_table 参数, 交给 render_rank_img 绘制
+    """
+    target_user = get_user_info(userid, raise_notfound_error=False)
+    if group_id is not None:
+        results = rank.calc_group_ranks(db, group_id, target_user, count_limit)
+    elif (not limit_users) and cfg.rank_store:
+        results = get_rank_store().calc_ranks(target_user, count_limit)
+    else:
+        rows = db.get_user_columns(rank.get_rank_columns())
+        if limit_users:
+            limit_users = set(limit_users)
+            rows = [i for i in rows if i[0] in limit_users]
+        results = rank.calc_ranks(rows, target_user, count_limit)
+
+    show_ids = set()
+    for i in results:
+        show_ids.update(i.head_ids)
+        show_ids.update(i.end_ids or ())
+    users = {i.id: i for i in db.get_users(show_ids, with_body_parts_info=False)}
+
+    table_w = 400
+    return [dict(head_part=[users[u] for u in i.head_ids if u in users], key=i.board.get_display(),
+                 total_count=i.total_count,
+                 end_part=None if i.end_ids is None else [users[u] for u in i.end_ids if u in users],
+                 title=i.board.title, item_name=i.board.item_name, target_userinfo=target_user,
+                 target_user_rank=i.target_rank, table_w=table_w)
+            for i in results]
+
+
+def render_rank_img(rank_data: t.List[t.Dict[str, t.Any]]):
+    """
+    绘制排行榜图片 (图片生成部分)。每张表格按内容缓存在 rank_tile_cache 中, 只重新绘制内容变化的表格,
+    cfg.rank_render_processes 大于 0 时在 rank_render_pool 中并行绘制
+    :param rank_data: get_rank_data 的返回值
+    """
+    return image_generate.merge_rank_table_image(
+        image_generate.generate_rank_tables(rank_data, rank_tile_cache, rank_render_pool.draw_tiles))
 
 
-def get_rank_img(userid: int, count_limit=40, limit_users: t.Optional[t.List[int]] = None):
-    users_all = db.get_all_users(with_body_parts_info=False)
-    users = []
-    if limit_users:
-        for i in users_all:
-            if i.id in limit_users:
-                users.append(i)
+def rank_img_cache_key(userid: int, count_limit=40, limit_users: t.Optional[t.List[int]] = None,
+                       group_id: t.Optional[int] = None):
+    """
+    rank_img_cache 中排行榜图片的键, 参数同 get_rank_img
+    """
+    if group_id is not None:
+        scope = ("group", group_id)
+    elif limit_users:
+        scope = ("users", frozenset(limit_users))
     else:
-        users = users_all
-
-    chest_users = []
-    length_users = []
-    depth_users = []
-    for i in users:
-        if i.sex.isSingle():
-            if i.length < 0:
-                depth_users.append(i)
-            else:  # 单 - 男, chest_users 不加
-                length_users.append(i)
-                continue
-        chest_users.append(i)
+        scope = ("all",)
+    return "rank", scope, count_limit, userid
 
-    target_user = get_user_info(userid, raise_notfound_error=False)
 
-    target_length_rank = 0
-    target_depth_rank = 0
-    target_chest_rank = 0
-    target_prostitution_rank = 0  # yl
-    target_persistance_rank = 0  # 耐力
-    taregt_injected_vol_rank = 0
-    taregt_injected_count_rank = 0
-    taregt_shoot_count_rank = 0
-    taregt_active_time_rank = 0
-    taregt_passive_time_rank = 0
-    taregt_shoot_vol_rank = 0
-
-    if target_user:
-        if target_user.sex.isSingle():
-            if target_user.length < 0:
-                target_depth_rank = get_target_rank(depth_users, target_user, lambda u: u.length, reverse=True)
-                target_chest_rank = get_target_rank(chest_users, target_user, lambda u: u.chest_size)
-            else:
-                target_length_rank = get_target_rank(length_users, target_user, lambda u: u.length)
-        target_prostitution_rank = get_target_rank(users, target_user, lambda u: u.prostitution)
-        target_persistance_rank = get_target_rank(users, target_user, lambda u: u.persistance)
-        taregt_injected_vol_rank = get_target_rank(users, target_user, lambda u: u.injected_vol)
-        taregt_injected_count_rank = get_target_rank(users, target_user, lambda u: u.injected_count)
-        taregt_shoot_count_rank = get_target_rank(users, target_user, lambda u: u.shoot_count)
-        taregt_passive_time_rank = get_target_rank(users, target_user, lambda u: u.passive_time)
-        taregt_shoot_vol_rank = get_target_rank(users, target_user, lambda u: u.shoot_vol)
-
-    length_rank = heapq.nlargest(int(count_limit / 2), length_users, key=lambda u: u.length)
-    length_rank_r = heapq.nsmallest(int(count_limit / 2), length_users, key=lambda u: u.length)
-    depth_rank = heapq.nsmallest(int(count_limit / 2), depth_users, key=lambda u: u.length)
-    depthrank_r = heapq.nlargest(int(count_limit / 2), depth_users, key=lambda u: u.length)
-    persistance_rank = heapq.nlargest(int(count_limit / 2), users, key=lambda u: u.persistance)  # 耐力
-    persistance_rank_r = heapq.nsmallest(int(count_limit / 2), users, key=lambda u: u.persistance)  # 耐力, 倒
-    prostitution_rank = heapq.nlargest(count_limit, users, key=lambda u: u.prostitution)  # yl
-    chest_size_rank = heapq.nlargest(int(count_limit / 2), chest_users, key=lambda u: u.chest_size)
-    chest_size_rank_r = heapq.nsmallest(int(count_limit / 2), chest_users, key=lambda u: u.chest_size)
-
-    injected_vol_rank = heapq.nlargest(count_limit, users, key=lambda u: u.injected_vol)
-    injected_count_rank = heapq.nlargest(count_limit, users, key=lambda u: u.injected_count)
-    shoot_count_rank = heapq.nlargest(count_limit, users, key=lambda u: u.shoot_count)
-    shoot_vol_rank = heapq.nlargest(count_limit, users, key=lambda u: u.shoot_vol)
-    active_time_rank = heapq.nlargest(count_limit, users, key=lambda u: u.active_time)
-    passive_time_rank = heapq.nlargest(count_limit, users, key=lambda u: u.passive_time)
-
-    length_rank_r.reverse()
-    depthrank_r.reverse()
-    persistance_rank_r.reverse()
-    chest_size_rank_r.reverse()
+def get_rank_img(userid: int, count_limit=40, limit_users: t.Optional[t.List[int]] = None,
+                 group_id: t.Optional[int] = None):
+    """
+    获取排行榜图片。数据没有变化时返回 rank_img_cache 中的图片, 不要修改返回的图片
+    """
+    key = rank_img_cache_key(userid, count_limit, limit_users, group_id)
+    version = db.data_version
+    ret = rank_img_cache.get(key, version)
+    if ret is None:
+        ret = render_rank_img(get_rank_data(userid, count_limit, limit_users, group_id))
+        rank_img_cache.put(key, ret, version)
+    return ret
+
+
+def get_user_ranks(userid: int, group_id: t.Optional[int] = None) -> t.Dict[str, int]:
+    """
+    获取用户在各排行中的名次, 不读取其他用户
+    :param group_id: 只统计此群的成员
+    :return: {排行标题: 名次}, 不参与的排行为 0
+    """
+    return rank.calc_user_ranks(db, get_user_info(userid), group_id)
 
-    table_w = 400
 
-    len_tbl = image_generate.generate_rank_table(length_rank, lambda u: u.length, len(length_users),
-                                                 end_part=length_rank_r,
-                                                 title="长度排行", item_name="长度 (cm)", target_userinfo=target_user,
-                                                 target_user_rank=target_length_rank, table_w=table_w)
-    depth_tbl = image_generate.generate_rank_table(depth_rank, lambda u: u.length, len(depth_users),
-                                                   end_part=depthrank_r,
-                                                   title="深度排行", item_name="深度 (cm)", target_userinfo=target_user,
-                                                   target_user_rank=target_depth_rank, table_w=table_w)
-    persistance_tbl = image_generate.generate_rank_table(persistance_rank, lambda u: u.persistance, len(users),
-                                                         end_part=persistance_rank_r, title="持久排行", item_name="持久 (s)",
-                                                         target_userinfo=target_user, target_user_rank=target_persistance_rank, table_w=table_w)
-    chest_tbl = image_generate.generate_rank_table(chest_size_rank,
-                                                   lambda u: f"{u.chest_size} ({yinpa_tools.chest_size_to_cup(u.chest_size)})",
-                                                   len(chest_users), end_part=chest_size_rank_r,
-                                                   title="欧派排行", item_name="大小", target_userinfo=target_user,
-                                                   target_user_rank=target_chest_rank, table_w=table_w)
-
-    injected_vol_tbl = image_generate.generate_rank_table(injected_vol_rank, lambda u: u.injected_vol, len(users),
-                                                          end_part=None, title="被注入量排行", item_name="被注入量 (ml)",
-                                                          target_userinfo=target_user, target_user_rank=taregt_injected_vol_rank,
-                                                          table_w=table_w)
-    shoot_vol_tbl = image_generate.generate_rank_table(shoot_vol_rank, lambda u: u.shoot_vol, len(users),
-                                                          end_part=None, title="发射量排行", item_name="发射量 (ml)",
-                                                          target_userinfo=target_user, target_user_rank=taregt_shoot_vol_rank,
-                                                          table_w=table_w)
-    injected_count_tbl = image_generate.generate_rank_table(injected_count_rank, lambda u: u.injected_count, len(users),
-                                                          end_part=None, title="被透次数排行", item_name="被透次数",
-                                                          target_userinfo=target_user, target_user_rank=taregt_injected_count_rank,
-                                                          table_w=table_w)
-    shoot_count_tbl = image_generate.generate_rank_table(shoot_count_rank, lambda u: u.shoot_count, len(users),
-                                                          end_part=None, title="透人次数排行", item_name="透人次数",
-                                                          target_userinfo=target_user, target_user_rank=taregt_shoot_count_rank,
-                                                          table_w=table_w)
-    active_time_tbl = image_generate.generate_rank_table(active_time_rank, lambda u: u.active_time, len(users),
-                                                          end_part=None, title="透人总时长排行", item_name="透人时长 (s)",
-                                                          target_userinfo=target_user, target_user_rank=taregt_active_time_rank,
-                                                          table_w=table_w)
-    passive_time_tbl = image_generate.generate_rank_table(passive_time_rank, lambda u: u.passive_time, len(users),
-                                                          end_part=None, title="被透总时长排行", item_name="被透时长 (s)",
-                                                          target_userinfo=target_user, target_user_rank=taregt_passive_time_rank,
-                                                          table_w=table_w)
-
-    prostitution_tbl = image_generate.generate_rank_table(prostitution_rank, lambda u: u.prostitution, len(users),
-                                                          end_part=None, title="引乱排行", item_name="引乱度",
-                                                          target_userinfo=target_user, target_user_rank=target_prostitution_rank,
-                                                          table_w=table_w)
-
-    return image_generate.merge_rank_table_image([len_tbl, depth_tbl, persistance_tbl, chest_tbl, injected_vol_tbl,
-                                                  shoot_vol_tbl, injected_count_tbl, shoot_count_tbl, active_time_tbl,
-                                                  passive_time_tbl, prostitution_tbl])
+def add_group_members(group_id: int, user_ids: t.Iterable[int]):
+    """
+    记录群成员, 用于 get_rank_img(group_id=...)。在群内 yinpa 时会自动记录双方
+    """
+    db.add_group_members(group_id, user_ids)
+
+
+def remove_group_members(group_id: int, user_ids: t.Optional[t.Iterable[int]] = None):
+    """
+    :param user_ids: 为 None 时移除整个群
+    """
+    db.remove_group_members(group_id, user_ids)
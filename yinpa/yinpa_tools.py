@@ -17,21 +17,79 @@ def chest_size_to_cup(size: float):
         return f"Z+{ret_value - ord('Z')}"
     return chr(ret_value)
 
+_tier_prefix_sums = {}
+
+
+def _get_tier_prefix_sums(demarcation: int):
+    """
+    prefix[m] = sum(int(demarcation / k) for k in range(3, m + 1)), m 取 0 ~ demarcation。k > demarcation 时各项为 0
+    """
+    ret = _tier_prefix_sums.get(demarcation)
+    if ret is None:
+        ret = [0] * (demarcation + 1)
+        for k in range(3, demarcation + 1):
+            ret[k] = ret[k - 1] + int(demarcation / k)
+        _tier_prefix_sums[demarcation] = ret
+    return ret
+
+
+def sensitive_to_calc_sensitive(sensitive: int):
+    """
+    敏感度分梯队折算: 每 cfg.sensitive_calc_demarcation 为一个梯队, 第 i 个梯队 (i 从 1 开始) 除以 i + 2, 不足一个梯队的剩余部分同样计算
+    calc = sum(int(D / k) for k in range(3, n + 3)) + int(r / (n + 3)), 其中 n, r = divmod(int(sensitive), D)
+    """
+    total_sensitive = int(sensitive)
+    demarcation = cfg.sensitive_calc_demarcation
+    if (demarcation <= 0) or (demarcation != int(demarcation)):  # 只有整数梯队值可以用前缀和
+        calc_sensitive = 0
+        for_count = 2
+        while total_sensitive >= demarcation:
+            for_count += 1
+            total_sensitive -= demarcation
+            calc_sensitive += int(demarcation / for_count)
+        return calc_sensitive + int(total_sensitive / (for_count + 1))
+
+    demarcation = int(demarcation)
+    if total_sensitive < demarcation:  # 不足一个梯队 (包括负数), divmod 向下取整, 不能用于负数
+        return int(total_sensitive / 3)
+    tier_count, remainder = divmod(total_sensitive, demarcation)
+    prefix = _get_tier_prefix_sums(demarcation)
+    return prefix[min(tier_count + 2, demarcation)] + int(remainder / (tier_count + 3))
+
+
 def sensitive_to_volume(sensitive: int, use_time: float):
     if (sensitive <= 150) or (use_time <= cfg.min_persistance):
         return 0.0
-    total_sensitive = int(sensitive)
-    calc_sensitive = 0
-    for_count = 1
-    while True:
-        for_count += 1
-        if for_count <= 2:
-            continue
-        if total_sensitive >= cfg.sensitive_calc_demarcation:
-            total_sensitive -= cfg.sensitive_calc_demarcation
-            calc_sensitive += int(cfg.sensitive_calc_demarcation / for_count)
-        else:
-            calc_sensitive += int(total_sensitive / for_count)
-            break
-    base_value = (calc_sensitive + use_time / 16) / 16
+    base_value = (sensitive_to_calc_sensitive(sensitive) + use_time / 16) / 16
     return random.randint(int(base_value / 2 * 100), int(base_value * 2.5 * 100)) / 100
+
+
+def sensitive_to_volume_batch(sensitive, use_time, rng=None):
+    """
+    sensitive_to_volume 的批量版本, 用于模拟。需要 numpy
+    :param sensitive: 敏感度数组
+    :param use_time: 耗时数组, 与 sensitive 形状相同
+    :param rng: numpy.random.Generator, 为 None 时使用 numpy.random.default_rng()
+    :return: 量的数组 (float64)
+    """
+    import numpy as np
+
+    demarcation = cfg.sensitive_calc_demarcation
+    if (demarcation <= 0) or (demarcation != int(demarcation)):
+        raise ValueError(f"sensitive_calc_demarcation must be a positive integer: {demarcation}")
+    demarcation = int(demarcation)
+    sensitive = np.asarray(sensitive, dtype=np.float64)
+    use_time = np.asarray(use_time, dtype=np.float64)
+    if rng is None:
+        rng = np.random.default_rng()
+
+    total_sensitive = np.trunc(sensitive).astype(np.int64)
+    tier_count, remainder = np.divmod(np.maximum(total_sensitive, 0), demarcation)
+    prefix = np.asarray(_get_tier_prefix_sums(demarcation), dtype=np.int64)
+    calc_sensitive = prefix[np.minimum(tier_count + 2, demarcation)] + remainder // (tier_count + 3)
+
+    base_value = (calc_sensitive + use_time / 16) / 16
+    low = np.trunc(base_value / 2 * 100).astype(np.int64)
+    high = np.trunc(base_value * 2.5 * 100).astype(np.int64)
+    ret = rng.integers(low, high, endpoint=True) / 100
+    return np.where((sensitive <= 150) | (use_time <= cfg.min_persistance), 0.0, ret)